@@ -12,5 +12,30 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# route the chat endpoints to the async views, see backendApp/async_views.py
+os.environ.setdefault('ASYNC_CHAT_VIEWS', 'True')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def lifespan(receive, send):
+    """Warm the async OpenAI client in the worker's event loop, close it on shutdown"""
+    from backendApp.services.openai_client import aclose_async_client, awarm_async_client
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await awarm_async_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_async_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    # Django does not handle the lifespan protocol
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    await django_application(scope, receive, send)
@@ -11,9 +11,11 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 load_dotenv()
 
@@ -47,9 +49,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backendApp.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware', 
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'backendApp.middleware.SessionActivityMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -57,6 +61,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-request DB query headers for the load tests in benchmarks/
+BENCHMARK_QUERY_HEADERS = os.getenv('BENCHMARK_QUERY_HEADERS', 'False') == 'True'
+if BENCHMARK_QUERY_HEADERS:
+    MIDDLEWARE.insert(0, 'backendApp.middleware.QueryCountHeaderMiddleware')
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -93,6 +102,38 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # AI responses keyed by prompt hash. LocMemCache evicts least recently
+    # used entries past MAX_ENTRIES; point CHAT_CACHE_BACKEND/LOCATION at a
+    # shared backend (e.g. Redis) to share hits between workers.
+    'chat_responses': {
+        'BACKEND': os.getenv('CHAT_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CHAT_CACHE_LOCATION', 'chat-responses'),
+        'TIMEOUT': int(os.getenv('CHAT_CACHE_TTL', 60 * 60 * 24)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CHAT_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
+    # Session data for the cached_db session engine and the last activity of
+    # every session (services/session_activity.py). Per process by default,
+    # point CHAT_SESSION_CACHE_BACKEND/LOCATION at a shared backend (Redis,
+    # memcached) so the workers share them and cached_db can be used.
+    'sessions': {
+        'BACKEND': os.getenv('CHAT_SESSION_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CHAT_SESSION_CACHE_LOCATION', 'sessions'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CHAT_SESSION_CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -185,8 +226,29 @@ CORS_ALLOW_METHODS = [
     'PUT',
 ]
 
+# Sessions live in the database, which prune_chats --expired-sessions needs.
+# With a shared 'sessions' cache they are read from the cache and written
+# through (cached_db); a per-process cache would leave every other worker a
+# stale copy of a session flushed or changed in one, so cached_db refuses it.
+# Sessions are only saved when they change: SessionActivityMiddleware renews
+# the cookie and services/session_activity.py slides expire_date in batches.
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+_shared_session_cache = CACHES['sessions']['BACKEND'] not in PROCESS_LOCAL_CACHES
+SESSION_ENGINE = os.getenv(
+    'SESSION_ENGINE',
+    'django.contrib.sessions.backends.cached_db' if _shared_session_cache else 'django.contrib.sessions.backends.db'
+)
+if SESSION_ENGINE == 'django.contrib.sessions.backends.cached_db' and not _shared_session_cache:
+    raise ImproperlyConfigured(
+        "SESSION_ENGINE cached_db needs a 'sessions' cache shared by all workers, "
+        "set CHAT_SESSION_CACHE_BACKEND to Redis or memcached"
+    )
+SESSION_CACHE_ALIAS = 'sessions'
 SESSION_COOKIE_AGE = 86400 * 7  
-SESSION_SAVE_EVERY_REQUEST = True
+SESSION_SAVE_EVERY_REQUEST = False
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 SESSION_COOKIE_SAMESITE = 'Lax'
 SESSION_COOKIE_SECURE = False  
@@ -201,4 +263,155 @@ CSRF_TRUSTED_ORIGINS = [
 
 
 
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
\ No newline at end of file
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# e.g. http://127.0.0.1:8100/v1 for the stub server in benchmarks/
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+
+# Connection pool of the per-process OpenAI clients (services/openai_client.py).
+# OPENAI_HTTP2 needs the h2 package (pip install httpx[http2]).
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 50))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', 60))
+OPENAI_HTTP2 = os.getenv('OPENAI_HTTP2', 'False') == 'True'
+# open a connection (GET /models) when a gunicorn worker boots
+OPENAI_WARMUP_REQUEST = os.getenv('OPENAI_WARMUP_REQUEST', 'True') == 'True'
+
+# Serve the async chat views (backendApp/async_views.py) instead of the sync
+# DRF ones. backend/asgi.py turns this on, the WSGI entry point leaves it off.
+ASYNC_CHAT_VIEWS = os.getenv('ASYNC_CHAT_VIEWS', 'False') == 'True'
+
+# Response cache in front of CodingChatAI.get_response, see CACHES above
+CHAT_RESPONSE_CACHE_ENABLED = os.getenv('CHAT_RESPONSE_CACHE_ENABLED', 'True') == 'True'
+CHAT_RESPONSE_CACHE_ALIAS = 'chat_responses'
+
+# OpenAI calls: each request gets CHAT_LLM_DEADLINE seconds in total, split
+# into attempts of at most CHAT_LLM_ATTEMPT_TIMEOUT. 408/409/429/5xx and
+# timeouts are retried with jittered exponential backoff. After
+# CHAT_LLM_BREAKER_FAILURES failures in a row calls fail fast for
+# CHAT_LLM_BREAKER_RESET_TIMEOUT seconds. With hedging on, a completion slower
+# than the CHAT_LLM_HEDGE_PERCENTILE of recent ones gets a second attempt.
+CHAT_LLM_DEADLINE = float(os.getenv('CHAT_LLM_DEADLINE', 60))
+CHAT_LLM_ATTEMPT_TIMEOUT = float(os.getenv('CHAT_LLM_ATTEMPT_TIMEOUT', 45))
+CHAT_LLM_MAX_ATTEMPTS = int(os.getenv('CHAT_LLM_MAX_ATTEMPTS', 3))
+CHAT_LLM_RETRY_BASE_DELAY = 0.5
+CHAT_LLM_RETRY_MAX_DELAY = 8
+CHAT_LLM_BREAKER_FAILURES = int(os.getenv('CHAT_LLM_BREAKER_FAILURES', 5))
+CHAT_LLM_BREAKER_RESET_TIMEOUT = float(os.getenv('CHAT_LLM_BREAKER_RESET_TIMEOUT', 30))
+CHAT_LLM_HEDGE_ENABLED = os.getenv('CHAT_LLM_HEDGE_ENABLED', 'False') == 'True'
+CHAT_LLM_HEDGE_PERCENTILE = 95
+CHAT_LLM_HEDGE_MIN_SAMPLES = 20  # recent successful calls needed before hedging
+CHAT_LLM_HEDGE_MAX_THREADS = 16
+
+# Identical prompts in flight at the same time share one OpenAI call, across
+# the workers of a host through flocks in CHAT_SINGLE_FLIGHT_LOCK_DIR. Waiters
+# call on their own after CHAT_SINGLE_FLIGHT_TIMEOUT seconds.
+CHAT_SINGLE_FLIGHT_ENABLED = os.getenv('CHAT_SINGLE_FLIGHT_ENABLED', 'True') == 'True'
+CHAT_SINGLE_FLIGHT_LOCK_DIR = os.getenv(
+    'CHAT_SINGLE_FLIGHT_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'chat-single-flight')
+)
+CHAT_SINGLE_FLIGHT_TIMEOUT = float(os.getenv('CHAT_SINGLE_FLIGHT_TIMEOUT', 60))
+
+# Admission control for the chat endpoints, see services/admission.py.
+# Per session: CHAT_RATE_LIMIT_REQUESTS requests per minute in bursts of up
+# to CHAT_RATE_LIMIT_BURST, CHAT_RATE_LIMIT_TOKENS LLM tokens per minute (0
+# turns a limit off). Per host: CHAT_UPSTREAM_CONCURRENCY generations in
+# flight, with a queue of CHAT_ADMISSION_QUEUE_SIZE waiting requests per
+# process, CHAT_ADMISSION_QUEUE_PER_SESSION of them per session, each waiting
+# at most CHAT_ADMISSION_QUEUE_TIMEOUT seconds. Refusals are 429s.
+CHAT_ADMISSION_ENABLED = os.getenv('CHAT_ADMISSION_ENABLED', 'True') == 'True'
+CHAT_RATE_LIMIT_REQUESTS = float(os.getenv('CHAT_RATE_LIMIT_REQUESTS', 30))
+CHAT_RATE_LIMIT_BURST = float(os.getenv('CHAT_RATE_LIMIT_BURST', 10))
+CHAT_RATE_LIMIT_TOKENS = float(os.getenv('CHAT_RATE_LIMIT_TOKENS', 60000))
+CHAT_UPSTREAM_CONCURRENCY = int(os.getenv('CHAT_UPSTREAM_CONCURRENCY', 32))
+CHAT_ADMISSION_QUEUE_SIZE = int(os.getenv('CHAT_ADMISSION_QUEUE_SIZE', 64))
+CHAT_ADMISSION_QUEUE_PER_SESSION = int(os.getenv('CHAT_ADMISSION_QUEUE_PER_SESSION', 2))
+CHAT_ADMISSION_QUEUE_TIMEOUT = float(os.getenv('CHAT_ADMISSION_QUEUE_TIMEOUT', 10))
+CHAT_ADMISSION_STATE_DIR = os.getenv(
+    'CHAT_ADMISSION_STATE_DIR', os.path.join(tempfile.gettempdir(), 'chat-admission')
+)
+
+# POST /api/chat/batch/: up to CHAT_BATCH_MAX_ITEMS messages per request,
+# CHAT_BATCH_CONCURRENCY completions in flight at a time (a request may ask
+# for less)
+CHAT_BATCH_MAX_ITEMS = int(os.getenv('CHAT_BATCH_MAX_ITEMS', 50))
+CHAT_BATCH_CONCURRENCY = int(os.getenv('CHAT_BATCH_CONCURRENCY', 8))
+
+# GET /api/search/: at most CHAT_SEARCH_MAX_RESULTS hits per query
+CHAT_SEARCH_MAX_RESULTS = int(os.getenv('CHAT_SEARCH_MAX_RESULTS', 50))
+
+# Deleting chat sessions (DELETE /api/sessions/{id}/ and /api/session/):
+# messages go in raw DELETEs of CHAT_DELETE_BATCH_SIZE rows, each in a
+# transaction of its own. With ?async=1, or always with
+# CHAT_DELETE_IN_BACKGROUND, the sessions are only marked deleted before
+# the 202 answer and purged by a thread; prune_chats purges any a worker
+# left marked when it exited.
+CHAT_DELETE_BATCH_SIZE = int(os.getenv('CHAT_DELETE_BATCH_SIZE', 1000))
+CHAT_DELETE_IN_BACKGROUND = os.getenv('CHAT_DELETE_IN_BACKGROUND', 'False') == 'True'
+
+# manage.py prune_chats writes the sessions it deletes to gzip'd NDJSON
+# files under CHAT_ARCHIVE_DIR
+CHAT_ARCHIVE_DIR = os.getenv('CHAT_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+
+# Local analysis of the code blocks of a message before it goes to the model
+# (services/code_analysis.py): up to CHAT_CODE_ANALYSIS_MAX_BLOCKS blocks of
+# CHAT_CODE_ANALYSIS_MAX_CHARS each, in a pool of CHAT_CODE_ANALYSIS_WORKERS
+# processes per worker (0 analyses in the request thread), given up on after
+# CHAT_CODE_ANALYSIS_TIMEOUT seconds. Results are cached by content hash.
+CHAT_CODE_ANALYSIS_ENABLED = os.getenv('CHAT_CODE_ANALYSIS_ENABLED', 'True') == 'True'
+CHAT_CODE_ANALYSIS_WORKERS = int(os.getenv('CHAT_CODE_ANALYSIS_WORKERS', 2))
+CHAT_CODE_ANALYSIS_TIMEOUT = float(os.getenv('CHAT_CODE_ANALYSIS_TIMEOUT', 2))
+CHAT_CODE_ANALYSIS_MAX_BLOCKS = int(os.getenv('CHAT_CODE_ANALYSIS_MAX_BLOCKS', 5))
+CHAT_CODE_ANALYSIS_MAX_CHARS = int(os.getenv('CHAT_CODE_ANALYSIS_MAX_CHARS', 50000))
+CHAT_CODE_ANALYSIS_CACHE_ALIAS = 'default'
+CHAT_CODE_ANALYSIS_CACHE_TIMEOUT = int(os.getenv('CHAT_CODE_ANALYSIS_CACHE_TIMEOUT', 60 * 60 * 24))
+
+# Code the user revises is sent as a unified diff against the earlier
+# version still in the prompt (services/code_revisions.py): for blocks of at
+# least CHAT_REVISION_MIN_LINES lines, at least CHAT_REVISION_MIN_SIMILARITY
+# similar to it, when the diff is at most CHAT_REVISION_MAX_DIFF_RATIO of
+# the block's tokens.
+CHAT_REVISION_DIFFS_ENABLED = os.getenv('CHAT_REVISION_DIFFS_ENABLED', 'True') == 'True'
+CHAT_REVISION_MIN_LINES = int(os.getenv('CHAT_REVISION_MIN_LINES', 8))
+CHAT_REVISION_MIN_SIMILARITY = float(os.getenv('CHAT_REVISION_MIN_SIMILARITY', 0.6))
+CHAT_REVISION_MAX_DIFF_RATIO = float(os.getenv('CHAT_REVISION_MAX_DIFF_RATIO', 0.6))
+
+# Session activity (services/session_activity.py): kept in the
+# CHAT_SESSION_ACTIVITY_CACHE_ALIAS cache and written to django_session by
+# every worker at most once every CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL
+# seconds, CHAT_SESSION_ACTIVITY_BATCH_SIZE sessions per UPDATE.
+CHAT_SESSION_ACTIVITY_CACHE_ALIAS = 'sessions'
+CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL = float(os.getenv('CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL', 60))
+CHAT_SESSION_ACTIVITY_BATCH_SIZE = int(os.getenv('CHAT_SESSION_ACTIVITY_BATCH_SIZE', 500))
+
+# POST /api/reviews/ (services/code_review.py): uploads are unpacked under
+# CHAT_REVIEW_DIR for the length of the review. At most CHAT_REVIEW_MAX_FILES
+# source files and CHAT_REVIEW_MAX_TOTAL_BYTES of code, larger files than
+# CHAT_REVIEW_MAX_FILE_BYTES are skipped. Files are reviewed in chunks of
+# about CHAT_REVIEW_CHUNK_TOKENS, CHAT_REVIEW_CONCURRENCY at a time.
+CHAT_REVIEW_DIR = os.getenv('CHAT_REVIEW_DIR', str(MEDIA_ROOT / 'code_files'))
+CHAT_REVIEW_MAX_FILES = int(os.getenv('CHAT_REVIEW_MAX_FILES', 1000))
+CHAT_REVIEW_MAX_FILE_BYTES = int(os.getenv('CHAT_REVIEW_MAX_FILE_BYTES', 512 * 1024))
+CHAT_REVIEW_MAX_TOTAL_BYTES = int(os.getenv('CHAT_REVIEW_MAX_TOTAL_BYTES', 20 * 1024 * 1024))
+CHAT_REVIEW_CHUNK_TOKENS = int(os.getenv('CHAT_REVIEW_CHUNK_TOKENS', 1500))
+CHAT_REVIEW_CONCURRENCY = int(os.getenv('CHAT_REVIEW_CONCURRENCY', 8))
+
+# Queued replies (?async=1): stored as ChatJob rows and processed by
+# `manage.py run_chat_worker` with CHAT_JOB_WORKERS threads. A claimed job is
+# leased for CHAT_JOB_VISIBILITY_TIMEOUT seconds, then another worker may take
+# it over. Transient failures are retried up to CHAT_JOB_MAX_ATTEMPTS times.
+CHAT_JOB_WORKERS = int(os.getenv('CHAT_JOB_WORKERS', 4))
+CHAT_JOB_VISIBILITY_TIMEOUT = int(os.getenv('CHAT_JOB_VISIBILITY_TIMEOUT', 300))
+CHAT_JOB_MAX_ATTEMPTS = int(os.getenv('CHAT_JOB_MAX_ATTEMPTS', 3))
+CHAT_JOB_RETRY_DELAY = 10  # seconds before the second attempt, doubled after each
+CHAT_JOB_POLL_INTERVAL = float(os.getenv('CHAT_JOB_POLL_INTERVAL', 1))
+CHAT_LONG_POLL_MAX_WAIT = 25  # seconds, well under nginx's 60s proxy_read_timeout
+
+# Prompt context: recent turns are packed into CHAT_HISTORY_TOKEN_BUDGET
+# tokens, older ones are folded into a rolling summary on the ChatSession
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', 6000))
+CHAT_CONTEXT_MAX_MESSAGES = 50  # rows fetched per turn before packing
+CHAT_TOKENIZER_ENCODING = 'o200k_base'  # gpt-4o family
+CHAT_SUMMARY_MAX_TOKENS = 400
+CHAT_SUMMARY_MESSAGE_CHARS = 2000  # per message, when building the summary prompt
+CHAT_SUMMARY_BATCH_TOKENS = 6000
+CHAT_SUMMARY_MAX_BACKLOG = 200  # older unsummarized rows folded in per turn
\ No newline at end of file
@@ -1,45 +1,82 @@
 
 from django.contrib import admin
-from .models import ChatSession, ChatMessage
+from django.db.models import Q
+from .models import ChatSession, ChatMessage, ChatJob, CodeReview, ReviewedFile
+from .services.search_service import matching_message_ids
+
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ['id', 'title', 'session_key', 'message_count', 'created_at', 'updated_at']
     list_filter = ['created_at', 'updated_at']
     search_fields = ['title', 'session_key', 'id']
-    readonly_fields = ['id', 'created_at', 'updated_at']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'message_count', 'last_message_at']
     
     fieldsets = (
         ('Session Info', {
-            'fields': ('id', 'session_key', 'title')
+            'fields': ('id', 'session_key', 'title', 'response_cache_enabled')
+        }),
+        ('Activity', {
+            'fields': ('message_count', 'last_message_at'),
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         })
     )
-    
-    def message_count(self, obj):
-        return obj.messages.count()
-    message_count.short_description = 'Messages'
+
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'session', 'message_type', 'content_preview', 'tokens_used', 'response_time', 'created_at']
-    list_filter = ['message_type', 'created_at']
+    list_display = ['id', 'session', 'message_type', 'status', 'content_preview', 'tokens_used', 'response_time', 'created_at']
+    list_filter = ['message_type', 'status', 'cached', 'created_at']
     search_fields = ['content', 'session__title']
-    readonly_fields = ['id', 'created_at', 'tokens_used', 'response_time']
+    readonly_fields = ['id', 'created_at', 'tokens_used', 'response_time', 'time_to_first_token', 'cached']
     
     fieldsets = (
         ('Message Info', {
-            'fields': ('session', 'message_type', 'content')
+            'fields': ('session', 'message_type', 'status', 'content', 'error')
         }),
         ('Metadata', {
-            'fields': ('tokens_used', 'response_time', 'created_at'),
+            'fields': ('tokens_used', 'response_time', 'time_to_first_token', 'cached', 'created_at'),
             'classes': ('collapse',)
         })
     )
     
+    def get_search_results(self, request, queryset, search_term):
+        # content goes through the full-text index, an icontains scan over
+        # every message is far too slow
+        if not search_term:
+            return queryset, False
+        titles = ChatSession.objects.filter(title__icontains=search_term)
+        return queryset.filter(
+            Q(pk__in=matching_message_ids(search_term)) | Q(session__in=titles)
+        ), False
+    
     def content_preview(self, obj):
-        return obj.content[:100] + '...' if len(obj.content) > 100 else obj.content
-    content_preview.short_description = 'Content Preview'
\ No newline at end of file
+        return obj.preview
+    content_preview.short_description = 'Content Preview'
+
+
+@admin.register(ChatJob)
+class ChatJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'assistant_message', 'status', 'attempts', 'available_at', 'locked_by', 'locked_until']
+    list_filter = ['status', 'created_at']
+    readonly_fields = ['id', 'user_message', 'assistant_message', 'attempts', 'locked_by', 'locked_until', 'created_at', 'updated_at']
+
+
+class ReviewedFileInline(admin.TabularInline):
+    model = ReviewedFile
+    fields = ['path', 'language', 'status', 'reused', 'chunk_count', 'fingerprint']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(CodeReview)
+class CodeReviewAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'session_key', 'status', 'file_count', 'reviewed_count', 'reused_count', 'tokens_used', 'created_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['name', 'session_key']
+    readonly_fields = ['id', 'file_count', 'reviewed_count', 'reused_count', 'skipped_count', 'failed_count', 'chunk_count', 'tokens_used', 'created_at', 'completed_at']
+    inlines = [ReviewedFileInline]
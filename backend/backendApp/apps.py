@@ -1,6 +1,28 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_index(sender, using, **kwargs):
+    # SQLite drops the search triggers whenever a migration rebuilds the
+    # messages table, put them back (a no-op when nothing is missing)
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+    from .services.search_service import install_search_index
+
+    connection = connections[using]
+    recorder = MigrationRecorder(connection)
+    if not recorder.has_table() or not recorder.migration_qs.filter(
+        app='backendApp', name='0017_chatmessage_search_index_keys'
+    ).exists():
+        return
+    # not atomic: on Postgres the index is built CONCURRENTLY
+    with connection.schema_editor(atomic=False) as schema_editor:
+        install_search_index(schema_editor)
 
 
 class BackendappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backendApp'
+
+    def ready(self):
+        post_migrate.connect(ensure_search_index, sender=self)
@@ -0,0 +1,284 @@
+"""
+Async variants of the chat endpoints.
+
+Served in place of QuickChatView and ChatSessionViewSet.send_message when the
+project runs under ASGI (see backend/asgi.py), so a worker is not pinned for
+the whole OpenAI round trip. Only DB work goes through sync_to_async.
+"""
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+
+from .models import ChatSession, ChatMessage
+from .serializers import ChatMessageSerializer, SendMessageSerializer
+from .services.admission import AdmissionRejected, aadmit
+from .services.ai_service import CodingChatAI
+from .services.chat_service import (
+    begin_exchange, complete_exchange, fail_exchange, aupdate_rolling_summary, create_chat_session
+)
+from .services.job_queue import await_message, enqueue_reply
+from .views import (
+    wants_stream, wants_queued_reply, long_poll_timeout, queued_reply_payload, sse_event, session_payload
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncChatView(View):
+    """Base class for the async chat views, mirroring DRF's JSON handling"""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # DRF's APIView is csrf exempt for anonymous session users, keep parity
+        view.csrf_exempt = True
+        return view
+
+    def json_response(self, data, status=200):
+        return JsonResponse(data, status=status, encoder=DjangoJSONEncoder, safe=False)
+
+    def parse_message(self, request):
+        """Returns (validated_data, None) or (None, error response)"""
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None, self.json_response({'detail': 'JSON parse error'}, status=400)
+
+        serializer = SendMessageSerializer(data=data)
+        if not serializer.is_valid():
+            return None, self.json_response(serializer.errors, status=400)
+        return serializer.validated_data, None
+
+    def too_many_requests(self, error):
+        response = self.json_response(
+            {'error': 'Too many requests, please retry later', 'reason': error.reason, 'retry_after': error.retry_after},
+            status=429
+        )
+        response['Retry-After'] = str(error.retry_after)
+        return response
+
+    def queued_reply_response(self, session, user_msg, assistant_msg, job):
+        payload = queued_reply_payload(session, user_msg, assistant_msg, job)
+        response = self.json_response(payload, status=202)
+        response['Location'] = payload['poll_url']
+        return response
+
+
+def astream_ai_reply(session, user_msg, assistant_msg, conversation_history, permit=None):
+    """Async counterpart of views.stream_ai_reply()"""
+    ai_service = CodingChatAI()
+
+    async def events():
+        start_time = time.time()
+        time_to_first_token = None
+        parts = []
+        result = None
+        ai_events = None
+
+        try:
+            yield sse_event('start', {
+                'user_message': ChatMessageSerializer(user_msg).data,
+                'assistant_message_id': str(assistant_msg.id),
+                'session_id': str(session.id)
+            })
+
+            summary = await aupdate_rolling_summary(session, conversation_history)
+            ai_events = ai_service.astream_response(
+                user_msg.content, conversation_history,
+                use_cache=session.response_cache_enabled, summary=summary
+            )
+
+            async for event in ai_events:
+                if event['type'] == 'delta':
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    parts.append(event['content'])
+                    yield sse_event('delta', {'content': event['content']})
+                else:
+                    result = event
+        finally:
+            if ai_events is not None:
+                await ai_events.aclose()
+
+            if result is None:
+                result = {
+                    'response': ''.join(parts),
+                    'tokens_used': None,
+                    'response_time': time.time() - start_time,
+                    'time_to_first_token': time_to_first_token,
+                    'error': 'Client disconnected before the response finished',
+                    'success': False,
+                }
+                logger.info(f"Client disconnected from stream for session {session.id}")
+
+            await sync_to_async(complete_exchange)(assistant_msg, result)
+            if permit is not None:
+                await permit.acharge(result.get('tokens_used'))
+                permit.release()
+
+        if result['success']:
+            yield sse_event('done', {
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'success': True
+            })
+        else:
+            yield sse_event('error', {
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'error': result.get('error', 'Failed to process message'),
+                'success': False
+            })
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class AsyncSendMessageView(AsyncChatView):
+    """Async POST /api/sessions/{id}/send_message/"""
+
+    async def post(self, request, pk):
+        session_key = request.session.session_key
+        if not session_key:
+            return self.json_response({'detail': 'Not found.'}, status=404)
+
+        try:
+            session = await ChatSession.objects.aget(id=pk, session_key=session_key)
+        except ChatSession.DoesNotExist:
+            return self.json_response({'detail': 'Not found.'}, status=404)
+
+        data, error_response = self.parse_message(request)
+        if error_response:
+            return error_response
+
+        user_message = data['message']
+        assistant_msg = None
+
+        try:
+            permit = await aadmit(session_key, slots=0 if wants_queued_reply(request) else 1)
+        except AdmissionRejected as e:
+            return self.too_many_requests(e)
+
+        try:
+            user_msg, assistant_msg, conversation_history = await sync_to_async(begin_exchange)(
+                session, user_message, only_if_title="New Chat"
+            )
+
+            if wants_queued_reply(request):
+                job = await sync_to_async(enqueue_reply)(user_msg, assistant_msg)
+                return self.queued_reply_response(session, user_msg, assistant_msg, job)
+
+            if wants_stream(request):
+                return astream_ai_reply(session, user_msg, assistant_msg, conversation_history, permit.handover())
+
+            summary = await aupdate_rolling_summary(session, conversation_history)
+            ai_result = await CodingChatAI().aget_response(
+                user_message, conversation_history,
+                use_cache=session.response_cache_enabled, summary=summary
+            )
+            await permit.acharge(ai_result.get('tokens_used'))
+            await sync_to_async(complete_exchange)(assistant_msg, ai_result)
+
+            await session.arefresh_from_db()
+            session_data = await sync_to_async(session_payload)(session, request)
+
+            return self.json_response({
+                'user_message': ChatMessageSerializer(user_msg).data,
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'session': session_data
+            })
+
+        except Exception as e:
+            logger.error(f"Error in async send_message: {str(e)}")
+            if assistant_msg is not None:
+                await sync_to_async(fail_exchange)(assistant_msg, e)
+            return self.json_response({'error': 'Failed to process message'}, status=500)
+        finally:
+            permit.release()
+
+
+class AsyncQuickChatView(AsyncChatView):
+    """Async POST /api/chat/"""
+
+    async def post(self, request):
+        data, error_response = self.parse_message(request)
+        if error_response:
+            return error_response
+
+        user_message = data['message']
+        session_id = data.get('session_id')
+        assistant_msg = None
+
+        if not request.session.session_key:
+            await sync_to_async(request.session.create)()
+        session_key = request.session.session_key
+
+        try:
+            permit = await aadmit(session_key, slots=0 if wants_queued_reply(request) else 1)
+        except AdmissionRejected as e:
+            return self.too_many_requests(e)
+
+        try:
+            session = None
+            if session_id:
+                session = await ChatSession.objects.filter(
+                    id=session_id,
+                    session_key=session_key
+                ).afirst()
+            if session is None:
+                session = await sync_to_async(create_chat_session)(session_key, "Quick Chat")
+
+            user_msg, assistant_msg, conversation_history = await sync_to_async(begin_exchange)(
+                session, user_message
+            )
+
+            if wants_queued_reply(request):
+                job = await sync_to_async(enqueue_reply)(user_msg, assistant_msg)
+                return self.queued_reply_response(session, user_msg, assistant_msg, job)
+
+            if wants_stream(request):
+                return astream_ai_reply(session, user_msg, assistant_msg, conversation_history, permit.handover())
+
+            summary = await aupdate_rolling_summary(session, conversation_history)
+            ai_result = await CodingChatAI().aget_response(
+                user_message, conversation_history,
+                use_cache=session.response_cache_enabled, summary=summary
+            )
+            await permit.acharge(ai_result.get('tokens_used'))
+            await sync_to_async(complete_exchange)(assistant_msg, ai_result)
+
+            return self.json_response({
+                'user_message': ChatMessageSerializer(user_msg).data,
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'session_id': str(session.id),
+                'success': ai_result['success']
+            })
+
+        except Exception as e:
+            logger.error(f"Error in async quick_chat: {str(e)}")
+            if assistant_msg is not None:
+                await sync_to_async(fail_exchange)(assistant_msg, e)
+            return self.json_response({'error': 'Failed to process message'}, status=500)
+        finally:
+            permit.release()
+
+
+class AsyncMessageView(AsyncChatView):
+    """Async GET /api/messages/{id}/, long-polling without holding a thread"""
+
+    async def get(self, request, pk):
+        session_key = request.session.session_key
+        if not session_key:
+            return self.json_response({'detail': 'Not found.'}, status=404)
+
+        queryset = ChatMessage.objects.filter(pk=pk, session__session_key=session_key)
+        message = await await_message(queryset, long_poll_timeout(request))
+        if message is None:
+            return self.json_response({'detail': 'Not found.'}, status=404)
+
+        return self.json_response(ChatMessageSerializer(message).data)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from backendApp.models import ChatSession
+from backendApp.services.chat_service import recompute_session_counters
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized message_count and last_message_* columns of chat sessions'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--session-key',
+            help='Only recompute the chat sessions of this Django session key'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Sessions updated per query (default: 500)'
+        )
+    
+    def handle(self, *args, **options):
+        sessions = ChatSession.objects.all()
+        if options['session_key']:
+            sessions = sessions.filter(session_key=options['session_key'])
+        
+        total = recompute_session_counters(sessions, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Recomputed counters for {total} chat sessions'))
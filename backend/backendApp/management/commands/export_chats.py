@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+import sys
+
+from backendApp.models import ChatSession
+from backendApp.services.chat_archive import iter_ndjson, iter_records
+
+
+class Command(BaseCommand):
+    help = 'Stream chat sessions and their messages as NDJSON (the format import_chats reads)'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='File to write, gzip\'d if it ends in .gz (default: stdout)'
+        )
+        parser.add_argument(
+            '--session-key',
+            help='Only the sessions of this Django session key'
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            help='Compress the output (implied by a .gz output file)'
+        )
+    
+    def handle(self, *args, **options):
+        sessions = ChatSession.objects.filter(deleted_at__isnull=True)
+        if options['session_key']:
+            sessions = sessions.filter(session_key=options['session_key'])
+        
+        output = options['output']
+        compress = options['gzip'] or output.endswith('.gz')
+        chunks = iter_ndjson(iter_records(sessions), compress=compress)
+        
+        if output == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+        
+        with open(output, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        self.stdout.write(self.style.SUCCESS(f'Exported to {output}'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+import gzip
+import sys
+
+from backendApp.services.chat_archive import IMPORT_BATCH_SIZE, import_records, read_records
+
+
+class Command(BaseCommand):
+    help = 'Import chat sessions and messages from NDJSON written by export_chats or prune_chats'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file, gzip\'d or not, - for stdin')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=IMPORT_BATCH_SIZE,
+            help=f'Rows inserted per transaction (default: {IMPORT_BATCH_SIZE})'
+        )
+    
+    def handle(self, *args, **options):
+        source = self.open(options['path'])
+        
+        try:
+            sessions, messages = import_records(read_records(source), max(1, options['batch_size']))
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            source.close()
+        
+        self.stdout.write(self.style.SUCCESS(f'Imported {sessions} sessions and {messages} messages'))
+    
+    def open(self, path):
+        source = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        if source.peek(2)[:2] == b'\x1f\x8b':
+            return gzip.GzipFile(fileobj=source)
+        return source
@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Sum
+from django.utils import timezone
+from datetime import timedelta
+import time
+
+from backendApp.services.chat_service import purge_deleted_reviews, purge_deleted_sessions
+from backendApp.services.retention import PruneRun, RetentionError, prunable_sessions, prune, run_lock
+
+
+class Command(BaseCommand):
+    help = (
+        'Archive chat sessions idle for N days or tied to expired Django sessions to '
+        'gzip\'d NDJSON, then delete them in batches. An interrupted run is resumed.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            metavar='DAYS',
+            help='Prune sessions without messages for DAYS days'
+        )
+        parser.add_argument(
+            '--expired-sessions',
+            action='store_true',
+            help='Prune sessions whose Django session has expired or was removed'
+        )
+        parser.add_argument(
+            '--archive-dir',
+            default=settings.CHAT_ARCHIVE_DIR,
+            help=f'Where the archives and run state go (default: {settings.CHAT_ARCHIVE_DIR})'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Sessions archived and deleted per batch (default: 100)'
+        )
+        parser.add_argument(
+            '--message-batch-size',
+            type=int,
+            default=1000,
+            help='Messages deleted per transaction (default: 1000)'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to pause between transactions, to go easy on a live database (default: 0)'
+        )
+        parser.add_argument(
+            '--max-runtime',
+            type=float,
+            metavar='MINUTES',
+            help='Stop after the batch running at MINUTES, the next run resumes'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count what would be pruned'
+        )
+    
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        if older_than is not None and older_than < 1:
+            raise CommandError('--older-than must be at least 1 day')
+        
+        try:
+            if options['dry_run']:
+                return self.dry_run(older_than, options['expired_sessions'])
+            with run_lock(options['archive_dir']):
+                self.prune(options)
+        except RetentionError as e:
+            raise CommandError(str(e))
+    
+    def dry_run(self, older_than, expired_sessions):
+        if older_than is None and not expired_sessions:
+            raise CommandError('Pass --older-than and/or --expired-sessions')
+        now = timezone.now()
+        sessions = prunable_sessions(
+            now - timedelta(days=older_than) if older_than else None,
+            now if expired_sessions else None
+        )
+        totals = sessions.aggregate(sessions=Count('id'), messages=Sum('message_count'))
+        self.stdout.write(
+            f"Would archive and delete {totals['sessions']} sessions "
+            f"with {totals['messages'] or 0} messages"
+        )
+    
+    def prune(self, options):
+        run = PruneRun.unfinished(options['archive_dir'])
+        if run is not None:
+            # the criteria and cutoffs of the interrupted run apply
+            self.stdout.write(f"Resuming {run.path} after {run.state['batches']} batches")
+        elif options['older_than'] is None and not options['expired_sessions']:
+            raise CommandError('Pass --older-than and/or --expired-sessions')
+        else:
+            run = PruneRun.start(options['archive_dir'], options['older_than'], options['expired_sessions'])
+            self.stdout.write(f"Pruning into {run.path}")
+        
+        # deletions a web worker could not finish
+        leftover = purge_deleted_sessions(batch_size=max(1, options['message_batch_size']), pause=options['sleep'])
+        if leftover[0]:
+            self.stdout.write(f"Purged {leftover[0]} sessions and {leftover[1]} messages marked deleted")
+        reviews = purge_deleted_reviews(batch_size=max(1, options['message_batch_size']), pause=options['sleep'])
+        if reviews:
+            self.stdout.write(f"Purged {reviews} code reviews marked deleted")
+        
+        deadline = None
+        if options['max_runtime']:
+            deadline = time.monotonic() + options['max_runtime'] * 60
+        
+        def progress(batch_file, deleted):
+            self.stdout.write(f"{batch_file}: deleted {deleted[0]} sessions, {deleted[1]} messages")
+        
+        finished = prune(
+            run, max(1, options['batch_size']), max(1, options['message_batch_size']),
+            pause=options['sleep'], deadline=deadline, progress=progress
+        )
+        
+        summary = f"{run.state['sessions']} sessions and {run.state['messages']} messages in {run.state['batches']} batches"
+        if finished:
+            self.stdout.write(self.style.SUCCESS(f"Pruned {summary}"))
+        else:
+            self.stdout.write(self.style.WARNING(f"Stopped after {summary}, run the command again to resume"))
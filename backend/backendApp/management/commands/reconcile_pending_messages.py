@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from datetime import timedelta
+
+from backendApp.services.chat_service import reconcile_pending
+
+class Command(BaseCommand):
+    help = 'Mark assistant messages stuck in pending (abandoned generations) as failed'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=10,
+            help='Age in minutes after which a pending message counts as abandoned (default: 10)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many messages would be marked as failed'
+        )
+    
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(minutes=options['older_than'])
+        count = reconcile_pending(cutoff, dry_run=options['dry_run'])
+        
+        if options['dry_run']:
+            self.stdout.write(f'{count} pending messages older than {options["older_than"]} minutes would be marked as failed')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Marked {count} abandoned pending messages as failed'))
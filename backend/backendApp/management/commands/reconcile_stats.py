@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from backendApp.services.stats_service import reconcile_counters, rebuild_daily_activity
+
+class Command(BaseCommand):
+    help = 'Recompute the activity counters (and optionally daily rollups) from the chat tables to fix drift'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daily-days',
+            type=int,
+            default=0,
+            help='Also rebuild the daily rollups of the last N days (default: 0, counters only)'
+        )
+    
+    def handle(self, *args, **options):
+        scopes = reconcile_counters()
+        self.stdout.write(f'Reconciled counters for {scopes} scopes')
+        
+        if options['daily_days'] > 0:
+            rows = rebuild_daily_activity(days=options['daily_days'])
+            self.stdout.write(f'Rebuilt {rows} daily rollup rows')
+        
+        self.stdout.write(self.style.SUCCESS('Statistics reconciled successfully'))
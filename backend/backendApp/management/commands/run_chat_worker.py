@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connection
+import logging
+import os
+import signal
+import socket
+import threading
+
+from backendApp.services.job_queue import run_next_job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Process queued AI replies (requests sent with ?async=1)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.CHAT_JOB_WORKERS,
+            help=f'Jobs processed concurrently (default: {settings.CHAT_JOB_WORKERS})'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.CHAT_JOB_POLL_INTERVAL,
+            help=f'Seconds between polls of an empty queue (default: {settings.CHAT_JOB_POLL_INTERVAL})'
+        )
+        parser.add_argument(
+            '--drain',
+            action='store_true',
+            help='Exit once no job is due instead of waiting for more'
+        )
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        processed = []
+
+        def shut_down(signum, frame):
+            # jobs in progress are finished, unclaimed ones stay queued
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shut_down)
+        signal.signal(signal.SIGINT, shut_down)
+
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(f"{prefix}:{n}", stop, options['poll_interval'], options['drain'], processed),
+                name=f"chat-worker-{n}"
+            )
+            for n in range(max(1, options['workers']))
+        ]
+
+        self.stdout.write(f"Processing queued replies with {len(threads)} workers")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # join with a timeout so signals are handled meanwhile
+            while thread.is_alive():
+                thread.join(1)
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {len(processed)} jobs'))
+
+    def work(self, worker_id, stop, poll_interval, drain, processed):
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                try:
+                    ran = run_next_job(worker_id)
+                except DatabaseError as e:
+                    logger.error(f"Worker {worker_id} could not claim a job: {str(e)}")
+                    ran = False
+                if ran:
+                    processed.append(worker_id)
+                elif drain:
+                    break
+                else:
+                    stop.wait(poll_interval)
+        finally:
+            connection.close()
@@ -0,0 +1,211 @@
+"""
+Prometheus metrics for the chat API.
+
+Request, DB, LLM and serializer timings are recorded by MetricsMiddleware,
+the instrument_llm decorator on CodingChatAI and the serializers'
+InstrumentedSerializerMixin, and exposed by metrics_view at /metrics.
+
+Under gunicorn every worker is its own process with its own counters. Set
+PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py does) so the workers write their
+samples to files there and /metrics aggregates all of them, whichever
+worker serves the scrape.
+"""
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from functools import wraps
+import inspect
+import os
+import time
+
+LATENCY_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60)
+
+REQUEST_DURATION = Histogram(
+    'chat_http_request_duration_seconds',
+    'Wall time of a request, until the last byte for streamed responses',
+    ['endpoint', 'method', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_QUERIES = Histogram(
+    'chat_http_request_db_queries',
+    'Database queries run by a request',
+    ['endpoint', 'method'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 20, 30, 50, 100),
+)
+REQUEST_DB_DURATION = Histogram(
+    'chat_http_request_db_seconds',
+    'Time a request spent in database queries',
+    ['endpoint', 'method'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+LLM_DURATION = Histogram(
+    'chat_llm_request_duration_seconds',
+    'Latency of a CodingChatAI completion, cache lookups included',
+    ['operation', 'outcome'],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    'chat_llm_time_to_first_token_seconds',
+    'Time until the first streamed token of a completion',
+    ['operation'],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Histogram(
+    'chat_llm_tokens',
+    'Tokens billed for a completion (prompt and completion)',
+    ['operation'],
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+PROMPT_TOKENS_SAVED = Counter(
+    'chat_prompt_tokens_saved_total',
+    'Prompt tokens saved by sending revised code as diffs (services/code_revisions.py)',
+    ['operation'],
+)
+LLM_RETRIES = Counter(
+    'chat_llm_retries_total',
+    'OpenAI attempts retried, by the reason the previous attempt failed',
+    ['reason'],
+)
+LLM_FAILURES = Counter(
+    'chat_llm_failures_total',
+    'Chat completions that failed for good, by reason',
+    ['reason'],
+)
+ADMISSION_REJECTIONS = Counter(
+    'chat_admission_rejections_total',
+    'Chat requests turned away with a 429, by reason',
+    ['reason'],
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'chat_admission_queue_depth',
+    'Requests waiting for an upstream slot',
+    multiprocess_mode='livesum',
+)
+ADMISSION_WAIT = Histogram(
+    'chat_admission_wait_seconds',
+    'Time requests waited for an upstream slot',
+    buckets=(0, .01, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'chat_upstream_in_flight',
+    'Upstream slots held, i.e. chat generations in progress',
+    multiprocess_mode='livesum',
+)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    'chat_response_cache_lookups_total',
+    'Response cache lookups (services/response_cache.py), by result: hit or miss',
+    ['result'],
+)
+SESSION_ACTIVITY_FLUSHED = Counter(
+    'chat_session_activity_flushed_total',
+    'Sessions whose last activity was written to django_session (services/session_activity.py)',
+)
+SERIALIZER_DURATION = Histogram(
+    'chat_serializer_duration_seconds',
+    'Time spent building serializer.data',
+    ['serializer'],
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+)
+
+
+def observe_request(endpoint, method, status, duration, queries):
+    REQUEST_DURATION.labels(endpoint, method, str(status)).observe(duration)
+    REQUEST_DB_QUERIES.labels(endpoint, method).observe(queries.count)
+    REQUEST_DB_DURATION.labels(endpoint, method).observe(queries.duration)
+
+
+def observe_serializer(name, duration):
+    SERIALIZER_DURATION.labels(name).observe(duration)
+
+
+def observe_llm_result(operation, result, duration):
+    """Record a get_response()-style result dict"""
+    if result.get('coalesced'):
+        outcome = 'coalesced'
+    elif result.get('cached'):
+        outcome = 'cached'
+    elif result.get('success'):
+        outcome = 'ok'
+    else:
+        outcome = 'error'
+
+    LLM_DURATION.labels(operation, outcome).observe(duration)
+    if result.get('tokens_used'):
+        LLM_TOKENS.labels(operation).observe(result['tokens_used'])
+    if result.get('time_to_first_token') is not None and outcome == 'ok':
+        LLM_TIME_TO_FIRST_TOKEN.labels(operation).observe(result['time_to_first_token'])
+    if result.get('prompt_tokens_saved') and outcome == 'ok':
+        PROMPT_TOKENS_SAVED.labels(operation).inc(result['prompt_tokens_saved'])
+
+
+def instrument_llm(operation):
+    """
+    Decorate a CodingChatAI method returning a result dict, or a generator
+    of events ending with a 'done' event, to record its latency and tokens.
+    Works on sync and async methods alike.
+    """
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                events = func(*args, **kwargs)
+                try:
+                    async for event in events:
+                        if event.get('type') == 'done':
+                            observe_llm_result(operation, event, time.perf_counter() - start)
+                        yield event
+                finally:
+                    # pass an early close on, it stops the upstream stream
+                    await events.aclose()
+
+        elif inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                events = func(*args, **kwargs)
+                try:
+                    for event in events:
+                        if event.get('type') == 'done':
+                            observe_llm_result(operation, event, time.perf_counter() - start)
+                        yield event
+                finally:
+                    events.close()
+
+        elif inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = await func(*args, **kwargs)
+                observe_llm_result(operation, result, time.perf_counter() - start)
+                return result
+
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                observe_llm_result(operation, result, time.perf_counter() - start)
+                return result
+
+        return wrapper
+    return decorator
+
+
+def _registry():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def sample_value(name, **labels):
+    """Current value of a sample, summed over the workers like /metrics, 0 when unset"""
+    return _registry().get_sample_value(name, labels) or 0
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint"""
+    return HttpResponse(generate_latest(_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,243 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.utils.http import http_date
+import time
+
+from . import metrics
+from .services.session_activity import touch
+
+
+class QueryCounter:
+    """
+    connection.execute_wrapper() hook counting queries and their time.
+    Install it on every connection with count_queries().
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class count_queries:
+    """
+    Context manager counting the queries run on all database connections.
+    As an async context manager it installs the wrappers in the thread
+    sync_to_async runs the request's DB work in, on that thread's connections.
+    """
+
+    def __init__(self):
+        self.counter = QueryCounter()
+        self.wrappers = []
+
+    def __enter__(self):
+        for alias in connections:
+            wrapper = connections[alias].execute_wrapper(self.counter)
+            wrapper.__enter__()
+            self.wrappers.append(wrapper)
+        return self.counter
+
+    def __exit__(self, *exc_info):
+        while self.wrappers:
+            self.wrappers.pop().__exit__(*exc_info)
+
+    async def __aenter__(self):
+        return await sync_to_async(self.__enter__)()
+
+    async def __aexit__(self, *exc_info):
+        await sync_to_async(self.__exit__)(*exc_info)
+
+
+class QueryCountHeaderMiddleware:
+    """
+    Report the number and time of the database queries a request ran in
+    X-DB-Query-Count and X-DB-Query-Time-Ms. Used by the load tests in
+    benchmarks/, enabled with BENCHMARK_QUERY_HEADERS=True. Sync and async
+    capable, so it does not put the async views behind a thread.
+
+    Queries run while a streaming response is consumed happen after the
+    headers are sent and are not included.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with count_queries() as counter:
+            response = self.get_response(request)
+        return self.add_headers(response, counter)
+
+    async def __acall__(self, request):
+        async with count_queries() as counter:
+            response = await self.get_response(request)
+        return self.add_headers(response, counter)
+
+    def add_headers(self, response, counter):
+        response['X-DB-Query-Count'] = str(counter.count)
+        response['X-DB-Query-Time-Ms'] = f"{counter.duration * 1000:.2f}"
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Record wall time, DB query count and DB time of every request in the
+    Prometheus histograms of backendApp.metrics, labelled by URL name.
+    Sync and async capable, so under ASGI the async views keep running on
+    the event loop.
+
+    For streaming responses the observation is made once the last chunk has
+    been sent, so DB work done while streaming is included. A stream of the
+    other kind (an async stream under WSGI, a sync one under ASGI) is
+    observed when the response is returned.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        with count_queries() as counter:
+            response = self.get_response(request)
+
+        endpoint = self.endpoint(request)
+        if endpoint is None:
+            return response
+
+        if response.streaming and not response.is_async:
+            response.streaming_content = self.observe_stream(
+                response.streaming_content, request, endpoint, response.status_code, start, counter
+            )
+        else:
+            metrics.observe_request(
+                endpoint, request.method, response.status_code, time.perf_counter() - start, counter
+            )
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        async with count_queries() as counter:
+            response = await self.get_response(request)
+
+        endpoint = self.endpoint(request)
+        if endpoint is None:
+            return response
+
+        if response.streaming and response.is_async:
+            response.streaming_content = self.aobserve_stream(
+                response.streaming_content, request, endpoint, response.status_code, start, counter
+            )
+        else:
+            metrics.observe_request(
+                endpoint, request.method, response.status_code, time.perf_counter() - start, counter
+            )
+        return response
+
+    def endpoint(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # one label for every unresolved path keeps the label set bounded
+            return 'unmatched'
+        if match.func is metrics.metrics_view:
+            return None
+        return match.view_name or match.route
+
+    def observe_stream(self, content, request, endpoint, status, start, counter):
+        stream_queries = count_queries()
+        try:
+            with stream_queries:
+                yield from content
+        finally:
+            self.observe(request, endpoint, status, start, counter, stream_queries.counter)
+
+    async def aobserve_stream(self, content, request, endpoint, status, start, counter):
+        stream_queries = count_queries()
+        try:
+            async with stream_queries:
+                async for chunk in content:
+                    yield chunk
+        finally:
+            self.observe(request, endpoint, status, start, counter, stream_queries.counter)
+
+    def observe(self, request, endpoint, status, start, counter, stream_counter):
+        counter.count += stream_counter.count
+        counter.duration += stream_counter.duration
+        metrics.observe_request(endpoint, request.method, status, time.perf_counter() - start, counter)
+
+
+class SessionActivityMiddleware:
+    """
+    Record the activity of the request's session (services/session_activity.py)
+    and renew its cookie, which is what SESSION_SAVE_EVERY_REQUEST did,
+    without saving the session. Goes after SessionMiddleware. Sync and
+    async capable; under ASGI touch(), which may flush to the database,
+    runs through sync_to_async.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        session_key = self.session_key(request)
+        if session_key:
+            touch(session_key)
+            self.renew_cookie(request, response, session_key)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        session_key = self.session_key(request)
+        if session_key:
+            await sync_to_async(touch)(session_key)
+            self.renew_cookie(request, response, session_key)
+        return response
+
+    def session_key(self, request):
+        session = getattr(request, 'session', None)
+        return session.session_key if session is not None else None
+
+    def renew_cookie(self, request, response, session_key):
+        # SessionMiddleware sets the cookie itself when the session was saved
+        renew = (
+            request.COOKIES.get(settings.SESSION_COOKIE_NAME) == session_key
+            and settings.SESSION_COOKIE_NAME not in response.cookies
+            and not settings.SESSION_EXPIRE_AT_BROWSER_CLOSE
+        )
+        if renew:
+            response.set_cookie(
+                settings.SESSION_COOKIE_NAME, session_key,
+                max_age=settings.SESSION_COOKIE_AGE,
+                expires=http_date(time.time() + settings.SESSION_COOKIE_AGE),
+                domain=settings.SESSION_COOKIE_DOMAIN,
+                path=settings.SESSION_COOKIE_PATH,
+                secure=settings.SESSION_COOKIE_SECURE or None,
+                httponly=settings.SESSION_COOKIE_HTTPONLY or None,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
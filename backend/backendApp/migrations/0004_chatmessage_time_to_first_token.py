@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 02:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0003_chatsession_remove_reviewfeedback_review_chatmessage_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='time_to_first_token',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.16 on 2026-10-18 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0005_chatmessage_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='cached',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='response_cache_enabled',
+            field=models.BooleanField(default=True),
+        ),
+    ]
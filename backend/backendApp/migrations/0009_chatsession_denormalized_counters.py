@@ -0,0 +1,70 @@
+# Generated by Django 4.2.16 on 2026-10-18 02:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+
+def backfill_counters(apps, schema_editor):
+    ChatSession = apps.get_model('backendApp', 'ChatSession')
+    ChatMessage = apps.get_model('backendApp', 'ChatMessage')
+
+    last_message = ChatMessage.objects.filter(
+        session=OuterRef('pk')
+    ).order_by('-created_at', '-id')
+
+    sessions = ChatSession.objects.annotate(
+        num_messages=Count('messages'),
+        last_content=Subquery(last_message.values('content')[:1]),
+        last_type=Subquery(last_message.values('message_type')[:1]),
+        last_at=Subquery(last_message.values('created_at')[:1]),
+    ).only('id')
+
+    batch = []
+    for session in sessions.iterator(chunk_size=500):
+        content = session.last_content or ''
+        session.message_count = session.num_messages
+        session.last_message_preview = content[:100] + '...' if len(content) > 100 else content
+        session.last_message_type = session.last_type or ''
+        session.last_message_at = session.last_at
+        batch.append(session)
+        if len(batch) >= 500:
+            ChatSession.objects.bulk_update(batch, [
+                'message_count', 'last_message_preview', 'last_message_type', 'last_message_at'
+            ])
+            batch = []
+
+    if batch:
+        ChatSession.objects.bulk_update(batch, [
+            'message_count', 'last_message_preview', 'last_message_type', 'last_message_at'
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0008_chatmessage_session_window_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=103),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_type',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
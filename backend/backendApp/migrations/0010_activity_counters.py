@@ -0,0 +1,83 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:01
+
+from datetime import timedelta
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+GLOBAL_SCOPE = '__all__'
+
+
+def backfill_activity(apps, schema_editor):
+    ChatSession = apps.get_model('backendApp', 'ChatSession')
+    ChatMessage = apps.get_model('backendApp', 'ChatMessage')
+    ActivityCounter = apps.get_model('backendApp', 'ActivityCounter')
+    DailyActivity = apps.get_model('backendApp', 'DailyActivity')
+
+    totals = {GLOBAL_SCOPE: [0, 0]}
+    for row in ChatSession.objects.values('session_key').annotate(n=Count('id')).order_by():
+        totals.setdefault(row['session_key'], [0, 0])[0] += row['n']
+        totals[GLOBAL_SCOPE][0] += row['n']
+    for row in ChatMessage.objects.values('session__session_key').annotate(n=Count('id')).order_by():
+        totals.setdefault(row['session__session_key'], [0, 0])[1] += row['n']
+        totals[GLOBAL_SCOPE][1] += row['n']
+
+    ActivityCounter.objects.bulk_create([
+        ActivityCounter(scope=scope, session_count=sessions, message_count=messages)
+        for scope, (sessions, messages) in totals.items()
+    ], batch_size=500)
+
+    since = timezone.now().date() - timedelta(days=29)
+    daily = {}
+    for model, key, field in (
+        (ChatSession, 'session_key', 'sessions_created'),
+        (ChatMessage, 'session__session_key', 'messages_created'),
+    ):
+        rows = model.objects.filter(created_at__date__gte=since).annotate(
+            date=TruncDate('created_at')
+        ).values(key, 'date').annotate(n=Count('id')).order_by()
+        for row in rows:
+            for scope in (row[key], GLOBAL_SCOPE):
+                counts = daily.setdefault((scope, row['date']), {'sessions_created': 0, 'messages_created': 0})
+                counts[field] += row['n']
+
+    DailyActivity.objects.bulk_create([
+        DailyActivity(scope=scope, date=date, **counts)
+        for (scope, date), counts in daily.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0009_chatsession_denormalized_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=40, unique=True)),
+                ('session_count', models.BigIntegerField(default=0)),
+                ('message_count', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=40)),
+                ('date', models.DateField()),
+                ('sessions_created', models.BigIntegerField(default=0)),
+                ('messages_created', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-date'],
+                'unique_together': {('scope', 'date')},
+            },
+        ),
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:40
+
+from django.db import migrations
+
+# The DDL as it shipped, spelled out so later changes to
+# services/search_service.py leave this migration alone. 0017 moves it to
+# the current layout.
+TABLE = 'backendApp_chatmessage'
+FTS_TABLE = 'backendApp_chatmessage_fts'
+FTS_TRIGGERS = ('chatmsg_fts_insert', 'chatmsg_fts_delete', 'chatmsg_fts_update')
+
+SQLITE_INSTALL = [
+    # underscores are part of identifiers in code
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS "{FTS_TABLE}" USING fts5(
+        content, content='{TABLE}', content_rowid='rowid',
+        tokenize="porter unicode61 tokenchars '_'"
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[0]} AFTER INSERT ON "{TABLE}" BEGIN
+        INSERT INTO "{FTS_TABLE}"(rowid, content) VALUES (new.rowid, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[1]} AFTER DELETE ON "{TABLE}" BEGIN
+        INSERT INTO "{FTS_TABLE}"("{FTS_TABLE}", rowid, content) VALUES ('delete', old.rowid, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[2]} AFTER UPDATE OF content ON "{TABLE}" BEGIN
+        INSERT INTO "{FTS_TABLE}"("{FTS_TABLE}", rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO "{FTS_TABLE}"(rowid, content) VALUES (new.rowid, new.content);
+    END""",
+    f'INSERT INTO "{FTS_TABLE}"("{FTS_TABLE}") VALUES (\'rebuild\')',
+]
+SQLITE_DROP = [
+    *[f'DROP TRIGGER IF EXISTS {trigger}' for trigger in FTS_TRIGGERS],
+    f'DROP TABLE IF EXISTS "{FTS_TABLE}"',
+]
+
+POSTGRES_INSTALL = [
+    f"""ALTER TABLE "{TABLE}" ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', content)) STORED""",
+    f'CREATE INDEX IF NOT EXISTS chatmsg_search_idx ON "{TABLE}" USING gin (search_vector)',
+]
+POSTGRES_DROP = [
+    'DROP INDEX IF EXISTS chatmsg_search_idx',
+    f'ALTER TABLE "{TABLE}" DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def _run(schema_editor, statements):
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def install(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_INSTALL, 'sqlite': SQLITE_INSTALL})
+
+
+def drop(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_DROP, 'sqlite': SQLITE_DROP})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0011_chatjob'),
+    ]
+
+    operations = [
+        # Postgres tsvector column + GIN index, SQLite FTS5 table + triggers
+        migrations.RunPython(install, drop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0012_chatmessage_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='code_analysis',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
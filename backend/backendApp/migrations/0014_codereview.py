@@ -0,0 +1,56 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0013_chatmessage_code_analysis'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeReview',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('session_key', models.CharField(db_index=True, max_length=40)),
+                ('name', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('complete', 'Complete'), ('failed', 'Failed')], default='running', max_length=10)),
+                ('file_count', models.PositiveIntegerField(default=0)),
+                ('reviewed_count', models.PositiveIntegerField(default=0)),
+                ('reused_count', models.PositiveIntegerField(default=0)),
+                ('skipped_count', models.PositiveIntegerField(default=0)),
+                ('failed_count', models.PositiveIntegerField(default=0)),
+                ('chunk_count', models.PositiveIntegerField(default=0)),
+                ('tokens_used', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReviewedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('language', models.CharField(blank=True, max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('failed', 'Failed'), ('skipped', 'Skipped')], default='pending', max_length=10)),
+                ('reused', models.BooleanField(default=False)),
+                ('chunk_count', models.PositiveIntegerField(default=0)),
+                ('findings', models.JSONField(default=list)),
+                ('detail', models.TextField(blank=True)),
+                ('review', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='backendApp.codereview')),
+            ],
+            options={
+                'ordering': ['path'],
+                'indexes': [models.Index(fields=['fingerprint'], name='reviewedfile_fingerprint_idx')],
+            },
+        ),
+    ]
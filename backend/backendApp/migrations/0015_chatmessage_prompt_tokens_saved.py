@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0014_codereview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='prompt_tokens_saved',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
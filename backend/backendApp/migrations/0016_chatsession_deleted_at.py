@@ -0,0 +1,22 @@
+# Generated by Django 4.2.16 on 2026-10-18 04:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0015_chatmessage_prompt_tokens_saved'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='chatsession_deleted_idx'),
+        ),
+    ]
@@ -0,0 +1,118 @@
+# Generated by Django 4.2.16 on 2026-10-18 05:10
+
+from django.db import migrations
+
+# Spelled out rather than imported from services/search_service.py, so
+# later changes there leave this migration alone.
+TABLE = 'backendApp_chatmessage'
+FTS_TABLE = 'backendApp_chatmessage_search'
+FTS_KEYS_TABLE = 'backendApp_chatmessage_search_keys'
+FTS_TRIGGERS = ('chatmsg_search_insert', 'chatmsg_search_delete', 'chatmsg_search_update')
+POSTGRES_INDEX = 'chatmsg_search_expr_idx'
+# the layout of 0012
+OLD_FTS_TABLE = 'backendApp_chatmessage_fts'
+OLD_FTS_TRIGGERS = ('chatmsg_fts_insert', 'chatmsg_fts_delete', 'chatmsg_fts_update')
+OLD_POSTGRES_INDEX = 'chatmsg_search_idx'
+
+
+def _fts_key(message_id):
+    return f'(SELECT id FROM "{FTS_KEYS_TABLE}" WHERE message_id = {message_id})'
+
+
+SQLITE_DROP_OLD = [
+    *[f'DROP TRIGGER IF EXISTS {trigger}' for trigger in OLD_FTS_TRIGGERS],
+    f'DROP TABLE IF EXISTS "{OLD_FTS_TABLE}"',
+]
+SQLITE_INSTALL = [
+    # FTS rows keyed by an INTEGER PRIMARY KEY of their own, which VACUUM
+    # and table rebuilds leave alone, unlike the rowid of the messages
+    f"""CREATE TABLE IF NOT EXISTS "{FTS_KEYS_TABLE}" (
+        id INTEGER PRIMARY KEY, message_id char(32) NOT NULL UNIQUE
+    )""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS "{FTS_TABLE}" USING fts5(
+        content, tokenize="porter unicode61 tokenchars '_'"
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[0]} AFTER INSERT ON "{TABLE}" BEGIN
+        INSERT INTO "{FTS_KEYS_TABLE}"(message_id) VALUES (new.id);
+        INSERT INTO "{FTS_TABLE}"(rowid, content) VALUES ({_fts_key('new.id')}, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[1]} AFTER DELETE ON "{TABLE}" BEGIN
+        DELETE FROM "{FTS_TABLE}" WHERE rowid = {_fts_key('old.id')};
+        DELETE FROM "{FTS_KEYS_TABLE}" WHERE message_id = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[2]} AFTER UPDATE OF content ON "{TABLE}" BEGIN
+        UPDATE "{FTS_TABLE}" SET content = new.content WHERE rowid = {_fts_key('new.id')};
+    END""",
+    f'DELETE FROM "{FTS_TABLE}"',
+    f'DELETE FROM "{FTS_KEYS_TABLE}"',
+    f'INSERT INTO "{FTS_KEYS_TABLE}"(message_id) SELECT id FROM "{TABLE}"',
+    f"""INSERT INTO "{FTS_TABLE}"(rowid, content)
+        SELECT k.id, m.content FROM "{FTS_KEYS_TABLE}" k JOIN "{TABLE}" m ON m.id = k.message_id""",
+]
+SQLITE_DROP = [
+    *[f'DROP TRIGGER IF EXISTS {trigger}' for trigger in FTS_TRIGGERS],
+    f'DROP TABLE IF EXISTS "{FTS_TABLE}"',
+    f'DROP TABLE IF EXISTS "{FTS_KEYS_TABLE}"',
+]
+SQLITE_INSTALL_OLD = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS "{OLD_FTS_TABLE}" USING fts5(
+        content, content='{TABLE}', content_rowid='rowid',
+        tokenize="porter unicode61 tokenchars '_'"
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {OLD_FTS_TRIGGERS[0]} AFTER INSERT ON "{TABLE}" BEGIN
+        INSERT INTO "{OLD_FTS_TABLE}"(rowid, content) VALUES (new.rowid, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {OLD_FTS_TRIGGERS[1]} AFTER DELETE ON "{TABLE}" BEGIN
+        INSERT INTO "{OLD_FTS_TABLE}"("{OLD_FTS_TABLE}", rowid, content) VALUES ('delete', old.rowid, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {OLD_FTS_TRIGGERS[2]} AFTER UPDATE OF content ON "{TABLE}" BEGIN
+        INSERT INTO "{OLD_FTS_TABLE}"("{OLD_FTS_TABLE}", rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO "{OLD_FTS_TABLE}"(rowid, content) VALUES (new.rowid, new.content);
+    END""",
+    f'INSERT INTO "{OLD_FTS_TABLE}"("{OLD_FTS_TABLE}") VALUES (\'rebuild\')',
+]
+
+POSTGRES_INSTALL = [
+    # dropping the generated column is a catalog change, no table rewrite
+    f'DROP INDEX CONCURRENTLY IF EXISTS {OLD_POSTGRES_INDEX}',
+    f'ALTER TABLE "{TABLE}" DROP COLUMN IF EXISTS search_vector',
+    # left behind, possibly invalid, by an interrupted earlier attempt
+    f'DROP INDEX CONCURRENTLY IF EXISTS {POSTGRES_INDEX}',
+    f"""CREATE INDEX CONCURRENTLY {POSTGRES_INDEX} ON "{TABLE}"
+        USING gin (to_tsvector('english', content))""",
+]
+POSTGRES_DROP = [
+    f'DROP INDEX CONCURRENTLY IF EXISTS {POSTGRES_INDEX}',
+    f"""ALTER TABLE "{TABLE}" ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', content)) STORED""",
+    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {OLD_POSTGRES_INDEX} ON "{TABLE}" USING gin (search_vector)',
+]
+
+
+def _run(schema_editor, statements):
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def forwards(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_INSTALL, 'sqlite': SQLITE_DROP_OLD + SQLITE_INSTALL})
+
+
+def backwards(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRES_DROP, 'sqlite': SQLITE_DROP + SQLITE_INSTALL_OLD})
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('backendApp', '0016_chatsession_deleted_at'),
+    ]
+
+    operations = [
+        # SQLite: the FTS5 index moves off the implicit rowid to a keys table,
+        # Postgres: the generated column is replaced by an expression index
+        # built CONCURRENTLY, see services/search_service.py
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.16 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendApp', '0017_chatmessage_search_index_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='codereview',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='codereview',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='codereview_deleted_idx'),
+        ),
+    ]
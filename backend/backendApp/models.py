@@ -2,38 +2,243 @@
 from django.db import models
 import uuid
 
+
 class ChatSession(models.Model):
     """chat session with the AI assistant"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     session_key = models.CharField(max_length=40, db_index=True)
     title = models.CharField(max_length=200, blank=True)
+    # per-session opt-out of the shared AI response cache
+    response_cache_enabled = models.BooleanField(default=True)
+    # rolling summary of the turns that no longer fit the prompt's token budget,
+    # covering every message up to and including summary_until
+    summary = models.TextField(blank=True)
+    summary_until = models.DateTimeField(null=True, blank=True)
+    # denormalized from the messages so listing sessions never touches them,
+    # maintained by services/chat_service.py in the same transaction as the writes
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=103, blank=True)
+    last_message_type = models.CharField(max_length=10, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # set when the session is deleted in the background: its session_key is
+    # cleared so its owner no longer finds it, and it is purged shortly after
+    # (services/chat_service.py delete_chat_sessions)
+    deleted_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(
+                fields=['deleted_at'], name='chatsession_deleted_idx',
+                condition=models.Q(deleted_at__isnull=False)
+            ),
+        ]
     
     def __str__(self):
         return f"Chat Session: {self.title or str(self.id)[:8]}"
 
+
 class ChatMessage(models.Model):
     MESSAGE_TYPES = [
         ('user', 'User'),
         ('assistant', 'Assistant'),
     ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+    ]
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # assistant messages are created pending and filled in once the model answers
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_COMPLETE, db_index=True)
+    error = models.TextField(blank=True)
     
     
     tokens_used = models.PositiveIntegerField(null=True, blank=True)
     response_time = models.FloatField(null=True, blank=True)  # in seconds
+    time_to_first_token = models.FloatField(null=True, blank=True)  # in seconds, streamed responses only
+    cached = models.BooleanField(default=False)  # served from the response cache
+    # assistant messages: local analysis of the code blocks of the user message
+    # answered, see services/code_analysis.py
+    code_analysis = models.JSONField(null=True, blank=True)
+    # assistant messages: prompt tokens saved by sending revised code as
+    # diffs, see services/code_revisions.py
+    prompt_tokens_saved = models.PositiveIntegerField(null=True, blank=True)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # backs the bounded, newest-first context window query
+            models.Index(fields=['session', 'created_at', 'id'], name='chatmsg_session_window_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.message_type}: {self.content[:50]}..."
+    
+    @property
+    def preview(self):
+        return self.content[:100] + '...' if len(self.content) > 100 else self.content
+
+
+class ActivityCounter(models.Model):
+    """
+    Running totals of chat sessions and messages, one row for everything
+    (GLOBAL_SCOPE) and one per Django session key, so stats are O(1) reads.
+    Maintained by services/stats_service.py, reconciled by reconcile_stats.
+    """
+    GLOBAL_SCOPE = '__all__'
+    
+    scope = models.CharField(max_length=40, unique=True)
+    session_count = models.BigIntegerField(default=0)
+    message_count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.scope}: {self.session_count} sessions, {self.message_count} messages"
+
+
+class DailyActivity(models.Model):
+    """Sessions and messages created per day, globally and per Django session key"""
+    scope = models.CharField(max_length=40)
+    date = models.DateField()
+    sessions_created = models.BigIntegerField(default=0)
+    messages_created = models.BigIntegerField(default=0)
+    
+    class Meta:
+        unique_together = [('scope', 'date')]
+        ordering = ['-date']
+    
+    def __str__(self):
+        return f"{self.scope} {self.date}: {self.sessions_created} sessions, {self.messages_created} messages"
+
+
+class ChatJob(models.Model):
+    """
+    A queued AI reply (?async=1 requests). Claimed by run_chat_worker
+    processes, see services/job_queue.py. A running job whose lease
+    (locked_until) ran out is claimed again by another worker.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user_message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name='+')
+    assistant_message = models.OneToOneField(ChatMessage, on_delete=models.CASCADE, related_name='job')
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    # not claimed before, pushed back on retries
+    available_at = models.DateTimeField()
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['available_at']
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='chatjob_claim_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Job {self.id} ({self.status}, attempt {self.attempts})"
+
+
+class CodeReview(models.Model):
+    """
+    Review of an uploaded code archive or set of files (POST /api/reviews/),
+    see services/code_review.py. The findings are kept per file.
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    session_key = models.CharField(max_length=40, db_index=True)
+    name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_RUNNING)
+    file_count = models.PositiveIntegerField(default=0)
+    # reused: unchanged since an earlier review, its findings copied over
+    reviewed_count = models.PositiveIntegerField(default=0)
+    reused_count = models.PositiveIntegerField(default=0)
+    skipped_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    chunk_count = models.PositiveIntegerField(default=0)
+    tokens_used = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    # set when the review is deleted in the background, it is no longer
+    # listed and is purged shortly after (services/chat_service.py
+    # delete_chat_sessions)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['deleted_at'], name='codereview_deleted_idx',
+                condition=models.Q(deleted_at__isnull=False)
+            ),
+        ]
+    
+    def __str__(self):
+        return f"Review {self.name} ({self.status})"
+
+
+class ReviewedFile(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUS_SKIPPED = 'skipped'
+    STATUSES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_SKIPPED, 'Skipped'),
+    ]
+    
+    review = models.ForeignKey(CodeReview, on_delete=models.CASCADE, related_name='files')
+    path = models.CharField(max_length=500)
+    # sha256 of the content, a file seen before is not reviewed again
+    fingerprint = models.CharField(max_length=64)
+    size = models.PositiveIntegerField(default=0)
+    language = models.CharField(max_length=20, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_PENDING)
+    reused = models.BooleanField(default=False)
+    chunk_count = models.PositiveIntegerField(default=0)
+    findings = models.JSONField(default=list)
+    # why the file was skipped or failed
+    detail = models.TextField(blank=True)
+    
+    class Meta:
+        ordering = ['path']
+        indexes = [
+            models.Index(fields=['fingerprint'], name='reviewedfile_fingerprint_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.message_type}: {self.content[:50]}..."
\ No newline at end of file
+        return f"{self.path} ({self.status})"
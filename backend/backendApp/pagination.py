@@ -0,0 +1,100 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+import uuid
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination over chat messages on (created_at, id).
+
+    Without a cursor the newest page is returned. ``?before=<cursor>`` walks
+    back through older messages and ``?after=<cursor>`` fetches newer ones,
+    e.g. to poll for new messages. Every page is ordered oldest first and
+    costs one indexed range query no matter how deep it is.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'limit'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_limit(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if before and after:
+            raise ValidationError({'detail': 'Use either before or after, not both.'})
+
+        if after:
+            created_at, pk = after
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            ).order_by('created_at', 'id')
+            page = list(queryset[:limit])
+            self.has_older = True
+        else:
+            if before:
+                created_at, pk = before
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                )
+            page = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+            self.has_older = len(page) > limit
+            page = list(reversed(page[:limit]))
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'previous': self.get_previous_link(),
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_previous_link(self):
+        """Link to the page of older messages"""
+        if not self.page or not self.has_older:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[0]))
+
+    def get_next_link(self):
+        """
+        Link to the page of newer messages. Always given when the page is not
+        empty, so clients can poll it for messages that arrive later.
+        """
+        if not self.page:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(limit, self.max_page_size))
+
+    def encode_cursor(self, message):
+        raw = f"{message.created_at.isoformat()}|{message.id}"
+        return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            created_at, pk = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+            created_at = parse_datetime(created_at)
+            if created_at is None:
+                raise ValueError(cursor)
+            return created_at, uuid.UUID(pk)
+        except (ValueError, UnicodeError):
+            raise ValidationError({'detail': 'Invalid cursor.'})
@@ -1,44 +1,78 @@
 
+from django.conf import settings
 from rest_framework import serializers
-from .models import ChatSession, ChatMessage
+import time
 
-class ChatMessageSerializer(serializers.ModelSerializer):
+from .metrics import observe_serializer
+from .models import ChatSession, ChatMessage, CodeReview, ReviewedFile
+
+
+class InstrumentedListSerializer(serializers.ListSerializer):
+    """Times .data of many=True serializers, labelled after the child"""
+    
+    @property
+    def data(self):
+        start = time.perf_counter()
+        try:
+            return super().data
+        finally:
+            observe_serializer(f"{type(self.child).__name__}[]", time.perf_counter() - start)
+
+class InstrumentedSerializerMixin:
+    """Records how long building .data takes in chat_serializer_duration_seconds"""
+    
+    @property
+    def data(self):
+        start = time.perf_counter()
+        try:
+            return super().data
+        finally:
+            observe_serializer(type(self).__name__, time.perf_counter() - start)
+
+class ChatMessageSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = ChatMessage
-        fields = ['id', 'message_type', 'content', 'created_at', 'tokens_used', 'response_time']
-        read_only_fields = ['id', 'created_at', 'tokens_used', 'response_time']
+        list_serializer_class = InstrumentedListSerializer
+        fields = ['id', 'message_type', 'content', 'status', 'created_at', 'tokens_used', 'response_time', 'time_to_first_token', 'cached', 'code_analysis', 'prompt_tokens_saved']
+        read_only_fields = ['id', 'status', 'created_at', 'tokens_used', 'response_time', 'time_to_first_token', 'cached', 'code_analysis', 'prompt_tokens_saved']
 
-class ChatSessionSerializer(serializers.ModelSerializer):
-    messages = ChatMessageSerializer(many=True, read_only=True)
-    message_count = serializers.SerializerMethodField()
+class ChatSessionSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    """Session metadata, messages are served by /api/sessions/{id}/messages/"""
     
     class Meta:
         model = ChatSession
-        fields = ['id', 'title', 'created_at', 'updated_at', 'messages', 'message_count']
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        fields = ['id', 'title', 'response_cache_enabled', 'created_at', 'updated_at', 'message_count']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'message_count']
+    
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        # only write the edited columns, the counters are maintained concurrently
+        instance.save(update_fields=list(validated_data) + ['updated_at'])
+        return instance
+
+class ChatSessionDetailSerializer(ChatSessionSerializer):
+    """Legacy payload embedding the whole conversation (?include_messages=1)"""
+    messages = ChatMessageSerializer(many=True, read_only=True)
     
-    def get_message_count(self, obj):
-        return obj.messages.count()
+    class Meta(ChatSessionSerializer.Meta):
+        fields = ChatSessionSerializer.Meta.fields + ['messages']
 
-class ChatSessionListSerializer(serializers.ModelSerializer):
-    """Simplified serializer for listing sessions"""
-    message_count = serializers.SerializerMethodField()
+class ChatSessionListSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    """Simplified serializer for listing sessions, reads only the session row"""
     last_message = serializers.SerializerMethodField()
     
     class Meta:
         model = ChatSession
+        list_serializer_class = InstrumentedListSerializer
         fields = ['id', 'title', 'created_at', 'updated_at', 'message_count', 'last_message']
     
-    def get_message_count(self, obj):
-        return obj.messages.count()
-    
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
-        if last_msg:
+        if obj.last_message_at:
             return {
-                'content': last_msg.content[:100] + '...' if len(last_msg.content) > 100 else last_msg.content,
-                'message_type': last_msg.message_type,
-                'created_at': last_msg.created_at
+                'content': obj.last_message_preview,
+                'message_type': obj.last_message_type,
+                'created_at': obj.last_message_at
             }
         return None
 
@@ -50,4 +84,69 @@ class SendMessageSerializer(serializers.Serializer):
     def validate_message(self, value):
         if not value.strip():
             raise serializers.ValidationError("Message cannot be empty")
-        return value.strip()
\ No newline at end of file
+        return value.strip()
+
+class BatchChatSerializer(serializers.Serializer):
+    """Messages for POST /api/chat/batch/, each one validated like a single message"""
+    items = SendMessageSerializer(many=True, allow_empty=False, max_length=settings.CHAT_BATCH_MAX_ITEMS)
+    concurrency = serializers.IntegerField(
+        required=False, min_value=1, max_value=settings.CHAT_BATCH_CONCURRENCY
+    )
+
+class SearchQuerySerializer(serializers.Serializer):
+    """Query parameters of GET /api/search/"""
+    q = serializers.CharField(max_length=200)
+    limit = serializers.IntegerField(
+        required=False, default=20, min_value=1, max_value=settings.CHAT_SEARCH_MAX_RESULTS
+    )
+
+class ReviewUploadSerializer(serializers.Serializer):
+    """
+    POST /api/reviews/: a zip or tar "archive", or "files" with their
+    relative "paths" in the same order (the file names otherwise)
+    """
+    archive = serializers.FileField(required=False)
+    files = serializers.ListField(child=serializers.FileField(), required=False, allow_empty=False)
+    paths = serializers.ListField(child=serializers.CharField(max_length=500), required=False)
+    concurrency = serializers.IntegerField(
+        required=False, min_value=1, max_value=settings.CHAT_REVIEW_CONCURRENCY
+    )
+    
+    def validate(self, data):
+        if ('archive' in data) == ('files' in data):
+            raise serializers.ValidationError("Upload either an archive or files")
+        if 'paths' in data and len(data['paths']) != len(data.get('files', [])):
+            raise serializers.ValidationError("Give one path per file")
+        return data
+
+class ReviewedFileSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ReviewedFile
+        list_serializer_class = InstrumentedListSerializer
+        fields = ['path', 'language', 'fingerprint', 'size', 'status', 'reused', 'chunk_count', 'findings', 'detail']
+
+class CodeReviewSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    """Review totals, the files are in CodeReviewDetailSerializer"""
+    
+    class Meta:
+        model = CodeReview
+        list_serializer_class = InstrumentedListSerializer
+        fields = [
+            'id', 'name', 'status', 'file_count', 'reviewed_count', 'reused_count', 'skipped_count',
+            'failed_count', 'chunk_count', 'tokens_used', 'created_at', 'completed_at'
+        ]
+
+class CodeReviewDetailSerializer(CodeReviewSerializer):
+    """The merged report: totals, findings per severity and every file's findings"""
+    findings_by_severity = serializers.SerializerMethodField()
+    files = ReviewedFileSerializer(many=True, read_only=True)
+    
+    class Meta(CodeReviewSerializer.Meta):
+        fields = CodeReviewSerializer.Meta.fields + ['findings_by_severity', 'files']
+    
+    def get_findings_by_severity(self, obj):
+        counts = {'error': 0, 'warning': 0, 'info': 0}
+        for reviewed_file in obj.files.all():
+            for finding in reviewed_file.findings:
+                counts[finding['severity']] += 1
+        return counts
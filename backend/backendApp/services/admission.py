@@ -0,0 +1,448 @@
+"""
+Admission control in front of the chat endpoints.
+
+Checked before an exchange is stored, in this order:
+
+- Per-session token buckets, keyed by the Django session key: one for
+  requests (CHAT_RATE_LIMIT_REQUESTS per minute, bursts of up to
+  CHAT_RATE_LIMIT_BURST) and one for LLM tokens (CHAT_RATE_LIMIT_TOKENS per
+  minute). Tokens are charged once the completion reports its usage, so a
+  session that ran into debt is refused until it has paid it back.
+- A global cap of CHAT_UPSTREAM_CONCURRENCY generations in flight, shared
+  by the workers of a host through flocks on slot files. Requests that find
+  every slot taken wait in a short FIFO queue, at most
+  CHAT_ADMISSION_QUEUE_SIZE per process and CHAT_ADMISSION_QUEUE_PER_SESSION
+  per session, for at most CHAT_ADMISSION_QUEUE_TIMEOUT seconds.
+
+A refusal raises AdmissionRejected, which the views answer with 429 and
+Retry-After. The state lives in CHAT_ADMISSION_STATE_DIR and is shared by
+the processes that see the same directory: the workers of a host, or
+containers mounting it from one volume (docker-compose.yml mounts it into
+backend and worker). Hosts that do not share it each get their own
+CHAT_UPSTREAM_CONCURRENCY. Without fcntl (Windows) buckets and slots are
+per process.
+"""
+from asgiref.sync import sync_to_async
+from collections import deque
+from django.conf import settings
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ..metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS, ADMISSION_WAIT, UPSTREAM_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.02
+# suggested to clients turned away because the queue is full
+BUSY_RETRY_AFTER = 5
+# an untouched bucket refills completely long before this, so it can go
+BUCKET_MAX_AGE = 3600
+PRUNE_INTERVAL = 60
+
+
+class AdmissionRejected(Exception):
+    """A chat request refused by admission control, retry_after is in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Too many requests ({reason})")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def _reject(reason, retry_after):
+    ADMISSION_REJECTIONS.labels(reason).inc()
+    return AdmissionRejected(reason, retry_after)
+
+
+class SessionBuckets:
+    """Request and token buckets per session key, shared by the workers of a host"""
+
+    def __init__(self, state_dir=None):
+        self.state_dir = state_dir or settings.CHAT_ADMISSION_STATE_DIR
+        self._lock = threading.Lock()
+        self._local = {}
+        self._last_prune = 0
+
+    def admit(self, session_key, requests=1):
+        """
+        Take requests from the session's request bucket or raise
+        AdmissionRejected. More requests than a full burst are refused with
+        over_burst, the bucket never holds that many.
+        """
+        request_rate = settings.CHAT_RATE_LIMIT_REQUESTS / 60.0
+        token_rate = settings.CHAT_RATE_LIMIT_TOKENS / 60.0
+        if request_rate and requests > settings.CHAT_RATE_LIMIT_BURST:
+            # no wait helps, Retry-After is the time a full burst takes to refill
+            raise _reject('over_burst', settings.CHAT_RATE_LIMIT_BURST / request_rate)
+
+        def take(state):
+            if request_rate and state['requests'] < requests:
+                return 'rate_limited', (requests - state['requests']) / request_rate
+            if token_rate and state['tokens'] < 0:
+                return 'token_budget', -state['tokens'] / token_rate
+            state['requests'] -= requests
+            return None
+
+        refused = self._update(session_key, take)
+        if refused:
+            raise _reject(*refused)
+
+    def refund(self, session_key, requests=1):
+        """Give back requests taken by admit(), for a request refused later on"""
+        self._update(session_key, lambda state: state.update(
+            requests=min(settings.CHAT_RATE_LIMIT_BURST, state['requests'] + requests)
+        ))
+
+    def charge(self, session_key, tokens):
+        """Charge the tokens a completion used, the bucket may go into debt"""
+        if tokens:
+            self._update(session_key, lambda state: state.update(tokens=state['tokens'] - tokens))
+
+    def _full(self, now):
+        return {'requests': settings.CHAT_RATE_LIMIT_BURST, 'tokens': settings.CHAT_RATE_LIMIT_TOKENS, 'at': now}
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['at'])
+        state['requests'] = min(
+            settings.CHAT_RATE_LIMIT_BURST,
+            state['requests'] + elapsed * settings.CHAT_RATE_LIMIT_REQUESTS / 60.0
+        )
+        state['tokens'] = min(
+            settings.CHAT_RATE_LIMIT_TOKENS,
+            state['tokens'] + elapsed * settings.CHAT_RATE_LIMIT_TOKENS / 60.0
+        )
+        state['at'] = now
+
+    def _update(self, session_key, func):
+        """Refill the session's buckets, apply func to them and return its result"""
+        now = time.time()
+        if fcntl is None:
+            with self._lock:
+                state = self._local.setdefault(session_key, self._full(now))
+                self._refill(state, now)
+                return func(state)
+
+        name = hashlib.sha256(session_key.encode('utf-8')).hexdigest()[:32]
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(os.path.join(self.state_dir, f"bucket-{name}.json"), 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = self._full(now)
+                self._refill(state, now)
+                result = func(state)
+                f.truncate(0)
+                json.dump(state, f)
+        except OSError as e:
+            # fail open, a broken state dir must not take the chat down
+            logger.warning(f"Rate limit state unavailable: {str(e)}")
+            return None
+
+        self._prune(now)
+        return result
+
+    def _prune(self, now):
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        try:
+            with os.scandir(self.state_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith('bucket-') and now - entry.stat().st_mtime > BUCKET_MAX_AGE:
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+
+class Slot:
+    """One of the UpstreamSlots, held until released"""
+
+    def __init__(self, slots, lock_file=None):
+        self.slots = slots
+        self.lock_file = lock_file
+        self.released = False
+        UPSTREAM_IN_FLIGHT.inc()
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        UPSTREAM_IN_FLIGHT.dec()
+        if self.lock_file is not None:
+            # closing the file drops its flock
+            self.lock_file.close()
+        else:
+            with self.slots._lock:
+                self.slots._held -= 1
+
+
+class _Ticket:
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+
+class UpstreamSlots:
+    """
+    Counting semaphore of size slots across the processes of a host: slot i
+    is held by whoever holds the flock on <state_dir>/slot-<i>.lock, so a
+    crashed worker's slots are freed with its files. Waiters of a process
+    queue up in FIFO order and only the head of the queue polls for a slot.
+    """
+
+    def __init__(self, size=None, state_dir=None):
+        self.size = size or settings.CHAT_UPSTREAM_CONCURRENCY
+        self.state_dir = state_dir or settings.CHAT_ADMISSION_STATE_DIR
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._held = 0
+
+    def try_acquire(self):
+        """A free Slot, or None"""
+        if fcntl is None:
+            with self._lock:
+                if self._held >= self.size:
+                    return None
+                self._held += 1
+            return Slot(self)
+
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            start = random.randrange(self.size)
+            for i in range(self.size):
+                lock_file = open(os.path.join(self.state_dir, f"slot-{(start + i) % self.size}.lock"), 'a')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+                return Slot(self, lock_file)
+        except OSError as e:
+            logger.warning(f"Upstream slots unavailable, not limiting: {str(e)}")
+            with self._lock:
+                self._held += 1
+            return Slot(self)
+        return None
+
+    def acquire(self, session_key=None, timeout=None, bounded=True):
+        """
+        Take a slot, waiting in the queue for up to timeout seconds
+        (CHAT_ADMISSION_QUEUE_TIMEOUT). bounded=False skips the queue
+        length limits, for background workers. Raises AdmissionRejected.
+        """
+        start = time.monotonic()
+        slot = self._fast_path()
+        if slot is not None:
+            return slot
+
+        ticket = self._enqueue(session_key, bounded)
+        deadline = start + (timeout if timeout is not None else settings.CHAT_ADMISSION_QUEUE_TIMEOUT)
+        try:
+            while True:
+                slot = self._poll(ticket, start)
+                if slot is not None:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise _reject('queue_timeout', BUSY_RETRY_AFTER)
+                time.sleep(min(POLL_INTERVAL, remaining))
+        finally:
+            self._dequeue(ticket)
+
+    async def aacquire(self, session_key=None, timeout=None, bounded=True):
+        """Async variant of acquire(), waits without holding a thread"""
+        start = time.monotonic()
+        slot = self._fast_path()
+        if slot is not None:
+            return slot
+
+        ticket = self._enqueue(session_key, bounded)
+        deadline = start + (timeout if timeout is not None else settings.CHAT_ADMISSION_QUEUE_TIMEOUT)
+        try:
+            while True:
+                slot = self._poll(ticket, start)
+                if slot is not None:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise _reject('queue_timeout', BUSY_RETRY_AFTER)
+                await asyncio.sleep(min(POLL_INTERVAL, remaining))
+        finally:
+            self._dequeue(ticket)
+
+    def _fast_path(self):
+        # nobody waiting in this process, so nobody to overtake
+        if self._queue:
+            return None
+        slot = self.try_acquire()
+        if slot is not None:
+            ADMISSION_WAIT.observe(0)
+        return slot
+
+    def _poll(self, ticket, start):
+        if self._queue[0] is not ticket:
+            return None
+        slot = self.try_acquire()
+        if slot is not None:
+            ADMISSION_WAIT.observe(time.monotonic() - start)
+        return slot
+
+    def _enqueue(self, session_key, bounded):
+        with self._lock:
+            if bounded:
+                if len(self._queue) >= settings.CHAT_ADMISSION_QUEUE_SIZE:
+                    raise _reject('queue_full', BUSY_RETRY_AFTER)
+                waiting = sum(1 for ticket in self._queue if ticket.session_key == session_key)
+                if session_key and waiting >= settings.CHAT_ADMISSION_QUEUE_PER_SESSION:
+                    # one session may not crowd everybody else out of the queue
+                    raise _reject('session_queue_full', BUSY_RETRY_AFTER)
+            ticket = _Ticket(session_key)
+            self._queue.append(ticket)
+        ADMISSION_QUEUE_DEPTH.inc()
+        return ticket
+
+    def _dequeue(self, ticket):
+        with self._lock:
+            self._queue.remove(ticket)
+        ADMISSION_QUEUE_DEPTH.dec()
+
+
+class Permit:
+    """
+    An admitted chat request: the upstream slots it holds until release()
+    and the session its tokens are charged to. Without admission control
+    (limited=False) it holds nothing and limits nothing.
+    """
+
+    def __init__(self, session_key, slots=None, limited=True):
+        self.session_key = session_key
+        self.slots = slots or []
+        self.limited = limited
+
+    def lanes(self, wanted):
+        """How many completions the holder may run at once"""
+        return min(wanted, len(self.slots)) if self.limited else wanted
+
+    def charge(self, tokens):
+        if self.limited and tokens:
+            get_session_buckets().charge(self.session_key, tokens)
+
+    async def acharge(self, tokens):
+        """charge() off the event loop, the bucket file is flocked"""
+        if self.limited and tokens:
+            await sync_to_async(get_session_buckets().charge, thread_sensitive=False)(self.session_key, tokens)
+
+    def handover(self):
+        """A Permit taking over the slots, e.g. for a streamed response, this one is emptied"""
+        permit = Permit(self.session_key, self.slots, self.limited)
+        self.slots = []
+        return permit
+
+    def release(self):
+        slots, self.slots = self.slots, []
+        for slot in slots:
+            slot.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _extra_slots(permit, extra):
+    slots = get_upstream_slots()
+    for _ in range(extra):
+        slot = slots.try_acquire()
+        if slot is None:
+            break
+        permit.slots.append(slot)
+
+
+def admit(session_key, requests=1, slots=1, extra_slots=0):
+    """
+    Admit requests messages of session_key: check its buckets, then take an
+    upstream slot, waiting in the queue if needed (no slot with slots=0,
+    e.g. for queued replies, whose worker takes one). Up to extra_slots
+    more are taken if free right away, for a batch to fan out. A request
+    refused by the queue gets its requests back. Returns a Permit, raises
+    AdmissionRejected.
+    """
+    if not settings.CHAT_ADMISSION_ENABLED:
+        return Permit(session_key, limited=False)
+
+    buckets = get_session_buckets()
+    buckets.admit(session_key, requests)
+    permit = Permit(session_key)
+    if slots:
+        try:
+            permit.slots.append(get_upstream_slots().acquire(session_key))
+        except AdmissionRejected:
+            buckets.refund(session_key, requests)
+            raise
+        _extra_slots(permit, extra_slots)
+    return permit
+
+
+async def aadmit(session_key, requests=1, slots=1, extra_slots=0):
+    """
+    Async variant of admit(). The bucket and slot files are flocked, that
+    runs on a thread so the event loop is never blocked on another worker.
+    """
+    if not settings.CHAT_ADMISSION_ENABLED:
+        return Permit(session_key, limited=False)
+
+    buckets = get_session_buckets()
+    await sync_to_async(buckets.admit, thread_sensitive=False)(session_key, requests)
+    permit = Permit(session_key)
+    if slots:
+        try:
+            permit.slots.append(await get_upstream_slots().aacquire(session_key))
+        except AdmissionRejected:
+            await sync_to_async(buckets.refund, thread_sensitive=False)(session_key, requests)
+            raise
+        await sync_to_async(_extra_slots, thread_sensitive=False)(permit, extra_slots)
+    return permit
+
+
+def admit_job(session_key, timeout):
+    """
+    Upstream slot for a background job, waiting up to timeout seconds
+    without queue limits. The session's buckets were checked when the job
+    was queued. Raises AdmissionRejected.
+    """
+    if not settings.CHAT_ADMISSION_ENABLED:
+        return Permit(session_key, limited=False)
+    return Permit(session_key, [get_upstream_slots().acquire(timeout=timeout, bounded=False)])
+
+
+_buckets = None
+_slots = None
+
+
+def get_session_buckets():
+    global _buckets
+    if _buckets is None:
+        _buckets = SessionBuckets()
+    return _buckets
+
+
+def get_upstream_slots():
+    global _slots
+    if _slots is None:
+        _slots = UpstreamSlots()
+    return _slots
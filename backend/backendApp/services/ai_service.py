@@ -1,62 +1,499 @@
 
-import openai
 from django.conf import settings
 import time
 import logging
 
+from ..metrics import instrument_llm
+from .code_analysis import aanalyze_message, analyze_message, hints_message
+from .code_revisions import compact_revisions
+from .context_builder import pack_history
+from .openai_client import get_async_client, get_client
+from .resilience import get_resilient_caller, is_transient, record_failure
+from .response_cache import get_response_cache, prompt_hash
+from .single_flight import get_single_flight
+
 logger = logging.getLogger(__name__)
 
+FAILURE_RESPONSES = {
+    'circuit_open': "My AI service is having problems right now, so I'm giving it a short break. Please try again in a minute.",
+    'timeout': "My AI service took too long to answer. Please try again in a moment.",
+    'rate_limited': "My AI service is busy right now. Please try again in a moment.",
+    'upstream_error': "I'm sorry, I'm having trouble connecting to my AI service right now. Please try again in a moment.",
+    'unexpected': "I encountered an unexpected error. Please try again.",
+}
+
+
 class CodingChatAI:
-    def __init__(self):
-        openai.api_key = settings.OPENAI_API_KEY
+    MODEL = "gpt-4o-mini"
+    COMPLETION_PARAMS = {
+        'temperature': 0.3,
+        'max_tokens': 2000,
+        'presence_penalty': 0.1,
+        'frequency_penalty': 0.1,
+    }
+    # chunk reviews of uploaded code (review_chunk): deterministic, JSON out
+    REVIEW_PARAMS = {
+        'temperature': 0,
+        'max_tokens': 1500,
+        'response_format': {'type': 'json_object'},
+    }
+
+    def __init__(self, response_cache=None):
+        # cheap: the OpenAI clients and the resilience state are per process,
+        # see openai_client.get_client() and resilience.get_resilient_caller()
+        self.resilience = get_resilient_caller()
+        # any object with ResponseCache's interface can be plugged in
+        self.response_cache = response_cache if response_cache is not None else get_response_cache()
         
-    def get_response(self, user_message, conversation_history=None):
+    @instrument_llm('chat')
+    def get_response(self, user_message, conversation_history=None, use_cache=True, summary=None):
         """
-        Get AI response for coding-related questions
+        Get AI response for coding-related questions. The code blocks of
+        user_message are analysed first (see services/code_analysis.py), the
+        result carries the analyses as code_analysis. Revised code goes to
+        the model as diffs, the tokens saved are prompt_tokens_saved.
         """
+        analysis = analyze_message(user_message)
+        prompt_message, history, tokens_saved = self._revised_prompt(user_message, conversation_history)
+        result = self._get_response(prompt_message, history, use_cache, summary, analysis)
+        return self._with_extras(result, analysis, tokens_saved)
+    
+    def _get_response(self, user_message, conversation_history, use_cache, summary, analysis):
         try:
             start_time = time.time()
+            deadline = self.resilience.new_deadline()
             
+            messages = self._prepare_messages(user_message, conversation_history, summary, analysis)
             
-            messages = self._prepare_messages(user_message, conversation_history)
+            cache_key = self._cache_key(messages) if use_cache else None
+            if cache_key:
+                cached = self.response_cache.get(cache_key)
+                if cached:
+                    return self._cached_result(cached, start_time)
             
+            # sharing an in-flight answer is a reuse too, so it follows use_cache
+            single_flight = get_single_flight() if use_cache else None
+            if single_flight is None:
+                return self._complete(messages, cache_key, start_time, deadline)
             
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",  
-                messages=messages,
-                temperature=0.3,
-                max_tokens=2000,
-                presence_penalty=0.1,
-                frequency_penalty=0.1
+            result, shared = single_flight.do(
+                prompt_hash(messages, self.MODEL, self.COMPLETION_PARAMS),
+                lambda: self._complete(messages, cache_key, start_time, deadline)
             )
+            return self._shared_result(result, start_time) if shared else result
             
-            response_time = time.time() - start_time
-            ai_response = response.choices[0].message.content
-            tokens_used = response.usage.total_tokens if response.usage else None
-            
-            return {
-                'response': ai_response,
+        except Exception as e:
+            return self._failure_result(e)
+    
+    @instrument_llm('chat_stream')
+    def stream_response(self, user_message, conversation_history=None, use_cache=True, summary=None):
+        """
+        Stream AI response for coding-related questions.
+
+        Yields {'type': 'delta', 'content': ...} for every content chunk and
+        finishes with a {'type': 'done', ...} event carrying the same keys as
+        get_response() plus time_to_first_token.
+        """
+        analysis = analyze_message(user_message)
+        prompt_message, history, tokens_saved = self._revised_prompt(user_message, conversation_history)
+        events = self._stream_response(prompt_message, history, use_cache, summary, analysis)
+        try:
+            for event in events:
+                yield self._with_extras(event, analysis, tokens_saved) if event['type'] == 'done' else event
+        finally:
+            events.close()
+
+    def _stream_response(self, user_message, conversation_history, use_cache, summary, analysis):
+        start_time = time.time()
+        time_to_first_token = None
+        parts = []
+        tokens_used = None
+        stream = None
+
+        try:
+            messages = self._prepare_messages(user_message, conversation_history, summary, analysis)
+
+            cache_key = self._cache_key(messages) if use_cache else None
+            if cache_key:
+                cached = self.response_cache.get(cache_key)
+                if cached:
+                    result = self._cached_result(cached, start_time)
+                    yield {'type': 'delta', 'content': result['response']}
+                    yield {'type': 'done', 'time_to_first_token': result['response_time'], **result}
+                    return
+
+            # retried until the stream is open, once tokens flow a failure ends the reply
+            stream = self.resilience.call(lambda timeout: get_client().chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+                timeout=timeout,
+                **self.COMPLETION_PARAMS
+            ))
+
+            for chunk in stream:
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    parts.append(delta)
+                    yield {'type': 'delta', 'content': delta}
+
+            result = {
+                'response': ''.join(parts),
                 'tokens_used': tokens_used,
-                'response_time': response_time,
+                'response_time': time.time() - start_time,
+                'time_to_first_token': time_to_first_token,
                 'success': True
             }
+            if cache_key:
+                self.response_cache.set(cache_key, result)
+            yield {'type': 'done', **result}
+
+        except Exception as e:
+            yield {
+                'type': 'done',
+                **self._failure_result(e, partial=''.join(parts)),
+                'tokens_used': tokens_used,
+                'response_time': time.time() - start_time,
+                'time_to_first_token': time_to_first_token
+            }
+        finally:
+            # closing the stream drops the upstream connection, so an abandoned
+            # client stops the generation instead of paying for the rest of it
+            if stream is not None:
+                stream.close()
+
+    @instrument_llm('chat')
+    async def aget_response(self, user_message, conversation_history=None, use_cache=True, summary=None):
+        """
+        Async variant of get_response() using the non-blocking OpenAI client.
+        conversation_history must already be evaluated (e.g. a list).
+        """
+        analysis = await aanalyze_message(user_message)
+        prompt_message, history, tokens_saved = self._revised_prompt(user_message, conversation_history)
+        result = await self._aget_response(prompt_message, history, use_cache, summary, analysis)
+        return self._with_extras(result, analysis, tokens_saved)
+
+    async def _aget_response(self, user_message, conversation_history, use_cache, summary, analysis):
+        try:
+            start_time = time.time()
+            deadline = self.resilience.new_deadline()
+
+            messages = self._prepare_messages(user_message, conversation_history, summary, analysis)
+
+            cache_key = self._cache_key(messages) if use_cache else None
+            if cache_key:
+                cached = await self.response_cache.aget(cache_key)
+                if cached:
+                    return self._cached_result(cached, start_time)
+
+            single_flight = get_single_flight() if use_cache else None
+            if single_flight is None:
+                return await self._acomplete(messages, cache_key, start_time, deadline)
+
+            result, shared = await single_flight.ado(
+                prompt_hash(messages, self.MODEL, self.COMPLETION_PARAMS),
+                lambda: self._acomplete(messages, cache_key, start_time, deadline)
+            )
+            return self._shared_result(result, start_time) if shared else result
+
+        except Exception as e:
+            return self._failure_result(e)
+
+    @instrument_llm('chat_stream')
+    async def astream_response(self, user_message, conversation_history=None, use_cache=True, summary=None):
+        """Async variant of stream_response(), yielding the same events"""
+        analysis = await aanalyze_message(user_message)
+        prompt_message, history, tokens_saved = self._revised_prompt(user_message, conversation_history)
+        events = self._astream_response(prompt_message, history, use_cache, summary, analysis)
+        try:
+            async for event in events:
+                yield self._with_extras(event, analysis, tokens_saved) if event['type'] == 'done' else event
+        finally:
+            await events.aclose()
+
+    async def _astream_response(self, user_message, conversation_history, use_cache, summary, analysis):
+        start_time = time.time()
+        time_to_first_token = None
+        parts = []
+        tokens_used = None
+        stream = None
+
+        try:
+            messages = self._prepare_messages(user_message, conversation_history, summary, analysis)
+
+            cache_key = self._cache_key(messages) if use_cache else None
+            if cache_key:
+                cached = await self.response_cache.aget(cache_key)
+                if cached:
+                    result = self._cached_result(cached, start_time)
+                    yield {'type': 'delta', 'content': result['response']}
+                    yield {'type': 'done', 'time_to_first_token': result['response_time'], **result}
+                    return
+
+            stream = await self.resilience.acall(lambda timeout: get_async_client().chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+                timeout=timeout,
+                **self.COMPLETION_PARAMS
+            ))
+
+            async for chunk in stream:
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    parts.append(delta)
+                    yield {'type': 'delta', 'content': delta}
+
+            result = {
+                'response': ''.join(parts),
+                'tokens_used': tokens_used,
+                'response_time': time.time() - start_time,
+                'time_to_first_token': time_to_first_token,
+                'success': True
+            }
+            if cache_key:
+                await self.response_cache.aset(cache_key, result)
+            yield {'type': 'done', **result}
+
+        except Exception as e:
+            yield {
+                'type': 'done',
+                **self._failure_result(e, partial=''.join(parts)),
+                'tokens_used': tokens_used,
+                'response_time': time.time() - start_time,
+                'time_to_first_token': time_to_first_token
+            }
+        finally:
+            if stream is not None:
+                await stream.close()
+
+    @instrument_llm('review')
+    def review_chunk(self, path, language, code, first_line, known_findings=None, use_cache=True):
+        """
+        Review lines first_line.. of an uploaded file (services/code_review.py).
+        The model answers with a JSON object {"findings": [...]}, returned
+        as the result's response for the caller to parse. known_findings are
+        lines already reported by the local analysis, left out by the model.
+        """
+        try:
+            start_time = time.time()
+            deadline = self.resilience.new_deadline()
+            messages = self._review_messages(path, language, code, first_line, known_findings)
             
-        except openai.APIError as e:
-            logger.error(f"OpenAI API error: {str(e)}")
-            return {
-                'response': "I'm sorry, I'm having trouble connecting to my AI service right now. Please try again in a moment.",
-                'error': str(e),
-                'success': False
+            cache_key = self._cache_key(messages, self.REVIEW_PARAMS) if use_cache else None
+            if cache_key:
+                cached = self.response_cache.get(cache_key)
+                if cached:
+                    return self._cached_result(cached, start_time)
+            return self._complete(messages, cache_key, start_time, deadline, self.REVIEW_PARAMS)
+        
+        except Exception as e:
+            return self._failure_result(e)
+
+    def _review_messages(self, path, language, code, first_line, known_findings):
+        # numbered lines, so the findings point at the right ones
+        lines = code.splitlines()
+        last_line = first_line + len(lines) - 1
+        numbered = '\n'.join(f"{number}| {line}" for number, line in enumerate(lines, first_line))
+        known = ''
+        if known_findings:
+            known = "\n\nAlready reported by static analysis, do not repeat:\n" + '\n'.join(known_findings)
+        return [
+            {
+                "role": "system",
+                "content": "You review one part of a source file from a larger project. Report real "
+                           "problems only: bugs, security issues, performance problems, error handling, "
+                           "and maintainability issues worth fixing. Answer with a JSON object "
+                           '{"findings": [{"line": <line number>, "severity": "error"|"warning"|"info", '
+                           '"category": "bug"|"security"|"performance"|"maintainability"|"style", '
+                           '"message": "<one or two sentences>"}]}, and {"findings": []} when there is '
+                           "nothing to report. Code outside this part may define names used here."
+            },
+            {
+                "role": "user",
+                "content": f"File: {path} ({language}), lines {first_line}-{last_line}:\n"
+                           f"{numbered}{known}"
             }
+        ]
+
+    def summarize_conversation(self, previous_summary, messages):
+        """
+        Fold messages into previous_summary and return the new summary,
+        or None if the model call failed
+        """
+        try:
+            response = self.resilience.call(lambda timeout: get_client().chat.completions.create(
+                model=self.MODEL,
+                messages=self._summary_messages(previous_summary, messages),
+                temperature=0,
+                max_tokens=settings.CHAT_SUMMARY_MAX_TOKENS,
+                timeout=timeout
+            ))
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error(f"Failed to update conversation summary: {str(e)}")
+            return None
+
+    async def asummarize_conversation(self, previous_summary, messages):
+        """Async variant of summarize_conversation()"""
+        try:
+            response = await self.resilience.acall(lambda timeout: get_async_client().chat.completions.create(
+                model=self.MODEL,
+                messages=self._summary_messages(previous_summary, messages),
+                temperature=0,
+                max_tokens=settings.CHAT_SUMMARY_MAX_TOKENS,
+                timeout=timeout
+            ))
+            return response.choices[0].message.content.strip()
         except Exception as e:
-            logger.error(f"Unexpected error in AI service: {str(e)}")
-            return {
-                'response': "I encountered an unexpected error. Please try again.",
-                'error': str(e),
-                'success': False
+            logger.error(f"Failed to update conversation summary: {str(e)}")
+            return None
+
+    def _summary_messages(self, previous_summary, messages):
+        transcript = '\n\n'.join(
+            f"{msg.message_type.upper()}: {msg.content[:settings.CHAT_SUMMARY_MESSAGE_CHARS]}"
+            for msg in messages
+        )
+        return [
+            {
+                "role": "system",
+                "content": "You maintain a running summary of a programming help conversation. "
+                           "Merge the new turns into the existing summary. Keep the user's goals, "
+                           "languages and frameworks, code under discussion (names, key snippets), "
+                           "decisions made and open questions. Be concise and factual."
+            },
+            {
+                "role": "user",
+                "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"
             }
-    
-    def _prepare_messages(self, user_message, conversation_history=None):
+        ]
+
+    def _complete(self, messages, cache_key, start_time, deadline, params=None):
+        response = self.resilience.call(
+            lambda timeout: get_client().chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                timeout=timeout,
+                **(params or self.COMPLETION_PARAMS)
+            ),
+            deadline,
+            hedge=True
+        )
+        
+        result = {
+            'response': response.choices[0].message.content,
+            'tokens_used': response.usage.total_tokens if response.usage else None,
+            'response_time': time.time() - start_time,
+            'success': True
+        }
+        if cache_key:
+            self.response_cache.set(cache_key, result)
+        return result
+
+    async def _acomplete(self, messages, cache_key, start_time, deadline):
+        response = await self.resilience.acall(
+            lambda timeout: get_async_client().chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                timeout=timeout,
+                **self.COMPLETION_PARAMS
+            ),
+            deadline,
+            hedge=True
+        )
+
+        result = {
+            'response': response.choices[0].message.content,
+            'tokens_used': response.usage.total_tokens if response.usage else None,
+            'response_time': time.time() - start_time,
+            'success': True
+        }
+        if cache_key:
+            await self.response_cache.aset(cache_key, result)
+        return result
+
+    def _failure_result(self, error, partial=''):
+        """
+        AI result for a call that failed for good. error_type tells
+        timeouts, rate limits, an open circuit and other errors apart,
+        transient is True when trying again later may succeed.
+        """
+        error_type = record_failure(error)
+        logger.error(f"OpenAI call failed ({error_type}): {str(error)}")
+        return {
+            'response': partial or FAILURE_RESPONSES[error_type],
+            'error': str(error),
+            'error_type': error_type,
+            'transient': is_transient(error),
+            'success': False
+        }
+
+    def _revised_prompt(self, user_message, conversation_history):
+        """
+        (user_message, history, tokens saved): the turns that fit the prompt,
+        with revised code as diffs against earlier versions
+        (services/code_revisions.py). Unchanged if that fails.
+        """
+        recent_history, _ = pack_history(conversation_history)
+        try:
+            return compact_revisions(user_message, recent_history)
+        except Exception as e:
+            logger.error(f"Could not diff revised code: {str(e)}")
+            return user_message, recent_history, 0
+
+    def _with_extras(self, result, analysis, tokens_saved):
+        if analysis:
+            result = {**result, 'code_analysis': analysis}
+        if tokens_saved:
+            result = {**result, 'prompt_tokens_saved': tokens_saved}
+        return result
+
+    def _shared_result(self, result, start_time):
+        """
+        AI result for a caller that waited on another request's identical
+        call: counted like a cache hit, the tokens were spent by the leader
+        """
+        shared = dict(result)
+        shared.update({
+            'tokens_used': 0,
+            'response_time': time.time() - start_time,
+            'cached': True,
+            'coalesced': True
+        })
+        return shared
+
+    def _cache_key(self, messages, params=None):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.make_key(messages, self.MODEL, params or self.COMPLETION_PARAMS)
+
+    def _cached_result(self, cached, start_time):
+        """AI result for a cache hit: no tokens spent, response_time is the lookup"""
+        return {
+            'response': cached['response'],
+            'tokens_used': 0,
+            'response_time': time.time() - start_time,
+            'cached': True,
+            'success': True
+        }
+
+    def _prepare_messages(self, user_message, conversation_history=None, summary=None, analysis=None):
 
         
         
@@ -84,11 +521,17 @@ If asked about non-programming topics, politely redirect the conversation back t
             {"role": "system", "content": system_prompt}
         ]
         
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier part of this conversation:\n{summary}"
+            })
         
         if conversation_history:
             
-            history_list = list(conversation_history)
-            recent_history = history_list[-10:] if len(history_list) > 10 else history_list
+            # as many recent turns as fit the token budget, older ones are
+            # covered by the rolling summary (see chat_service.update_rolling_summary)
+            recent_history, _ = pack_history(conversation_history)
             
             for msg in recent_history:
                 role = "user" if msg.message_type == "user" else "assistant"
@@ -98,6 +541,11 @@ If asked about non-programming topics, politely redirect the conversation back t
                 })
         
     
+        # code_analysis results for the code blocks of the new message
+        hints = hints_message(analysis)
+        if hints:
+            messages.append({"role": "system", "content": hints})
+        
         messages.append({
             "role": "user", 
             "content": user_message
@@ -118,7 +566,8 @@ If asked about non-programming topics, politely redirect the conversation back t
         message_lower = message.lower()
         return any(keyword in message_lower for keyword in coding_keywords)
     
-    def generate_session_title(self, first_message):
+    @staticmethod
+    def generate_session_title(first_message):
         """Generate a title for the chat session based on first message"""
         try:
             
@@ -0,0 +1,109 @@
+"""
+Concurrent fan-out of the completions of a batch (POST /api/chat/batch/).
+
+The DB work stays on the calling thread: the exchanges are stored up front
+by begin_batch_exchanges and the rolling summaries updated once per session,
+then only the OpenAI calls run on the thread pool, at most concurrency at a
+time. Each reply is stored as its completion comes back.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+
+from ..models import ChatMessage
+from .ai_service import CodingChatAI
+from .chat_service import ABANDONED_RESPONSE, complete_exchange, fail_exchange, update_rolling_summary
+
+logger = logging.getLogger(__name__)
+
+ABANDONED_ERROR = 'Batch was abandoned before this message was answered'
+
+
+def batch_summaries(exchanges):
+    """Rolling summary per session of the batch, updated once per session"""
+    summaries = {}
+    for session, _, _, conversation_history in exchanges:
+        if session.pk not in summaries:
+            summaries[session.pk] = update_rolling_summary(session, conversation_history)
+    return summaries
+
+
+def _get_response(ai_service, exchange, summary):
+    session, user_msg, _, conversation_history = exchange
+    return ai_service.get_response(
+        user_msg.content, conversation_history,
+        use_cache=session.response_cache_enabled, summary=summary
+    )
+
+
+def _result_of(future):
+    try:
+        return future.result()
+    except Exception as e:
+        # get_response reports its own failures, this is a bug
+        logger.error(f"Batch item failed unexpectedly: {str(e)}")
+        return {
+            'response': "I encountered an unexpected error. Please try again.",
+            'error': str(e),
+            'success': False
+        }
+
+
+def run_batch(exchanges, concurrency, permit=None):
+    """
+    Answer the exchanges of begin_batch_exchanges with at most concurrency
+    completions in flight. Yields (index, assistant_msg, ai_result) as each
+    reply is stored, in completion order. The admission permit, if any, is
+    charged the tokens used and released at the end.
+
+    Closing the generator early (e.g. the client of a streamed batch went
+    away) stores the replies already running when they finish and the ones
+    not started as failed.
+    """
+    summaries = batch_summaries(exchanges)
+    ai_service = CodingChatAI()
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='chat-batch')
+    futures = {
+        executor.submit(_get_response, ai_service, exchange, summaries[exchange[0].pk]): index
+        for index, exchange in enumerate(exchanges)
+    }
+    stored = set()
+
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            ai_result = _result_of(future)
+            if permit is not None:
+                permit.charge(ai_result.get('tokens_used'))
+            assistant_msg = complete_exchange(exchanges[index][2], ai_result)
+            stored.add(index)
+            yield index, assistant_msg, ai_result
+    finally:
+        for future, index in futures.items():
+            if index in stored:
+                continue
+            if future.cancel():
+                ai_result = {'response': ABANDONED_RESPONSE, 'error': ABANDONED_ERROR, 'success': False}
+            else:
+                ai_result = _result_of(future)
+                if permit is not None:
+                    permit.charge(ai_result.get('tokens_used'))
+            complete_exchange(exchanges[index][2], ai_result)
+        executor.shutdown(wait=False)
+        if permit is not None:
+            permit.release()
+
+
+def fail_unfinished(exchanges, error):
+    """
+    Mark the replies of a batch that are still pending as failed, after
+    run_batch raised. Returns how many were failed.
+    """
+    pending = ChatMessage.objects.filter(
+        pk__in=[assistant_msg.pk for _, _, assistant_msg, _ in exchanges],
+        status=ChatMessage.STATUS_PENDING
+    )
+    count = 0
+    for assistant_msg in pending:
+        fail_exchange(assistant_msg, error)
+        count += 1
+    return count
@@ -0,0 +1,238 @@
+"""
+NDJSON archive format of chat sessions and messages, written by
+prune_chats and the exports, read back by import_chats.
+
+One JSON object per line. A header line ({"type": "archive", "version": 1})
+is followed by the session records, then the message records of those
+sessions, so a reader can restore them in order without holding the file.
+Rows are read with .values() and .iterator() (a server-side cursor on
+Postgres), memory stays flat however large the archive.
+"""
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+import datetime
+import gzip
+import json
+import logging
+import os
+import uuid
+import zlib
+
+from ..models import ChatSession, ChatMessage
+from .stats_service import record_activity
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+SESSION_FIELDS = [
+    'id', 'session_key', 'title', 'response_cache_enabled', 'summary', 'summary_until',
+    'message_count', 'last_message_preview', 'last_message_type', 'last_message_at',
+    'created_at', 'updated_at',
+]
+MESSAGE_FIELDS = [
+    'id', 'session_id', 'message_type', 'content', 'created_at', 'status', 'error',
+    'tokens_used', 'response_time', 'time_to_first_token', 'cached', 'code_analysis',
+    'prompt_tokens_saved',
+]
+
+CHUNK_SIZE = 2000
+# bytes buffered before a piece of a stream is handed on
+STREAM_BUFFER_SIZE = 64 * 1024
+IMPORT_BATCH_SIZE = 1000
+
+
+class ArchiveJSONEncoder(DjangoJSONEncoder):
+    """Keeps the microseconds DjangoJSONEncoder cuts off, keyset pagination orders by them"""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def dumps_record(record):
+    return json.dumps(record, cls=ArchiveJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def iter_records(sessions, chunk_size=CHUNK_SIZE):
+    """Header, session and message records of a ChatSession queryset"""
+    yield {'type': 'archive', 'version': FORMAT_VERSION, 'created_at': timezone.now()}
+
+    for row in sessions.order_by('pk').values(*SESSION_FIELDS).iterator(chunk_size=chunk_size):
+        yield {'type': 'session', **row}
+
+    messages = ChatMessage.objects.filter(session__in=sessions.values('pk')).order_by(
+        # the order of chatmsg_session_window_idx
+        'session_id', 'created_at', 'id'
+    )
+    for row in messages.values(*MESSAGE_FIELDS).iterator(chunk_size=chunk_size):
+        yield {'type': 'message', **row}
+
+
+def write_archive(path, sessions, chunk_size=CHUNK_SIZE):
+    """
+    Write the sessions of a queryset and their messages to path, gzip'd
+    when it ends in .gz. The file only appears under its name once it is
+    complete and on disk. Returns (sessions, messages) written.
+    """
+    counts = {'session': 0, 'message': 0}
+    partial = f"{path}.part"
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(partial, 'wt', encoding='utf-8') as f:
+        for record in iter_records(sessions, chunk_size):
+            f.write(dumps_record(record))
+            if record['type'] in counts:
+                counts[record['type']] += 1
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+    return counts['session'], counts['message']
+
+
+def drop_sessions(path, session_ids):
+    """
+    Rewrite the archive at path without the sessions of session_ids and
+    their messages, replacing it once the new file is on disk. Returns
+    (sessions, messages) dropped.
+    """
+    session_ids = {str(pk) for pk in session_ids}
+    dropped = {'session': 0, 'message': 0}
+    partial = f"{path}.part"
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt', encoding='utf-8') as src, opener(partial, 'wt', encoding='utf-8') as dst:
+        for number, line in enumerate(src):
+            if number:
+                record = json.loads(line)
+                owner = record['id'] if record['type'] == 'session' else record['session_id']
+                if owner in session_ids:
+                    dropped[record['type']] += 1
+                    continue
+            dst.write(line)
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+    return dropped['session'], dropped['message']
+
+
+def iter_ndjson(records, compress=False):
+    """
+    Encode records as NDJSON bytes, in pieces of about STREAM_BUFFER_SIZE,
+    gzip'd if compress. For StreamingHttpResponse and file writes alike.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    size = 0
+
+    for record in records:
+        line = dumps_record(record).encode('utf-8')
+        buffer.append(line)
+        size += len(line)
+        if size >= STREAM_BUFFER_SIZE:
+            data = b''.join(buffer)
+            buffer, size = [], 0
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+
+    data = b''.join(buffer)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def read_records(lines):
+    """Records of NDJSON lines (bytes or str), checking the header"""
+    header = None
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if header is None:
+            header = record
+            if record.get('type') != 'archive' or record.get('version') != FORMAT_VERSION:
+                raise ValueError(f"Not a version {FORMAT_VERSION} chat archive")
+            continue
+        if record.get('type') not in ('session', 'message'):
+            raise ValueError(f"Line {number}: unknown record type {record.get('type')!r}")
+        yield record
+
+
+def _new_rows(model, rows):
+    ids = [uuid.UUID(row['id']) for row in rows]
+    existing = set(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    return [row for row, pk in zip(rows, ids) if pk not in existing]
+
+
+def _create(model, rows, timestamps):
+    objs = [model(**row) for row in rows]
+    model.objects.bulk_create(objs)
+    # bulk_create applies auto_now(_add), put the archived times back
+    for obj, row in zip(objs, rows):
+        for field in timestamps:
+            setattr(obj, field, row[field])
+    model.objects.bulk_update(objs, timestamps)
+    return objs
+
+
+@transaction.atomic
+def _import_sessions(rows):
+    rows = _new_rows(ChatSession, rows)
+    if not rows:
+        return 0
+    _create(ChatSession, rows, ['created_at', 'updated_at'])
+
+    counts = {}
+    for row in rows:
+        sessions, messages = counts.get(row['session_key'], (0, 0))
+        counts[row['session_key']] = (sessions + 1, messages + row['message_count'])
+    for session_key, (sessions, messages) in counts.items():
+        record_activity(session_key, sessions=sessions, messages=messages)
+    return len(rows)
+
+
+@transaction.atomic
+def _import_messages(rows):
+    rows = _new_rows(ChatMessage, rows)
+    known = set(ChatSession.objects.filter(
+        pk__in={row['session_id'] for row in rows}
+    ).values_list('pk', flat=True))
+    orphans = [row for row in rows if uuid.UUID(row['session_id']) not in known]
+    if orphans:
+        logger.warning(f"Skipping {len(orphans)} messages of sessions missing from the archive")
+        rows = [row for row in rows if uuid.UUID(row['session_id']) in known]
+    if not rows:
+        return 0
+    _create(ChatMessage, rows, ['created_at'])
+    return len(rows)
+
+
+def import_records(records, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Restore the sessions and messages of read_records() with bulk_create, a
+    transaction per batch of batch_size rows. Rows whose id is taken already
+    are skipped, so a file can be imported again after an interruption.
+    Returns (sessions, messages) created.
+    """
+    importers = {'session': _import_sessions, 'message': _import_messages}
+    created = {'session': 0, 'message': 0}
+    batch_type, batch = None, []
+
+    for record in records:
+        record_type = record.pop('type')
+        if record_type != batch_type or len(batch) >= batch_size:
+            if batch:
+                created[batch_type] += importers[batch_type](batch)
+            batch_type, batch = record_type, []
+        batch.append(record)
+    if batch:
+        created[batch_type] += importers[batch_type](batch)
+
+    return created['session'], created['message']
@@ -0,0 +1,595 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+import logging
+import threading
+import time
+
+from ..models import ChatSession, ChatMessage, ChatJob, CodeReview, ReviewedFile
+from .ai_service import CodingChatAI
+from .context_builder import count_tokens, pack_history, unsummarized
+from .stats_service import record_activity
+
+logger = logging.getLogger(__name__)
+
+ABANDONED_RESPONSE = "This response was interrupted before it finished. Please try again."
+
+# sessions per purge_chat_sessions call, keeps their ids under the SQLite
+# variable limit
+DELETE_SESSION_BATCH = 500
+
+
+@transaction.atomic
+def create_chat_session(session_key, title):
+    session = ChatSession.objects.create(session_key=session_key, title=title)
+    record_activity(session_key, sessions=1)
+    return session
+
+
+def delete_chat_sessions(sessions, background=False, reviews=None):
+    """
+    Delete a queryset of chat sessions with their messages and update the
+    counters, through purge_chat_sessions: raw batches of
+    CHAT_DELETE_BATCH_SIZE messages, nothing loaded into memory. The code
+    reviews of reviews (a CodeReview queryset), if given, go the same way
+    with their files. Returns the number of sessions.
+
+    With background, the sessions and reviews are only marked deleted here,
+    which takes them away from their owner and the counters, and a thread
+    purges them once the transaction commits.
+    """
+    session_ids = list(sessions.filter(deleted_at__isnull=True).values_list('pk', flat=True))
+    review_ids = []
+    if reviews is not None:
+        review_ids = list(reviews.filter(deleted_at__isnull=True).values_list('pk', flat=True))
+    if background:
+        _mark_deleted(session_ids)
+        CodeReview.objects.filter(pk__in=review_ids).update(deleted_at=timezone.now())
+        transaction.on_commit(lambda: _purge_in_background(session_ids, review_ids))
+        return len(session_ids)
+
+    deleted = 0
+    for start in range(0, len(session_ids), DELETE_SESSION_BATCH):
+        deleted += purge_chat_sessions(
+            session_ids[start:start + DELETE_SESSION_BATCH], batch_size=settings.CHAT_DELETE_BATCH_SIZE
+        )[0]
+    purge_code_reviews(review_ids, batch_size=settings.CHAT_DELETE_BATCH_SIZE)
+    return deleted
+
+
+def _removed_counts(sessions):
+    return list(sessions.values('session_key').annotate(
+        num_sessions=Count('id'), num_messages=Sum('message_count')
+    ).order_by())
+
+
+def _mark_deleted(session_ids):
+    now = timezone.now()
+    for start in range(0, len(session_ids), DELETE_SESSION_BATCH):
+        with transaction.atomic():
+            sessions = ChatSession.objects.filter(
+                pk__in=session_ids[start:start + DELETE_SESSION_BATCH], deleted_at__isnull=True
+            )
+            removed = _removed_counts(sessions)
+            sessions.update(session_key='', deleted_at=now)
+            for row in removed:
+                record_activity(row['session_key'], sessions=-row['num_sessions'], messages=-(row['num_messages'] or 0))
+
+
+# (session ids, review ids) of the purge threads of this worker that have
+# not finished, purge_unfinished_deletes() does them when the worker exits
+_unfinished_purges = {}
+_unfinished_lock = threading.Lock()
+
+
+def _purge_in_background(session_ids, review_ids):
+    token = object()
+    with _unfinished_lock:
+        _unfinished_purges[token] = (session_ids, review_ids)
+
+    def purge():
+        try:
+            purge_deleted_sessions(session_ids)
+            purge_deleted_reviews(review_ids)
+        except Exception as e:
+            # prune_chats purges what is left marked
+            logger.error(f"Could not purge {len(session_ids)} deleted chat sessions: {str(e)}")
+        finally:
+            with _unfinished_lock:
+                _unfinished_purges.pop(token, None)
+            connection.close()
+
+    threading.Thread(target=purge, name='chat-session-purge', daemon=True).start()
+
+
+def purge_unfinished_deletes():
+    """
+    Purge what the background deletes of this worker have not yet, e.g.
+    when it exits. Returns (sessions, messages) deleted.
+    """
+    with _unfinished_lock:
+        unfinished = list(_unfinished_purges.values())
+    totals = (0, 0)
+    for session_ids, review_ids in unfinished:
+        deleted = purge_deleted_sessions(session_ids)
+        purge_deleted_reviews(review_ids)
+        totals = (totals[0] + deleted[0], totals[1] + deleted[1])
+    return totals
+
+
+def purge_deleted_sessions(session_ids=None, batch_size=None, pause=0):
+    """
+    Purge the sessions marked deleted (only those of session_ids, if given),
+    returns (sessions, messages) deleted
+    """
+    marked = ChatSession.objects.filter(deleted_at__isnull=False)
+    if session_ids is not None:
+        marked = marked.filter(pk__in=session_ids)
+    batch_size = batch_size or settings.CHAT_DELETE_BATCH_SIZE
+
+    totals = (0, 0)
+    while True:
+        ids = list(marked.order_by('pk').values_list('pk', flat=True)[:DELETE_SESSION_BATCH])
+        if not ids:
+            return totals
+        deleted = purge_chat_sessions(ids, batch_size=batch_size, pause=pause)
+        totals = (totals[0] + deleted[0], totals[1] + deleted[1])
+
+
+def purge_deleted_reviews(review_ids=None, batch_size=None, pause=0):
+    """
+    Purge the code reviews marked deleted (only those of review_ids, if
+    given), returns the number of reviews deleted
+    """
+    marked = CodeReview.objects.filter(deleted_at__isnull=False)
+    if review_ids is not None:
+        marked = marked.filter(pk__in=review_ids)
+    return purge_code_reviews(
+        list(marked.values_list('pk', flat=True)), batch_size=batch_size or settings.CHAT_DELETE_BATCH_SIZE, pause=pause
+    )
+
+
+def _raw_delete(queryset):
+    # one DELETE statement, without the collector loading the rows and their
+    # relations first. Only safe once nothing references the rows any more.
+    return queryset._raw_delete(queryset.db)
+
+
+def _delete_messages(pks):
+    _raw_delete(ChatJob.objects.filter(Q(user_message_id__in=pks) | Q(assistant_message_id__in=pks)))
+    return _raw_delete(ChatMessage.objects.filter(pk__in=pks))
+
+
+def purge_chat_sessions(session_ids, batch_size=1000, pause=0):
+    """
+    Delete chat sessions and their messages in bounded batches and update the
+    counters. Each batch of messages goes in a short transaction of its own,
+    pause seconds apart, then the sessions go in a last one. Memory and lock
+    time stay flat however long the histories are. Returns (sessions,
+    messages) deleted.
+    """
+    messages = 0
+    while True:
+        with transaction.atomic():
+            pks = list(
+                ChatMessage.objects.filter(session_id__in=session_ids)
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not pks:
+                break
+            messages += _delete_messages(pks)
+        if pause:
+            time.sleep(pause)
+
+    with transaction.atomic():
+        sessions = ChatSession.objects.filter(pk__in=session_ids)
+        # sessions marked deleted were taken off the counters already
+        removed = _removed_counts(sessions.filter(deleted_at__isnull=True))
+        # messages written since the last batch
+        messages += _delete_messages(
+            list(ChatMessage.objects.filter(session_id__in=session_ids).values_list('pk', flat=True))
+        )
+        deleted = _raw_delete(sessions)
+        for row in removed:
+            record_activity(row['session_key'], sessions=-row['num_sessions'], messages=-(row['num_messages'] or 0))
+
+    return deleted, messages
+
+
+def purge_code_reviews(review_ids, batch_size=1000, pause=0):
+    """
+    Delete code reviews and their files the way purge_chat_sessions deletes
+    messages: raw batches of batch_size files, each in a short transaction,
+    then the reviews. Returns the number of reviews deleted.
+    """
+    deleted = 0
+    for start in range(0, len(review_ids), DELETE_SESSION_BATCH):
+        ids = review_ids[start:start + DELETE_SESSION_BATCH]
+        while True:
+            with transaction.atomic():
+                pks = list(ReviewedFile.objects.filter(review_id__in=ids).values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                _raw_delete(ReviewedFile.objects.filter(pk__in=pks))
+            if pause:
+                time.sleep(pause)
+
+        with transaction.atomic():
+            # files written since the last batch
+            _raw_delete(ReviewedFile.objects.filter(review_id__in=ids))
+            deleted += _raw_delete(CodeReview.objects.filter(pk__in=ids))
+    return deleted
+
+
+@transaction.atomic
+def begin_exchange(session, user_message, only_if_title=None):
+    """
+    Phase one of a chat exchange, in one short transaction.
+
+    Stores the user message and a pending assistant message, retitles the
+    session on its first message (only when its title is only_if_title, if
+    given) and returns (user_msg, assistant_msg, conversation_history).
+    The model is called afterwards, outside of any transaction.
+    """
+    user_msg = ChatMessage.objects.create(
+        session=session,
+        message_type='user',
+        content=user_message
+    )
+    assistant_msg = ChatMessage.objects.create(
+        session=session,
+        message_type='assistant',
+        content='',
+        status=ChatMessage.STATUS_PENDING
+    )
+
+    ChatSession.objects.filter(pk=session.pk).update(
+        message_count=F('message_count') + 2,
+        last_message_preview=user_msg.preview,
+        last_message_type=user_msg.message_type,
+        last_message_at=user_msg.created_at,
+        updated_at=timezone.now()
+    )
+    record_activity(session.session_key, messages=2)
+    # the row is locked by the update, so this is our own count
+    session.refresh_from_db(fields=[
+        'message_count', 'last_message_preview', 'last_message_type', 'last_message_at', 'updated_at'
+    ])
+
+    if session.message_count == 2 and only_if_title in (None, session.title):
+        session.title = CodingChatAI.generate_session_title(user_message)
+        session.save(update_fields=['title'])
+
+    # the user message is appended by _prepare_messages, keep it out of the history
+    conversation_history = load_context_window(session, exclude=user_msg)
+
+    return user_msg, assistant_msg, conversation_history
+
+
+@transaction.atomic
+def begin_batch_exchanges(session_key, items, title="Quick Chat"):
+    """
+    Phase one for a batch of exchanges (POST /api/chat/batch/), like
+    begin_exchange but with a number of queries that does not grow with
+    the batch: the messages of all items are written with one bulk_create.
+
+    items are validated SendMessageSerializer data. An item whose session_id
+    is not one of session_key's sessions gets a new session, as in
+    POST /api/chat/. Returns one (session, user_msg, assistant_msg,
+    conversation_history) tuple per item, in item order. Items of the same
+    session share the history from before the batch.
+    """
+    requested = {item['session_id'] for item in items if item.get('session_id')}
+    sessions = {}
+    if requested:
+        sessions = {
+            session.pk: session
+            for session in ChatSession.objects.filter(session_key=session_key, pk__in=requested)
+        }
+    histories = {pk: load_context_window(session) for pk, session in sessions.items()}
+
+    targets, new_sessions = [], []
+    for item in items:
+        session = sessions.get(item.get('session_id'))
+        if session is None:
+            session = ChatSession(
+                session_key=session_key,
+                title=CodingChatAI.generate_session_title(item['message'])
+            )
+            new_sessions.append(session)
+            histories[session.pk] = []
+        targets.append(session)
+    ChatSession.objects.bulk_create(new_sessions)
+
+    messages = []
+    for session, item in zip(targets, items):
+        messages.append(ChatMessage(session=session, message_type='user', content=item['message']))
+        messages.append(ChatMessage(
+            session=session, message_type='assistant', content='', status=ChatMessage.STATUS_PENDING
+        ))
+    ChatMessage.objects.bulk_create(messages)
+
+    # per session: number of new messages, first and last user message
+    added = {}
+    for user_msg in messages[::2]:
+        count, first_msg, _ = added.get(user_msg.session_id, (0, user_msg, None))
+        added[user_msg.session_id] = (count + 2, first_msg, user_msg)
+
+    now = timezone.now()
+    for session in new_sessions:
+        session.message_count, _, last_msg = added[session.pk]
+        session.last_message_preview = last_msg.preview
+        session.last_message_type = last_msg.message_type
+        session.last_message_at = last_msg.created_at
+    ChatSession.objects.bulk_update(new_sessions, [
+        'message_count', 'last_message_preview', 'last_message_type', 'last_message_at'
+    ])
+
+    for pk, session in sessions.items():
+        if pk not in added:
+            continue
+        count, first_msg, last_msg = added[pk]
+        ChatSession.objects.filter(pk=pk).update(
+            message_count=F('message_count') + count,
+            last_message_preview=last_msg.preview,
+            last_message_type=last_msg.message_type,
+            last_message_at=last_msg.created_at,
+            updated_at=now
+        )
+        if session.message_count == 0:
+            # first messages of the session, as in begin_exchange
+            session.title = CodingChatAI.generate_session_title(first_msg.content)
+            session.save(update_fields=['title'])
+
+    record_activity(session_key, sessions=len(new_sessions), messages=len(messages))
+
+    return [
+        (session, messages[2 * i], messages[2 * i + 1], histories[session.pk])
+        for i, session in enumerate(targets)
+    ]
+
+
+def context_window_queryset(session):
+    """
+    The newest complete messages of a session, newest first.
+
+    Bounded to CHAT_CONTEXT_MAX_MESSAGES rows and to the columns the prompt
+    needs, backed by the (session, created_at, id) index, so the cost of a
+    turn does not grow with the length of the session.
+    """
+    return session.messages.filter(
+        status=ChatMessage.STATUS_COMPLETE
+    ).order_by('-created_at', '-id').only(
+        'id', 'session_id', 'message_type', 'content', 'created_at'
+    )
+
+
+def load_context_window(session, exclude=None, before=None):
+    """
+    Candidate prompt history, oldest first, optionally only messages created
+    before a datetime. Packing happens in _prepare_messages
+    """
+    queryset = context_window_queryset(session)
+    if exclude is not None:
+        queryset = queryset.exclude(pk=exclude.pk)
+    if before is not None:
+        queryset = queryset.filter(created_at__lt=before)
+    return list(reversed(queryset[:settings.CHAT_CONTEXT_MAX_MESSAGES]))
+
+
+def _summary_backlog_queryset(session, conversation_history):
+    """
+    Messages older than the fetched window that the summary does not cover
+    yet. Only possible when the window came back full. Bounded per call, the
+    rest is picked up on the next turns.
+    """
+    if len(conversation_history) < settings.CHAT_CONTEXT_MAX_MESSAGES:
+        return None
+
+    queryset = session.messages.filter(
+        status=ChatMessage.STATUS_COMPLETE,
+        created_at__lt=conversation_history[0].created_at
+    )
+    if session.summary_until is not None:
+        queryset = queryset.filter(created_at__gt=session.summary_until)
+
+    return queryset.order_by('created_at', 'id').only(
+        'id', 'session_id', 'message_type', 'content', 'created_at'
+    )[:settings.CHAT_SUMMARY_MAX_BACKLOG]
+
+
+def _messages_to_summarize(session, conversation_history, backlog):
+    if len(backlog) >= settings.CHAT_SUMMARY_MAX_BACKLOG:
+        # the backlog was cut short, summarizing newer turns now would skip the rest
+        return backlog
+    _, dropped = pack_history(conversation_history)
+    return backlog + unsummarized(dropped, session.summary_until)
+
+
+def _summary_batches(messages):
+    """Split messages into batches small enough for one summary call"""
+    batch, used = [], 0
+    for msg in messages:
+        cost = count_tokens(msg.content[:settings.CHAT_SUMMARY_MESSAGE_CHARS])
+        if batch and used + cost > settings.CHAT_SUMMARY_BATCH_TOKENS:
+            yield batch
+            batch, used = [], 0
+        batch.append(msg)
+        used += cost
+    if batch:
+        yield batch
+
+
+def _save_summary(session, summary, summary_until):
+    # update() so the session's updated_at is left alone
+    ChatSession.objects.filter(pk=session.pk).update(summary=summary, summary_until=summary_until)
+    session.summary = summary
+    session.summary_until = summary_until
+
+
+def update_rolling_summary(session, conversation_history):
+    """
+    Fold the turns that fell out of the token-budgeted window into the
+    session's rolling summary and return the summary to send.
+
+    Only turns newer than session.summary_until are summarized, so each turn
+    is folded in once and most requests make no summary call at all. That
+    includes turns older than the fetched window (see load_context_window).
+    Runs outside of any transaction since it may call the model.
+    """
+    backlog = _summary_backlog_queryset(session, conversation_history)
+    backlog = list(backlog) if backlog is not None else []
+    pending = _messages_to_summarize(session, conversation_history, backlog)
+    if not pending:
+        return session.summary
+
+    ai_service = CodingChatAI()
+    for batch in _summary_batches(pending):
+        summary = ai_service.summarize_conversation(session.summary, batch)
+        if summary is None:
+            # keep what we have, the remaining turns are retried next time
+            break
+        _save_summary(session, summary, batch[-1].created_at)
+
+    return session.summary
+
+
+async def aupdate_rolling_summary(session, conversation_history):
+    """Async variant of update_rolling_summary()"""
+    backlog = _summary_backlog_queryset(session, conversation_history)
+    backlog = [msg async for msg in backlog] if backlog is not None else []
+    pending = _messages_to_summarize(session, conversation_history, backlog)
+    if not pending:
+        return session.summary
+
+    ai_service = CodingChatAI()
+    for batch in _summary_batches(pending):
+        summary = await ai_service.asummarize_conversation(session.summary, batch)
+        if summary is None:
+            break
+        await ChatSession.objects.filter(pk=session.pk).aupdate(
+            summary=summary, summary_until=batch[-1].created_at
+        )
+        session.summary = summary
+        session.summary_until = batch[-1].created_at
+
+    return session.summary
+
+
+def complete_exchange(assistant_msg, ai_result):
+    """
+    Phase two: fill in the pending assistant message from an AI result
+    (see CodingChatAI.get_response). Unsuccessful results are stored as
+    failed so they are never mistaken for real completions.
+    """
+    assistant_msg.content = ai_result['response']
+    assistant_msg.tokens_used = ai_result.get('tokens_used')
+    assistant_msg.response_time = ai_result.get('response_time')
+    assistant_msg.time_to_first_token = ai_result.get('time_to_first_token')
+    assistant_msg.cached = ai_result.get('cached', False)
+    assistant_msg.code_analysis = ai_result.get('code_analysis')
+    assistant_msg.prompt_tokens_saved = ai_result.get('prompt_tokens_saved')
+
+    if ai_result['success']:
+        assistant_msg.status = ChatMessage.STATUS_COMPLETE
+        assistant_msg.error = ''
+    else:
+        assistant_msg.status = ChatMessage.STATUS_FAILED
+        assistant_msg.error = ai_result.get('error') or 'Unknown error'
+        if ai_result.get('error_type'):
+            assistant_msg.error = f"{ai_result['error_type']}: {assistant_msg.error}"
+
+    with transaction.atomic():
+        assistant_msg.save(update_fields=[
+            'content', 'tokens_used', 'response_time', 'time_to_first_token', 'cached', 'code_analysis',
+            'prompt_tokens_saved', 'status', 'error'
+        ])
+        ChatSession.objects.filter(pk=assistant_msg.session_id).update(updated_at=timezone.now())
+        # unless a newer exchange started in the meantime, this is the last message
+        ChatSession.objects.filter(
+            pk=assistant_msg.session_id,
+            last_message_at__lte=assistant_msg.created_at
+        ).update(
+            last_message_preview=assistant_msg.preview,
+            last_message_type=assistant_msg.message_type,
+            last_message_at=assistant_msg.created_at
+        )
+
+    return assistant_msg
+
+
+def fail_exchange(assistant_msg, error):
+    """Mark a pending assistant message as failed after an unexpected error"""
+    try:
+        return complete_exchange(assistant_msg, {
+            'response': "I encountered an unexpected error. Please try again.",
+            'error': str(error),
+            'success': False
+        })
+    except Exception as e:
+        # the reconcile_pending_messages command will pick the row up later
+        logger.error(f"Could not mark message {assistant_msg.id} as failed: {str(e)}")
+        return assistant_msg
+
+
+def reconcile_pending(older_than, dry_run=False):
+    """
+    Mark pending assistant messages created before older_than as failed.
+    These belong to generations whose worker died or hung. Replies still
+    queued or running as a ChatJob are left to the job queue, which retries
+    and fails them itself. Returns the count.
+    """
+    stale = ChatMessage.objects.filter(
+        status=ChatMessage.STATUS_PENDING,
+        created_at__lt=older_than
+    ).exclude(
+        job__status__in=[ChatJob.STATUS_QUEUED, ChatJob.STATUS_RUNNING]
+    )
+
+    if dry_run:
+        return stale.count()
+
+    return stale.update(
+        status=ChatMessage.STATUS_FAILED,
+        content=ABANDONED_RESPONSE,
+        error='Abandoned: no response was recorded before the pending timeout'
+    )
+
+
+def recompute_session_counters(sessions, batch_size=500):
+    """
+    Rebuild the denormalized message_count/last_message_* columns of the
+    given sessions from their messages. Returns the number of sessions.
+    """
+    last_message = ChatMessage.objects.filter(
+        session=OuterRef('pk')
+    ).order_by('-created_at', '-id')
+
+    sessions = sessions.annotate(
+        num_messages=Count('messages'),
+        last_content=Subquery(last_message.values('content')[:1]),
+        last_type=Subquery(last_message.values('message_type')[:1]),
+        last_at=Subquery(last_message.values('created_at')[:1]),
+    ).only('id')
+
+    fields = ['message_count', 'last_message_preview', 'last_message_type', 'last_message_at']
+    batch = []
+    total = 0
+
+    for session in sessions.iterator(chunk_size=batch_size):
+        session.message_count = session.num_messages
+        session.last_message_preview = ChatMessage(content=session.last_content or '').preview
+        session.last_message_type = session.last_type or ''
+        session.last_message_at = session.last_at
+        batch.append(session)
+        if len(batch) >= batch_size:
+            ChatSession.objects.bulk_update(batch, fields)
+            total += len(batch)
+            batch = []
+
+    if batch:
+        ChatSession.objects.bulk_update(batch, fields)
+        total += len(batch)
+
+    return total
@@ -0,0 +1,466 @@
+"""
+Local static pre-analysis of the code pasted into a chat message.
+
+Before a message goes to the model, its fenced code blocks are analysed
+here: language detection, line and complexity metrics, Python syntax errors
+and a handful of common lint findings. The model gets the results as a
+short system message (hints_message), so it does not spend tokens finding
+what a parser finds instantly, and the API returns them on the assistant
+message (ChatMessage.code_analysis).
+
+The analysers are CPU bound and pure, they run in a per-process pool of
+CHAT_CODE_ANALYSIS_WORKERS worker processes (0 runs them inline) with a
+CHAT_CODE_ANALYSIS_TIMEOUT budget per message. Results are cached by
+content hash in the CHAT_CODE_ANALYSIS_CACHE_ALIAS cache. Anything going
+wrong only costs the hints, never the reply.
+"""
+from asgiref.sync import sync_to_async
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from django.conf import settings
+import ast
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# bump when the analysers change, it invalidates the cached results
+ANALYZER_VERSION = 1
+CACHE_PREFIX = f'code-analysis:v{ANALYZER_VERSION}'
+MAX_FINDINGS = 10
+
+FENCE_RE = re.compile(r'^```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)^```[ \t]*$', re.MULTILINE | re.DOTALL)
+
+LANGUAGE_ALIASES = {
+    'py': 'python', 'python3': 'python', 'py3': 'python',
+    'js': 'javascript', 'jsx': 'javascript', 'node': 'javascript', 'mjs': 'javascript',
+    'ts': 'typescript', 'tsx': 'typescript',
+    'c++': 'cpp', 'cc': 'cpp', 'cxx': 'cpp', 'hpp': 'cpp', 'h': 'c',
+    'cs': 'csharp', 'c#': 'csharp',
+    'rs': 'rust', 'golang': 'go', 'rb': 'ruby', 'kt': 'kotlin',
+    'sh': 'bash', 'shell': 'bash', 'zsh': 'bash', 'console': 'bash',
+    'yml': 'yaml', 'postgresql': 'sql', 'mysql': 'sql', 'sqlite': 'sql',
+}
+
+# (language, pattern, weight), the best scoring language wins
+LANGUAGE_CUES = [
+    ('python', r'^\s*(def|class) \w+.*:\s*$', 3),
+    ('python', r'^\s*(from [\w.]+ )?import \w+', 2),
+    ('python', r'\bself\b|\bNone\b|\belif\b|print\(', 1),
+    ('javascript', r'\b(const|let|var) \w+\s*=|=>|\bfunction\b', 2),
+    ('javascript', r'console\.log|require\(|document\.|\bexport default\b', 3),
+    ('typescript', r'\binterface \w+\s*\{|: (string|number|boolean)\b', 3),
+    ('java', r'\bpublic (static )?(class|void|int)\b|System\.out\.', 3),
+    ('csharp', r'\busing System\b|Console\.Write', 3),
+    ('cpp', r'#include\s*<(iostream|vector|string)>|std::', 3),
+    ('c', r'#include\s*<(stdio|stdlib|string)\.h>|\bprintf\(', 3),
+    ('go', r'^package \w+|\bfunc \w+\(|:=', 2),
+    ('rust', r'\bfn \w+\(|\blet mut\b|println!', 3),
+    ('ruby', r'^\s*def \w+[^:]*$|^\s*end\s*$|\bputs\b', 2),
+    ('php', r'<\?php|\$\w+\s*=', 3),
+    ('sql', r'(?i)\b(select .+ from|insert into|create table|update \w+ set)\b', 3),
+    ('html', r'(?i)<(!doctype|html|div|body|span)\b', 3),
+    ('css', r'^\s*[.#]?[\w-]+\s*\{\s*$|^\s*[\w-]+:\s*[^;]+;\s*$', 1),
+    ('bash', r'^#!/bin/(ba)?sh|^\s*(sudo|apt|pip|npm|cd|echo|export) ', 2),
+]
+_LANGUAGE_CUES = [(language, re.compile(pattern, re.MULTILINE), weight) for language, pattern, weight in LANGUAGE_CUES]
+
+BRACKETS = {')': '(', ']': '[', '}': '{'}
+BRACE_LANGUAGES = {'javascript', 'typescript', 'java', 'csharp', 'cpp', 'c', 'go', 'rust', 'php', 'css'}
+SHADOWABLE_BUILTINS = {'list', 'dict', 'set', 'str', 'id', 'type', 'input', 'len', 'max', 'min', 'sum', 'file', 'filter', 'map'}
+COMPLEXITY_NODES = (
+    ast.If, ast.IfExp, ast.For, ast.AsyncFor, ast.While, ast.ExceptHandler,
+    ast.comprehension, ast.Assert, ast.match_case,
+)
+NESTING_NODES = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.With, ast.AsyncWith, ast.Try)
+
+
+def extract_code_blocks(text):
+    """(language hint, code) of every fenced code block of a message"""
+    return [(hint.lower(), code) for hint, code in FENCE_RE.findall(text) if code.strip()]
+
+
+def detect_language(code, hint=''):
+    if hint:
+        return LANGUAGE_ALIASES.get(hint, hint)
+    scores = {}
+    for language, pattern, weight in _LANGUAGE_CUES:
+        matches = len(pattern.findall(code))
+        if matches:
+            scores[language] = scores.get(language, 0) + weight * min(matches, 3)
+    if not scores:
+        return 'unknown'
+    return max(scores, key=scores.get)
+
+
+def _finding(line, code, message):
+    return {'line': line, 'code': code, 'message': message}
+
+
+class _PythonAnalysis:
+    """Metrics and lint findings of a module, gathered in one walk of its tree"""
+
+    def __init__(self):
+        self.functions = []  # [name, McCabe complexity] per function
+        self.classes = 0
+        self.max_nesting = 0
+        self.findings = []
+        self.imported = {}
+        self.used = set()
+        self.exported = False
+
+    def run(self, tree):
+        stack = [(tree, 0, None)]
+        while stack:
+            node, depth, function = stack.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                function = [node.name, 1]
+                self.functions.append(function)
+            elif function is not None:
+                # 1 plus a point per branch
+                if isinstance(node, COMPLEXITY_NODES):
+                    function[1] += 1 + (len(node.ifs) if isinstance(node, ast.comprehension) else 0)
+                elif isinstance(node, ast.BoolOp):
+                    function[1] += len(node.values) - 1
+            self.check(node)
+
+            if isinstance(node, NESTING_NODES):
+                depth += 1
+                self.max_nesting = max(self.max_nesting, depth)
+            stack.extend((child, depth, function) for child in ast.iter_child_nodes(node))
+
+        if not self.exported:
+            for name, line in self.imported.items():
+                if name not in self.used:
+                    self.findings.append(_finding(line, 'unused-import', f"{name} imported but unused"))
+        self.findings.sort(key=lambda finding: finding['line'])
+
+    def check(self, node):
+        findings = self.findings
+        if isinstance(node, ast.Name):
+            self.used.add(node.id)
+            if node.id == '__all__':
+                self.exported = True
+            elif isinstance(node.ctx, ast.Store) and node.id in SHADOWABLE_BUILTINS:
+                findings.append(_finding(node.lineno, 'shadowed-builtin', f"assignment shadows the builtin {node.id}()"))
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                self.imported[(alias.asname or alias.name).split('.')[0]] = node.lineno
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.name == '*':
+                    findings.append(_finding(node.lineno, 'wildcard-import', f"from {node.module} import *"))
+                elif node.module != '__future__':
+                    self.imported[alias.asname or alias.name] = node.lineno
+        elif isinstance(node, ast.ExceptHandler) and node.type is None:
+            findings.append(_finding(node.lineno, 'bare-except', "bare except also catches KeyboardInterrupt and SystemExit"))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for default in node.args.defaults + [d for d in node.args.kw_defaults if d]:
+                if isinstance(default, (ast.List, ast.Dict, ast.Set)):
+                    findings.append(_finding(
+                        default.lineno, 'mutable-default', f"mutable default argument in {node.name}()"
+                    ))
+        elif isinstance(node, ast.ClassDef):
+            self.classes += 1
+        elif isinstance(node, ast.Compare):
+            for op, right in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.Eq, ast.NotEq)) and isinstance(right, ast.Constant) and right.value is None:
+                    findings.append(_finding(node.lineno, 'none-comparison', "compare to None with 'is' / 'is not'"))
+
+
+def _analyze_python(code, result):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        result['syntax_error'] = {'line': e.lineno, 'column': e.offset, 'message': e.msg}
+        return
+    except (ValueError, RecursionError) as e:
+        # null bytes, absurdly deep nesting
+        result['syntax_error'] = {'line': None, 'column': None, 'message': str(e)}
+        return
+
+    analysis = _PythonAnalysis()
+    analysis.run(tree)
+    result['metrics'].update({
+        'functions': len(analysis.functions),
+        'classes': analysis.classes,
+        'max_nesting': analysis.max_nesting,
+    })
+    if analysis.functions:
+        name, worst = max(analysis.functions, key=lambda function: function[1])
+        result['metrics'].update({'max_complexity': worst, 'most_complex': name})
+    result['findings'] = analysis.findings
+
+
+def _analyze_brackets(code, result):
+    # naive, strings and comments are not skipped
+    stack = []
+    for line_number, line in enumerate(code.splitlines(), 1):
+        for char in line:
+            if char in '([{':
+                stack.append((char, line_number))
+            elif char in BRACKETS:
+                if not stack or stack[-1][0] != BRACKETS[char]:
+                    result['findings'].append(_finding(line_number, 'unbalanced-brackets', f"unexpected '{char}'"))
+                    return
+                stack.pop()
+    if stack:
+        char, line_number = stack[-1]
+        result['findings'].append(_finding(line_number, 'unbalanced-brackets', f"'{char}' is never closed"))
+
+
+def analyze_snippet(code, hint=''):
+    """Analysis of one code block, a JSON-able dict. Pure, runs in the pool."""
+    language = detect_language(code, hint)
+    lines = code.splitlines()
+    result = {
+        'language': language,
+        'metrics': {
+            'lines': sum(1 for line in lines if line.strip()),
+            'longest_line': max((len(line) for line in lines), default=0),
+        },
+        'syntax_error': None,
+        'findings': [],
+    }
+
+    if language == 'python':
+        _analyze_python(code, result)
+    elif language == 'json':
+        try:
+            json.loads(code)
+        except ValueError as e:
+            result['syntax_error'] = {'line': e.lineno, 'column': e.colno, 'message': e.msg}
+    elif language in BRACE_LANGUAGES:
+        _analyze_brackets(code, result)
+
+    result['findings'] = result['findings'][:MAX_FINDINGS]
+    return result
+
+
+def _analyze_blocks(blocks):
+    return [analyze_snippet(code, hint) for hint, code in blocks]
+
+
+_lock = threading.Lock()
+_pool = None
+_owner_pid = None
+
+
+def get_pool():
+    """The process's analysis pool, None when CHAT_CODE_ANALYSIS_WORKERS is 0"""
+    global _pool, _owner_pid
+    if settings.CHAT_CODE_ANALYSIS_WORKERS <= 0:
+        return None
+    with _lock:
+        if _pool is None or _owner_pid != os.getpid():
+            # forkserver: workers never inherit the threads and sockets of a
+            # busy web worker
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.CHAT_CODE_ANALYSIS_WORKERS,
+                mp_context=multiprocessing.get_context(method)
+            )
+            _owner_pid = os.getpid()
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def warm_pool():
+    """Start the pool's processes now rather than on the first code block"""
+    pool = get_pool()
+    if pool is not None:
+        try:
+            pool.submit(_analyze_blocks, []).result(timeout=30)
+        except Exception as e:
+            logger.warning(f"Could not warm the code analysis pool: {str(e)}")
+
+
+def close_pool():
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _cache():
+    from django.core.cache import caches
+    return caches[settings.CHAT_CODE_ANALYSIS_CACHE_ALIAS]
+
+
+def _cache_key(hint, code):
+    digest = hashlib.sha256(f"{hint}\0{code}".encode('utf-8')).hexdigest()
+    return f'{CACHE_PREFIX}:{digest}'
+
+
+def _blocks_of(message):
+    if not settings.CHAT_CODE_ANALYSIS_ENABLED:
+        return []
+    blocks = extract_code_blocks(message)[:settings.CHAT_CODE_ANALYSIS_MAX_BLOCKS]
+    return [(hint, code[:settings.CHAT_CODE_ANALYSIS_MAX_CHARS]) for hint, code in blocks]
+
+
+def _cached(blocks):
+    """(results with None for misses, keys), a miss when the cache is down"""
+    keys = [_cache_key(hint, code) for hint, code in blocks]
+    try:
+        found = _cache().get_many(keys)
+    except Exception as e:
+        logger.warning(f"Code analysis cache unavailable: {str(e)}")
+        found = {}
+    return [found.get(key) for key in keys], keys
+
+
+def _store(keys, results, analysed):
+    try:
+        _cache().set_many({keys[i]: results[i] for i in analysed}, settings.CHAT_CODE_ANALYSIS_CACHE_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Code analysis cache unavailable: {str(e)}")
+
+
+def _numbered(results):
+    return [{'block': index + 1, **result} for index, result in enumerate(results)]
+
+
+def analyze_message(message):
+    """
+    Analyses of the code blocks of message (numbered from 1), served from
+    the cache where possible, or [] when there is no code or the analysis
+    did not finish in time
+    """
+    blocks = _blocks_of(message)
+    if not blocks:
+        return []
+
+    start = time.perf_counter()
+    results, keys = _cached(blocks)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        todo = [blocks[i] for i in missing]
+        pool = get_pool()
+        try:
+            if pool is None:
+                fresh = _analyze_blocks(todo)
+            else:
+                fresh = pool.submit(_analyze_blocks, todo).result(timeout=settings.CHAT_CODE_ANALYSIS_TIMEOUT)
+        except FutureTimeoutError:
+            logger.warning(f"Code analysis took over {settings.CHAT_CODE_ANALYSIS_TIMEOUT}s, skipped")
+            return []
+        except Exception as e:
+            logger.error(f"Code analysis failed: {str(e)}")
+            if pool is not None:
+                _discard_pool(pool)
+            return []
+        for i, result in zip(missing, fresh):
+            results[i] = result
+        _store(keys, results, missing)
+
+    logger.debug(f"Analysed {len(blocks)} code blocks in {time.perf_counter() - start:.4f}s")
+    return _numbered(results)
+
+
+async def aanalyze_message(message):
+    """
+    Async variant of analyze_message(). The cache calls and an inline
+    analysis (no pool) run in a thread, the loop is never blocked.
+    """
+    blocks = _blocks_of(message)
+    if not blocks:
+        return []
+    results, keys = await sync_to_async(_cached, thread_sensitive=False)(blocks)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        todo = [blocks[i] for i in missing]
+        pool = get_pool()
+        try:
+            if pool is None:
+                fresh = await sync_to_async(_analyze_blocks, thread_sensitive=False)(todo)
+            else:
+                fresh = await asyncio.wait_for(
+                    asyncio.wrap_future(pool.submit(_analyze_blocks, todo)),
+                    settings.CHAT_CODE_ANALYSIS_TIMEOUT
+                )
+        except asyncio.TimeoutError:
+            logger.warning(f"Code analysis took over {settings.CHAT_CODE_ANALYSIS_TIMEOUT}s, skipped")
+            return []
+        except Exception as e:
+            logger.error(f"Code analysis failed: {str(e)}")
+            if pool is not None:
+                _discard_pool(pool)
+            return []
+        for i, result in zip(missing, fresh):
+            results[i] = result
+        await sync_to_async(_store, thread_sensitive=False)(keys, results, missing)
+
+    return _numbered(results)
+
+
+def analyze_snippets(blocks, batch_size=20):
+    """
+    analyze_snippet() of many (hint, code) blocks, e.g. the files of an
+    uploaded archive. Cached like analyze_message(), the misses are spread
+    over the pool in batches of batch_size. Without a timeout: a review
+    waits for its files, a broken pool falls back to inline.
+    """
+    if not blocks:
+        return []
+    results, keys = _cached(blocks)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        todo = [blocks[i] for i in missing]
+        fresh = None
+        pool = get_pool()
+        if pool is not None:
+            batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+            try:
+                fresh = [result for batch in pool.map(_analyze_blocks, batches) for result in batch]
+            except Exception as e:
+                logger.error(f"Code analysis failed in the pool, analysing inline: {str(e)}")
+                _discard_pool(pool)
+        if fresh is None:
+            fresh = _analyze_blocks(todo)
+        for i, result in zip(missing, fresh):
+            results[i] = result
+        _store(keys, results, missing)
+    return results
+
+
+def _describe(analysis):
+    metrics = analysis['metrics']
+    parts = [analysis['language'], f"{metrics['lines']} lines"]
+    if 'functions' in metrics:
+        parts.append(f"functions: {metrics['functions']}, classes: {metrics['classes']}")
+    if 'max_complexity' in metrics:
+        parts.append(f"max complexity {metrics['max_complexity']} ({metrics['most_complex']})")
+    lines = [f"- block {analysis['block']}: " + ', '.join(parts)]
+
+    error = analysis['syntax_error']
+    if error:
+        lines.append(f"  syntax error at line {error['line']}, column {error['column']}: {error['message']}")
+    for finding in analysis['findings']:
+        lines.append(f"  line {finding['line']} {finding['code']}: {finding['message']}")
+    return lines
+
+
+def hints_message(analyses):
+    """Compact system message with the analyses, None without any"""
+    if not analyses:
+        return None
+    lines = ["Local static analysis of the code blocks in the user's next message (computed, exact):"]
+    for analysis in analyses:
+        lines.extend(_describe(analysis))
+    lines.append("Rely on it instead of re-deriving it, and mention syntax errors first.")
+    return '\n'.join(lines)
@@ -0,0 +1,539 @@
+"""
+Map-reduce review of uploaded code (POST /api/reviews/).
+
+- Upload: the members of a zip or tar archive, or the files of a multi-file
+  upload, are copied to a directory of their own under CHAT_REVIEW_DIR,
+  STREAM_BUFFER_SIZE bytes at a time, and fingerprinted (sha256) on the
+  way. Only source files are kept; paths leaving the directory and links
+  are dropped, binaries and files over CHAT_REVIEW_MAX_FILE_BYTES skipped.
+- Incremental: a file with the fingerprint of one the same session key had
+  reviewed before gets that file's findings, without a model call.
+- Map: the other files are split into chunks of about
+  CHAT_REVIEW_CHUNK_TOKENS, at top-level definitions (and the members of
+  top-level classes) for Python, at blank lines outside brackets otherwise.
+  The chunks are reviewed by the model on a thread pool, at most
+  concurrency at a time.
+- Reduce: each file's chunk findings and its local static analysis
+  (code_analysis.analyze_snippets) are merged into one list, stored as
+  soon as the file's last chunk is back.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.utils import timezone
+import ast
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import shutil
+import stat
+import tarfile
+import uuid
+import zipfile
+import zlib
+
+from ..models import CodeReview, ReviewedFile
+from .ai_service import CodingChatAI
+from .code_analysis import analyze_snippets, detect_language
+from .context_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+STREAM_BUFFER_SIZE = 64 * 1024
+# files of these extensions are reviewed, the extension is the language hint
+CODE_EXTENSIONS = {
+    'py', 'js', 'jsx', 'mjs', 'ts', 'tsx', 'java', 'kt', 'go', 'rs', 'rb', 'php', 'cs',
+    'c', 'h', 'cc', 'cpp', 'cxx', 'hpp', 'swift', 'scala', 'sql', 'sh',
+}
+# dependencies and build output, not the project's own code
+IGNORED_DIRS = {
+    '.git', '.hg', '.svn', 'node_modules', 'vendor', '__pycache__', '.venv', 'venv', '.tox',
+    'dist', 'build',
+}
+SEVERITIES = ['error', 'warning', 'info']
+MAX_FINDINGS_PER_CHUNK = 20
+# files read and analysed at a time while planning
+PLAN_BATCH_SIZE = 50
+ABANDONED_ERROR = 'Review was abandoned before this file was reviewed'
+
+
+class ReviewUploadError(Exception):
+    pass
+
+
+def _member_path(name):
+    """Relative path of an uploaded file, None if it would leave the upload directory"""
+    path = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    if path in ('', '.') or path == '..' or path.startswith('../'):
+        return None
+    return path
+
+
+def _is_source(path):
+    directories, _, filename = path.rpartition('/')
+    if any(part in IGNORED_DIRS for part in directories.split('/')):
+        return False
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in CODE_EXTENSIONS
+
+
+def _zip_members(archive):
+    for info in archive.infolist():
+        # symlinks are stored as files holding the target
+        if not info.is_dir() and not stat.S_ISLNK(info.external_attr >> 16):
+            yield info.filename, lambda info=info: archive.open(info)
+
+
+def _tar_members(archive):
+    for info in archive:
+        if info.isfile():
+            yield info.name, lambda info=info: archive.extractfile(info)
+
+
+def _archive_members(upload):
+    """(name, open function) of the regular files of a zip or tar upload"""
+    upload.seek(0)
+    if zipfile.is_zipfile(upload):
+        upload.seek(0)
+        return _zip_members(zipfile.ZipFile(upload))
+    upload.seek(0)
+    try:
+        return _tar_members(tarfile.open(fileobj=upload, mode='r:*'))
+    except tarfile.TarError:
+        raise ReviewUploadError("The archive is neither a zip file nor a tarball")
+
+
+def _copy(source, target):
+    """
+    Copy source to target, hashing it. Returns (fingerprint, size, reason),
+    with a reason (and target removed) when the file is not reviewed.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    reason = ''
+    with open(target, 'wb') as f:
+        while True:
+            data = source.read(STREAM_BUFFER_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if size > settings.CHAT_REVIEW_MAX_FILE_BYTES:
+                reason = f"larger than {settings.CHAT_REVIEW_MAX_FILE_BYTES} bytes"
+                break
+            if b'\0' in data:
+                reason = 'binary file'
+                break
+            digest.update(data)
+            f.write(data)
+    if reason:
+        os.remove(target)
+        return '', size, reason
+    return digest.hexdigest(), size, ''
+
+
+def store_upload(directory, archive=None, files=(), paths=()):
+    """
+    Copy the source files of an archive, or of files (named by paths when
+    given), to directory. Returns a dict per file: path, fingerprint, size,
+    language and the reason it is skipped, if it is. Raises
+    ReviewUploadError when the upload is over the limits or has no code.
+    """
+    if archive is not None:
+        members = _archive_members(archive)
+    else:
+        members = (
+            (paths[i] if i < len(paths) else upload.name, lambda upload=upload: upload)
+            for i, upload in enumerate(files)
+        )
+
+    try:
+        return _store_members(directory, members)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error) as e:
+        raise ReviewUploadError(f"The archive is damaged: {str(e)}")
+
+
+def _store_members(directory, members):
+    stored = {}
+    total = 0
+    for name, open_member in members:
+        path = _member_path(name)
+        if path is None or path in stored or not _is_source(path):
+            continue
+        if len(stored) >= settings.CHAT_REVIEW_MAX_FILES:
+            raise ReviewUploadError(f"More than {settings.CHAT_REVIEW_MAX_FILES} source files")
+
+        target = os.path.join(directory, *path.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open_member() as source:
+            fingerprint, size, reason = _copy(source, target)
+        total += size if not reason else 0
+        if total > settings.CHAT_REVIEW_MAX_TOTAL_BYTES:
+            raise ReviewUploadError(f"More than {settings.CHAT_REVIEW_MAX_TOTAL_BYTES} bytes of source code")
+
+        stored[path] = {
+            'path': path,
+            'fingerprint': fingerprint,
+            'size': size,
+            'language': detect_language('', path.rpartition('.')[2].lower()),
+            'reason': reason,
+        }
+
+    if not stored:
+        raise ReviewUploadError("No source files found in the upload")
+    return list(stored.values())
+
+
+def _python_units(code, line_count):
+    """Line ranges of the top-level statements and of the members of top-level classes"""
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+
+    starts = {1}
+    for node in tree.body:
+        nodes = [node] + (node.body if isinstance(node, ast.ClassDef) else [])
+        for member in nodes:
+            decorators = getattr(member, 'decorator_list', [])
+            starts.add(min([member.lineno] + [d.lineno for d in decorators]))
+    starts = sorted(start for start in starts if start <= line_count)
+    return [(start, end - 1) for start, end in zip(starts, starts[1:] + [line_count + 1])]
+
+
+def _block_units(lines):
+    """Line ranges separated by blank lines outside brackets"""
+    units = []
+    start = 1
+    depth = 0
+    for number, line in enumerate(lines, 1):
+        depth = max(0, depth + sum(line.count(c) for c in '{([') - sum(line.count(c) for c in '})]'))
+        if not line.strip() and depth == 0 and number > start:
+            units.append((start, number))
+            start = number + 1
+    if start <= len(lines):
+        units.append((start, len(lines)))
+    return units
+
+
+def _split_unit(lines, first, last, max_tokens):
+    ranges = []
+    start = first
+    tokens = 0
+    for number in range(first, last + 1):
+        line_tokens = count_tokens(lines[number - 1]) + 1
+        if tokens and tokens + line_tokens > max_tokens:
+            ranges.append((start, number - 1))
+            start, tokens = number, 0
+        tokens += line_tokens
+    ranges.append((start, last))
+    return ranges
+
+
+def chunk_ranges(code, language, max_tokens):
+    """
+    (first line, last line) of the chunks of a file, 1-based and inclusive.
+    Consecutive units are packed up to max_tokens, a unit over it is cut
+    at line boundaries.
+    """
+    lines = code.splitlines()
+    if not any(line.strip() for line in lines):
+        return []
+    units = _python_units(code, len(lines)) if language == 'python' else None
+    if units is None:
+        units = _block_units(lines)
+
+    chunks = []
+    current = None
+    tokens = 0
+    for first, last in units:
+        unit_tokens = count_tokens('\n'.join(lines[first - 1:last])) + 1
+        if current and tokens + unit_tokens <= max_tokens:
+            current = (current[0], last)
+            tokens += unit_tokens
+            continue
+        if current:
+            chunks.append(current)
+        if unit_tokens > max_tokens:
+            *parts, (current_first, current_last) = _split_unit(lines, first, last, max_tokens)
+            chunks.extend(parts)
+            current = (current_first, current_last)
+            tokens = count_tokens('\n'.join(lines[current_first - 1:current_last])) + 1
+        else:
+            current, tokens = (first, last), unit_tokens
+    chunks.append(current)
+    return chunks
+
+
+def _static_findings(analysis):
+    """Findings of a code_analysis result, in the report's format"""
+    findings = []
+    error = analysis['syntax_error']
+    if error:
+        findings.append({
+            'line': error['line'], 'severity': 'error', 'category': 'syntax-error',
+            'message': error['message'], 'source': 'static',
+        })
+    for finding in analysis['findings']:
+        findings.append({
+            'line': finding['line'], 'severity': 'warning', 'category': finding['code'],
+            'message': finding['message'], 'source': 'static',
+        })
+    return findings
+
+
+def parse_findings(ai_result, first_line, last_line):
+    """Findings of a review_chunk() answer, raises ValueError when it is not the JSON asked for"""
+    data = json.loads(ai_result['response'])
+    findings = data.get('findings') if isinstance(data, dict) else None
+    if not isinstance(findings, list):
+        raise ValueError("The review has no findings list")
+
+    parsed = []
+    for item in findings[:MAX_FINDINGS_PER_CHUNK]:
+        if not isinstance(item, dict) or not str(item.get('message') or '').strip():
+            continue
+        line = item.get('line')
+        parsed.append({
+            'line': line if isinstance(line, int) and first_line <= line <= last_line else None,
+            'severity': item.get('severity') if item.get('severity') in SEVERITIES else 'info',
+            'category': str(item.get('category') or 'general')[:40],
+            'message': str(item['message']).strip()[:1000],
+            'source': 'model',
+        })
+    return parsed
+
+
+def merge_findings(groups):
+    """The findings of groups as one list, repeats dropped, by line then severity"""
+    merged = []
+    seen = set()
+    for findings in groups:
+        for finding in findings:
+            key = (finding['line'], finding['message'].lower())
+            if key not in seen:
+                seen.add(key)
+                merged.append(finding)
+    merged.sort(key=lambda f: (f['line'] is None, f['line'] or 0, SEVERITIES.index(f['severity'])))
+    return merged
+
+
+def new_upload_directory():
+    directory = os.path.join(settings.CHAT_REVIEW_DIR, uuid.uuid4().hex)
+    os.makedirs(directory)
+    return directory
+
+
+def discard_upload(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class ReviewPlan:
+    """
+    The files of an upload, which are reused, skipped or reviewed, and the
+    chunks to review: everything known before a model is called, so the
+    review can be admitted (and refused) on its chunk count.
+    """
+
+    def __init__(self, session_key, name, directory, files):
+        self.session_key = session_key
+        self.name = name
+        self.directory = directory
+        self.files = files
+        # (file index, first line, last line)
+        self.chunks = []
+
+    @classmethod
+    def prepare(cls, session_key, name, directory, files):
+        plan = cls(session_key, name, directory, files)
+        plan._reuse()
+        pending = [i for i, file in enumerate(files) if file['status'] == ReviewedFile.STATUS_PENDING]
+        for start in range(0, len(pending), PLAN_BATCH_SIZE):
+            plan._plan_batch(pending[start:start + PLAN_BATCH_SIZE])
+        return plan
+
+    def _reuse(self):
+        fingerprints = {file['fingerprint'] for file in self.files if not file['reason']}
+        previous = {}
+        for reviewed in ReviewedFile.objects.filter(
+            review__session_key=self.session_key, review__deleted_at__isnull=True, fingerprint__in=fingerprints,
+            status=ReviewedFile.STATUS_COMPLETE
+        ).order_by('review__created_at').only('fingerprint', 'findings', 'chunk_count'):
+            # the latest review of the content wins
+            previous[reviewed.fingerprint] = reviewed
+
+        for file in self.files:
+            file.update({'status': ReviewedFile.STATUS_PENDING, 'reused': False, 'findings': [], 'chunks': 0})
+            if file['reason']:
+                file['status'] = ReviewedFile.STATUS_SKIPPED
+            elif file['fingerprint'] in previous:
+                reviewed = previous[file['fingerprint']]
+                file.update({
+                    'status': ReviewedFile.STATUS_COMPLETE, 'reused': True,
+                    'findings': reviewed.findings, 'chunks': reviewed.chunk_count,
+                })
+
+    def _plan_batch(self, indexes):
+        codes = {}
+        for i in indexes:
+            try:
+                codes[i] = self.read(i)
+            except UnicodeDecodeError:
+                self.files[i].update({'status': ReviewedFile.STATUS_SKIPPED, 'reason': 'not UTF-8 text'})
+
+        analyses = analyze_snippets([(self.files[i]['language'], code) for i, code in codes.items()])
+        for (i, code), analysis in zip(codes.items(), analyses):
+            file = self.files[i]
+            file['findings'] = _static_findings(analysis)
+            ranges = chunk_ranges(code, file['language'], settings.CHAT_REVIEW_CHUNK_TOKENS)
+            file['chunks'] = len(ranges)
+            self.chunks.extend((i, first, last) for first, last in ranges)
+
+    def read(self, index, first=None, last=None):
+        """Content of the index-th file, lines first..last only if given"""
+        path = os.path.join(self.directory, *self.files[index]['path'].split('/'))
+        with open(path, encoding='utf-8') as f:
+            code = f.read()
+        if first is None:
+            return code
+        return '\n'.join(code.splitlines()[first - 1:last])
+
+    def start(self):
+        """Store the review and its files, returns the CodeReview"""
+        review = CodeReview.objects.create(
+            session_key=self.session_key, name=self.name[:255], file_count=len(self.files),
+            chunk_count=len(self.chunks)
+        )
+        rows = ReviewedFile.objects.bulk_create([
+            ReviewedFile(
+                review=review, path=file['path'][:500], fingerprint=file['fingerprint'],
+                size=file['size'], language=file['language'][:20], status=file['status'],
+                reused=file['reused'], chunk_count=file['chunks'], findings=file['findings'],
+                detail=file['reason']
+            )
+            for file in self.files
+        ])
+        for file, row in zip(self.files, rows):
+            file['row'] = row
+        return review
+
+    def discard(self):
+        discard_upload(self.directory)
+
+
+def _review_chunk(ai_service, plan, chunk):
+    index, first, last = chunk
+    file = plan.files[index]
+    known = [
+        f"line {finding['line']}: {finding['message']}"
+        for finding in file['findings'] if finding['line'] and first <= finding['line'] <= last
+    ]
+    return ai_service.review_chunk(file['path'], file['language'], plan.read(index, first, last), first, known)
+
+
+def _result_of(future):
+    try:
+        return future.result()
+    except Exception as e:
+        # review_chunk reports its own failures, this is a bug
+        logger.error(f"Chunk review failed unexpectedly: {str(e)}")
+        return {'response': '', 'error': str(e), 'success': False}
+
+
+def _finish_file(file, groups, errors):
+    row = file['row']
+    row.findings = merge_findings([file['findings']] + groups)
+    if errors:
+        row.status = ReviewedFile.STATUS_FAILED
+        row.detail = '; '.join(sorted(set(errors)))[:2000]
+    else:
+        row.status = ReviewedFile.STATUS_COMPLETE
+    row.save(update_fields=['findings', 'status', 'detail'])
+    return row
+
+
+def _finish_review(review, plan, tokens_used):
+    rows = [file['row'] for file in plan.files]
+    statuses = Counter(row.status for row in rows)
+    review.reused_count = sum(1 for row in rows if row.reused)
+    review.reviewed_count = statuses[ReviewedFile.STATUS_COMPLETE] - review.reused_count
+    review.skipped_count = statuses[ReviewedFile.STATUS_SKIPPED]
+    review.failed_count = statuses[ReviewedFile.STATUS_FAILED]
+    review.tokens_used = tokens_used
+    if review.failed_count and not review.reviewed_count and not review.reused_count:
+        review.status = CodeReview.STATUS_FAILED
+    else:
+        review.status = CodeReview.STATUS_COMPLETE
+    review.completed_at = timezone.now()
+    review.save()
+
+
+def run_review(plan, review, concurrency, permit=None):
+    """
+    Review the chunks of plan.start()'s review with at most concurrency
+    model calls in flight. Yields each ReviewedFile once it is final: the
+    reused and skipped ones first, the others as their last chunk comes
+    back. The admission permit, if any, is charged the tokens used and
+    released at the end, and the upload directory removed.
+
+    Closing the generator early (e.g. the client of a streamed review went
+    away) lets the running chunks finish and fails the files of the ones
+    not started.
+    """
+    ai_service = CodingChatAI()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='code-review')
+    futures = {executor.submit(_review_chunk, ai_service, plan, chunk): chunk for chunk in plan.chunks}
+    remaining = {}
+    for index, _, _ in plan.chunks:
+        remaining[index] = remaining.get(index, 0) + 1
+    groups = {index: [] for index in remaining}
+    errors = {index: [] for index in remaining}
+    handled = set()
+    tokens_used = 0
+
+    def collect(future, ai_result):
+        nonlocal tokens_used
+        index, first, last = futures[future]
+        handled.add(future)
+        tokens_used += ai_result.get('tokens_used') or 0
+        if permit is not None:
+            permit.charge(ai_result.get('tokens_used'))
+        if ai_result['success']:
+            try:
+                groups[index].append(parse_findings(ai_result, first, last))
+            except ValueError as e:
+                errors[index].append(f"Unreadable review of lines {first}-{last}: {str(e)}")
+        else:
+            errors[index].append(ai_result['error'])
+        remaining[index] -= 1
+        if not remaining[index]:
+            return _finish_file(plan.files[index], groups[index], errors[index])
+        return None
+
+    try:
+        for index, file in enumerate(plan.files):
+            if index not in remaining:
+                if file['status'] == ReviewedFile.STATUS_PENDING:
+                    # nothing to send, e.g. an empty file
+                    _finish_file(file, [], [])
+                yield file['row']
+
+        for future in as_completed(futures):
+            row = collect(future, _result_of(future))
+            if row is not None:
+                yield row
+    finally:
+        for future in futures:
+            if future in handled:
+                continue
+            if future.cancel():
+                ai_result = {'response': '', 'error': ABANDONED_ERROR, 'success': False}
+            else:
+                ai_result = _result_of(future)
+            collect(future, ai_result)
+        executor.shutdown(wait=False)
+        _finish_review(review, plan, tokens_used)
+        plan.discard()
+        if permit is not None:
+            permit.release()
@@ -0,0 +1,136 @@
+"""
+Diff-aware prompts for revised code.
+
+The usual review loop is paste code, get feedback, paste the fixed version:
+sent as is, every round adds another full copy of the file to the prompt.
+compact_revisions() goes through the code blocks of the turns that make it
+into the prompt, oldest first. A block at least
+CHAT_REVISION_MIN_SIMILARITY similar (difflib, line by line) to a block
+sent in full earlier in the same prompt is replaced by a reference to that
+block and a unified diff against it, when the diff is at most
+CHAT_REVISION_MAX_DIFF_RATIO of the block's tokens.
+
+Blocks are only diffed against blocks sent in full, so the model never has
+to apply a diff on top of a diff. The stored messages keep their full text.
+
+Only the prompt window is searched for a base, not the session's older
+stored messages: the model sees nothing else, and a diff against a block it
+can't see is of no use to it. So when the earlier version has been packed
+out of the window, the revision goes in full once (about 870 tokens instead
+of about 360 for the 150-line file of the README's example) and is the base
+of the revisions after it.
+"""
+from difflib import SequenceMatcher, unified_diff
+from django.conf import settings
+import copy
+import logging
+
+from .code_analysis import FENCE_RE
+from .context_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# characters of a message quoted to refer to it
+REFERENCE_CHARS = 50
+
+
+class _Base:
+    """A code block sent in full, later blocks may be diffed against it"""
+
+    def __init__(self, reference, hint, lines):
+        self.reference = reference
+        self.hint = hint
+        self.lines = lines
+
+
+def _reference(message_type, text, index):
+    quoted = ' '.join(FENCE_RE.sub('', text).split())[:REFERENCE_CHARS] or '(code only)'
+    speaker = 'my message' if message_type == 'user' else 'your reply'
+    return f'code block {index} of {speaker} starting "{quoted}"'
+
+
+def _similarity(base, lines):
+    matcher = SequenceMatcher(None, base.lines, lines, autojunk=False)
+    threshold = settings.CHAT_REVISION_MIN_SIMILARITY
+    # the cheap upper bounds rule most pairs out before the real ratio
+    if matcher.real_quick_ratio() < threshold or matcher.quick_ratio() < threshold:
+        return 0
+    return matcher.ratio()
+
+
+def find_base(hint, lines, bases):
+    """The block of bases lines is most similar to, None below the threshold"""
+    best, best_ratio = None, 0
+    for base in bases:
+        if hint and base.hint and hint != base.hint:
+            continue
+        ratio = _similarity(base, lines)
+        if ratio >= settings.CHAT_REVISION_MIN_SIMILARITY and ratio > best_ratio:
+            best, best_ratio = base, ratio
+    return best
+
+
+def _diff_block(base, lines):
+    diff = list(unified_diff(base.lines, lines, 'before', 'after', n=3, lineterm=''))
+    if not diff:
+        return f"(the same code as {base.reference}, unchanged)"
+    body = '\n'.join(diff)
+    return f"(revised version of {base.reference}, as a unified diff against it:)\n```diff\n{body}\n```"
+
+
+def _compact(message_type, text, bases):
+    """text with its revised blocks replaced by diffs, and the tokens saved"""
+    pieces = []
+    position = 0
+    saved = 0
+    for index, match in enumerate(FENCE_RE.finditer(text), 1):
+        hint, code = match.group(1).lower(), match.group(2)
+        lines = code.splitlines()
+        if len(lines) < settings.CHAT_REVISION_MIN_LINES:
+            continue
+
+        base = find_base(hint, lines, bases)
+        if base is not None:
+            replacement = _diff_block(base, lines)
+            full_tokens = count_tokens(match.group(0))
+            diff_tokens = count_tokens(replacement)
+            if diff_tokens <= full_tokens * settings.CHAT_REVISION_MAX_DIFF_RATIO:
+                pieces.append(text[position:match.start()])
+                pieces.append(replacement)
+                position = match.end()
+                saved += full_tokens - diff_tokens
+                continue
+        bases.append(_Base(_reference(message_type, text, index), hint, lines))
+
+    if not pieces:
+        return text, 0
+    pieces.append(text[position:])
+    return ''.join(pieces), saved
+
+
+def compact_revisions(user_message, conversation_history):
+    """
+    (user_message, conversation_history, tokens saved) with the revised
+    code blocks replaced by diffs. conversation_history is what goes into
+    the prompt, oldest first; changed turns are copies, the messages passed
+    in are left alone.
+    """
+    if not settings.CHAT_REVISION_DIFFS_ENABLED:
+        return user_message, conversation_history, 0
+
+    bases = []
+    history = []
+    saved = 0
+    for msg in conversation_history:
+        content, msg_saved = _compact(msg.message_type, msg.content, bases)
+        if msg_saved:
+            msg = copy.copy(msg)
+            msg.content = content
+            saved += msg_saved
+        history.append(msg)
+
+    user_message, msg_saved = _compact('user', user_message, bases)
+    saved += msg_saved
+    if saved:
+        logger.debug(f"Sent revised code as diffs, {saved} prompt tokens saved")
+    return user_message, history, saved
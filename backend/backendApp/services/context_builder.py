@@ -0,0 +1,70 @@
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """tiktoken encoding for the chat model, or None to use the estimate"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(settings.CHAT_TOKENIZER_ENCODING)
+        except Exception as e:
+            # not installed, or the encoding file could not be fetched
+            logger.warning(f"tiktoken unavailable, estimating token counts: {str(e)}")
+            _encoding = None
+    return _encoding
+
+
+def count_tokens(text):
+    """Count tokens locally, falling back to ~4 characters per token"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def message_tokens(msg):
+    return count_tokens(msg.content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def pack_history(conversation_history, budget=None):
+    """
+    Split chronologically ordered messages into (included, dropped).
+
+    included holds as many of the most recent messages as fit in budget
+    tokens (CHAT_HISTORY_TOKEN_BUDGET by default), dropped the older ones,
+    both oldest first. The budget only depends on the history itself, so
+    packing the same history always gives the same window.
+    """
+    if budget is None:
+        budget = settings.CHAT_HISTORY_TOKEN_BUDGET
+
+    history = list(conversation_history or [])
+    used = 0
+    start = len(history)
+
+    while start > 0:
+        cost = message_tokens(history[start - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+
+    return history[start:], history[:start]
+
+
+def unsummarized(dropped, summary_until):
+    """The dropped messages not yet folded into a summary covering up to summary_until"""
+    if summary_until is None:
+        return list(dropped)
+    return [msg for msg in dropped if msg.created_at > summary_until]
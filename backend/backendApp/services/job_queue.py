@@ -0,0 +1,222 @@
+"""
+DB-backed queue of AI replies for ?async=1 requests.
+
+The web request stores the exchange, enqueues a ChatJob and answers 202.
+run_chat_worker processes claim jobs and complete the pending assistant
+message, which clients long-poll through GET /api/messages/{id}/?wait=.
+No broker: on Postgres workers claim with SELECT ... FOR UPDATE SKIP
+LOCKED, on SQLite with a compare-and-set UPDATE (writes are serialized).
+
+A claimed job is leased for CHAT_JOB_VISIBILITY_TIMEOUT seconds. If its
+worker dies the lease runs out and another worker claims it again. Failed
+attempts with a transient cause are re-queued with a growing delay, up to
+CHAT_JOB_MAX_ATTEMPTS attempts.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+import asyncio
+import logging
+import time
+
+from ..models import ChatJob, ChatMessage
+from .admission import admit_job
+from .ai_service import CodingChatAI
+from .chat_service import complete_exchange, load_context_window, update_rolling_summary
+
+logger = logging.getLogger(__name__)
+
+# SQLite: candidates tried per claim before giving up until the next poll
+CLAIM_CANDIDATES = 5
+LONG_POLL_MIN_INTERVAL = 0.1
+LONG_POLL_MAX_INTERVAL = 1.0
+
+GAVE_UP_RESPONSE = "I couldn't finish this response. Please try again."
+
+
+def enqueue_reply(user_msg, assistant_msg):
+    """Queue the generation of assistant_msg, the pending reply to user_msg"""
+    return ChatJob.objects.create(
+        user_message=user_msg,
+        assistant_message=assistant_msg,
+        available_at=timezone.now()
+    )
+
+
+def _claimable(now):
+    # queued and due, or running with an expired lease
+    return ChatJob.objects.filter(
+        Q(status=ChatJob.STATUS_QUEUED, available_at__lte=now) |
+        Q(status=ChatJob.STATUS_RUNNING, locked_until__lt=now)
+    ).order_by('available_at')
+
+
+def claim_job(worker_id):
+    """Lease the next due job to worker_id and return it, or None"""
+    now = timezone.now()
+    lease = {
+        'status': ChatJob.STATUS_RUNNING,
+        'attempts': F('attempts') + 1,
+        'locked_by': worker_id,
+        'locked_until': now + timedelta(seconds=settings.CHAT_JOB_VISIBILITY_TIMEOUT),
+        'updated_at': now,
+    }
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = _claimable(now).select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            ChatJob.objects.filter(pk=job.pk).update(**lease)
+    else:
+        # no row locks, the update only matches if nobody claimed the job
+        # since we read it (claiming bumps attempts)
+        for job in _claimable(now)[:CLAIM_CANDIDATES]:
+            if _claimable(now).filter(pk=job.pk, attempts=job.attempts).update(**lease):
+                break
+        else:
+            return None
+
+    return ChatJob.objects.select_related(
+        'user_message', 'assistant_message__session'
+    ).get(pk=job.pk)
+
+
+def _retry_delay(attempts):
+    return settings.CHAT_JOB_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def _settle(job, worker_id, status, ai_result=None, error=''):
+    """
+    Finish or re-queue a job and store its reply, as long as worker_id still
+    holds the lease. Returns False when the lease was lost to another worker.
+    """
+    now = timezone.now()
+    updates = {
+        'status': status,
+        'locked_by': '',
+        'locked_until': None,
+        'last_error': error,
+        'updated_at': now,
+    }
+    if status == ChatJob.STATUS_QUEUED:
+        updates['available_at'] = now + timedelta(seconds=_retry_delay(job.attempts))
+
+    with transaction.atomic():
+        held = ChatJob.objects.filter(
+            pk=job.pk,
+            status=ChatJob.STATUS_RUNNING,
+            locked_by=worker_id,
+            attempts=job.attempts
+        ).update(**updates)
+        if held and ai_result is not None:
+            complete_exchange(job.assistant_message, ai_result)
+
+    if not held:
+        logger.warning(f"Job {job.id} was claimed by another worker, dropping attempt {job.attempts}")
+    return bool(held)
+
+
+def generate_reply(job):
+    """AI result for the job's user message, see CodingChatAI.get_response"""
+    user_msg = job.user_message
+    session = job.assistant_message.session
+    # later exchanges of the session may be stored already, leave them out
+    conversation_history = load_context_window(session, before=user_msg.created_at)
+
+    # a job waiting too long for an upstream slot is re-queued like a timeout
+    with admit_job(session.session_key, timeout=settings.CHAT_JOB_VISIBILITY_TIMEOUT / 2) as permit:
+        summary = update_rolling_summary(session, conversation_history)
+        ai_result = CodingChatAI().get_response(
+            user_msg.content, conversation_history,
+            use_cache=session.response_cache_enabled, summary=summary
+        )
+        permit.charge(ai_result.get('tokens_used'))
+    return ai_result
+
+
+def run_job(job, worker_id):
+    """Run a claimed job, returns the status it was settled with"""
+    if job.assistant_message.status != ChatMessage.STATUS_PENDING:
+        # settled some other way, e.g. by reconcile_pending_messages
+        _settle(job, worker_id, ChatJob.STATUS_DONE)
+        return ChatJob.STATUS_DONE
+
+    if job.attempts > settings.CHAT_JOB_MAX_ATTEMPTS:
+        # the previous workers died or overran their lease
+        error = f"Gave up after {job.attempts - 1} attempts"
+        _settle(job, worker_id, ChatJob.STATUS_FAILED, {
+            'response': GAVE_UP_RESPONSE, 'error': error, 'success': False
+        }, error=error)
+        return ChatJob.STATUS_FAILED
+
+    try:
+        ai_result = generate_reply(job)
+    except Exception as e:
+        logger.error(f"Job {job.id} attempt {job.attempts} failed: {str(e)}")
+        ai_result = {
+            'response': "I encountered an unexpected error. Please try again.",
+            'error': str(e),
+            'transient': True,
+            'success': False
+        }
+
+    if ai_result['success']:
+        status = ChatJob.STATUS_DONE
+    elif ai_result.get('transient') and job.attempts < settings.CHAT_JOB_MAX_ATTEMPTS:
+        # the message stays pending until a later attempt
+        _settle(job, worker_id, ChatJob.STATUS_QUEUED, error=ai_result.get('error') or '')
+        return ChatJob.STATUS_QUEUED
+    else:
+        status = ChatJob.STATUS_FAILED
+
+    _settle(job, worker_id, status, ai_result, error=ai_result.get('error') or '')
+    return status
+
+
+def run_next_job(worker_id):
+    """Claim and run one job, False when none was due"""
+    job = claim_job(worker_id)
+    if job is None:
+        return False
+    run_job(job, worker_id)
+    return True
+
+
+def _long_poll_delays(timeout):
+    """Sleeps between polls, backing off, adding up to timeout seconds"""
+    deadline = time.monotonic() + min(timeout, settings.CHAT_LONG_POLL_MAX_WAIT)
+    delay = LONG_POLL_MIN_INTERVAL
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, LONG_POLL_MAX_INTERVAL)
+
+
+def wait_for_message(queryset, timeout):
+    """
+    The message of queryset (None if there is none), once it is no longer
+    pending or after timeout seconds, whichever comes first
+    """
+    message = queryset.first()
+    for delay in _long_poll_delays(timeout):
+        if message is None or message.status != ChatMessage.STATUS_PENDING:
+            break
+        time.sleep(delay)
+        message = queryset.first()
+    return message
+
+
+async def await_message(queryset, timeout):
+    """Async variant of wait_for_message(), no thread is held while waiting"""
+    message = await queryset.afirst()
+    for delay in _long_poll_delays(timeout):
+        if message is None or message.status != ChatMessage.STATUS_PENDING:
+            break
+        await asyncio.sleep(delay)
+        message = await queryset.afirst()
+    return message
@@ -0,0 +1,158 @@
+"""
+Process-wide OpenAI clients.
+
+One sync and one async client per worker process, created lazily on first
+use, each with its own tuned httpx connection pool so requests reuse warm
+keep-alive connections instead of paying for TCP and TLS setup. Workers
+forked from a process that already had clients get fresh ones, sockets
+are never shared across processes.
+
+gunicorn.conf.py warms the sync client when a worker boots and closes the
+clients when it exits. The async client's connections belong to the event
+loop that opened them, so it is warmed and closed by the ASGI lifespan
+handler in backend/asgi.py, inside the worker's loop.
+"""
+from django.conf import settings
+import asyncio
+import logging
+import os
+import threading
+
+import httpx
+import openai
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+_owner_pid = None
+
+
+def _http2_enabled():
+    if not settings.OPENAI_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("OPENAI_HTTP2 is set but the h2 package is missing, using HTTP/1.1")
+        return False
+    return True
+
+
+def _pool_options():
+    return {
+        'limits': httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        'http2': _http2_enabled(),
+        # per-request timeouts are set by ResilientCaller
+        'timeout': httpx.Timeout(settings.CHAT_LLM_ATTEMPT_TIMEOUT, connect=10.0),
+    }
+
+
+def _client_options():
+    return {
+        'api_key': settings.OPENAI_API_KEY,
+        'base_url': settings.OPENAI_BASE_URL,
+        # retries are done by ResilientCaller
+        'max_retries': 0,
+    }
+
+
+def _check_owner():
+    """Drop clients inherited from the parent process across a fork"""
+    global _client, _async_client, _owner_pid
+    if _owner_pid != os.getpid():
+        _client = None
+        _async_client = None
+        _owner_pid = os.getpid()
+
+
+def get_client():
+    """The worker's shared openai.OpenAI client"""
+    global _client
+    if _client is None or _owner_pid != os.getpid():
+        with _lock:
+            _check_owner()
+            if _client is None:
+                _client = openai.OpenAI(
+                    http_client=httpx.Client(**_pool_options()),
+                    **_client_options()
+                )
+    return _client
+
+
+def get_async_client():
+    """
+    The worker's shared openai.AsyncOpenAI client, for the ASGI views.
+    Concurrent requests share its connection pool.
+    """
+    global _async_client
+    if _async_client is None or _owner_pid != os.getpid():
+        with _lock:
+            _check_owner()
+            if _async_client is None:
+                _async_client = openai.AsyncOpenAI(
+                    http_client=httpx.AsyncClient(**_pool_options()),
+                    **_client_options()
+                )
+    return _async_client
+
+
+def warm_clients(connect=None):
+    """
+    Create the sync client and, if connect (OPENAI_WARMUP_REQUEST by
+    default), open a pooled connection with a cheap GET /models so the first
+    chat request does not pay for the handshake. See awarm_async_client()
+    for the async client.
+    """
+    if connect is None:
+        connect = settings.OPENAI_WARMUP_REQUEST
+    try:
+        client = get_client()
+        if connect:
+            client.with_options(timeout=5.0).models.list()
+    except Exception as e:
+        # e.g. no API key configured, requests will report the error
+        logger.warning(f"OpenAI client warm-up failed: {str(e)}")
+
+
+async def awarm_async_client(connect=None):
+    """warm_clients() for the async client, run in the loop that will use it"""
+    if connect is None:
+        connect = settings.OPENAI_WARMUP_REQUEST
+    try:
+        client = get_async_client()
+        if connect:
+            await client.with_options(timeout=5.0).models.list()
+    except Exception as e:
+        logger.warning(f"Async OpenAI client warm-up failed: {str(e)}")
+
+
+async def aclose_async_client():
+    """Close the async client in the loop its connections belong to"""
+    global _async_client
+    with _lock:
+        async_client, _async_client = _async_client, None
+    if async_client is not None:
+        await async_client.close()
+
+
+def close_clients():
+    """Close the pooled connections, e.g. when a worker exits"""
+    global _client, _async_client
+    with _lock:
+        client, async_client = _client, _async_client
+        _client = _async_client = None
+
+    if client is not None:
+        client.close()
+    if async_client is not None:
+        try:
+            asyncio.run(async_client.close())
+        except Exception as e:
+            # e.g. called with the worker's event loop still running
+            logger.warning(f"Could not close the async OpenAI client: {str(e)}")
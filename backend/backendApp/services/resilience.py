@@ -0,0 +1,322 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import openai
+
+from ..metrics import LLM_FAILURES, LLM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class CircuitOpenError(Exception):
+    """The upstream failed too often recently, calls are refused without trying"""
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before a call succeeded"""
+
+
+def is_retryable(error):
+    """Timeouts, connection errors, 408/409/429 and 5xx are worth another attempt"""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def is_transient(error):
+    """Errors a later request may not hit, e.g. worth re-queueing a job for"""
+    return is_retryable(error) or isinstance(error, (CircuitOpenError, DeadlineExceeded))
+
+
+def classify_error(error):
+    """Short failure reason stored with failed messages and used as metric label"""
+    if isinstance(error, CircuitOpenError):
+        return 'circuit_open'
+    if isinstance(error, (DeadlineExceeded, openai.APITimeoutError)):
+        return 'timeout'
+    if isinstance(error, openai.RateLimitError):
+        return 'rate_limited'
+    if isinstance(error, openai.APIError):
+        return 'upstream_error'
+    return 'unexpected'
+
+
+class Deadline:
+    """Time budget for one request, shared by all of its attempts"""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+class CircuitBreaker:
+    """
+    Per-process circuit breaker.
+
+    Closed: calls go through. After failure_threshold consecutive retryable
+    failures it opens and refuses calls for reset_timeout seconds. Then it
+    is half open: one trial call is let through, closing the circuit if it
+    succeeds and opening it again if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"OpenAI circuit opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Latencies of recent successful calls, for picking the hedging delay"""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p, min_samples):
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+class ResilientCaller:
+    """
+    Runs calls to the OpenAI API under a deadline, with bounded jittered
+    retries, a circuit breaker and optional hedging.
+
+    The call is a function taking the timeout of the attempt in seconds and
+    doing one request (a coroutine function for acall). Retryable errors are
+    retried with full-jitter exponential backoff, honouring Retry-After,
+    as long as the deadline allows. With hedge=True and CHAT_LLM_HEDGE_ENABLED,
+    an attempt still running after the CHAT_LLM_HEDGE_PERCENTILE latency of
+    recent calls gets a second, concurrent attempt and the first success wins.
+    """
+
+    def __init__(self):
+        self.max_attempts = settings.CHAT_LLM_MAX_ATTEMPTS
+        self.attempt_timeout = settings.CHAT_LLM_ATTEMPT_TIMEOUT
+        self.base_delay = settings.CHAT_LLM_RETRY_BASE_DELAY
+        self.max_delay = settings.CHAT_LLM_RETRY_MAX_DELAY
+        self.breaker = CircuitBreaker(
+            settings.CHAT_LLM_BREAKER_FAILURES,
+            settings.CHAT_LLM_BREAKER_RESET_TIMEOUT
+        )
+        self.latencies = LatencyTracker()
+        # starts its threads on the first hedged call, not here
+        self._hedge_pool = ThreadPoolExecutor(
+            max_workers=settings.CHAT_LLM_HEDGE_MAX_THREADS, thread_name_prefix='llm-hedge'
+        )
+
+    def new_deadline(self):
+        return Deadline(settings.CHAT_LLM_DEADLINE)
+
+    def call(self, func, deadline=None, hedge=False):
+        deadline = deadline or self.new_deadline()
+        attempt = 0
+        while True:
+            timeout = self._next_timeout(deadline)
+            start = time.monotonic()
+            try:
+                result = self._hedged(func, timeout) if hedge else func(timeout)
+            except Exception as e:
+                delay = self._after_failure(e, attempt, deadline)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._after_success(time.monotonic() - start)
+            return result
+
+    async def acall(self, func, deadline=None, hedge=False):
+        deadline = deadline or self.new_deadline()
+        attempt = 0
+        while True:
+            timeout = self._next_timeout(deadline)
+            start = time.monotonic()
+            try:
+                result = await (self._ahedged(func, timeout) if hedge else func(timeout))
+            except Exception as e:
+                delay = self._after_failure(e, attempt, deadline)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._after_success(time.monotonic() - start)
+            return result
+
+    def _next_timeout(self, deadline):
+        if not self.breaker.allow():
+            raise CircuitOpenError("OpenAI is failing, not calling it for a while")
+        timeout = min(self.attempt_timeout, deadline.remaining())
+        if timeout <= 0:
+            raise DeadlineExceeded("No time left for another attempt")
+        return timeout
+
+    def _after_success(self, elapsed):
+        self.breaker.record_success()
+        self.latencies.observe(elapsed)
+
+    def _after_failure(self, error, attempt, deadline):
+        """Seconds to wait before the next attempt, or re-raise when giving up"""
+        if not is_retryable(error):
+            # the upstream answered, e.g. a bad request, it is not unhealthy
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+
+        if attempt + 1 >= self.max_attempts:
+            raise error
+        delay = self._backoff(attempt, error)
+        if delay >= deadline.remaining():
+            raise DeadlineExceeded(f"Deadline reached after {attempt + 1} attempts: {error}") from error
+
+        LLM_RETRIES.labels(classify_error(error)).inc()
+        logger.warning(f"Retrying OpenAI call in {delay:.2f}s after: {str(error)}")
+        return delay
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        try:
+            return max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            return delay
+
+    def _hedge_delay(self, timeout):
+        if not settings.CHAT_LLM_HEDGE_ENABLED:
+            return None
+        delay = self.latencies.percentile(
+            settings.CHAT_LLM_HEDGE_PERCENTILE, settings.CHAT_LLM_HEDGE_MIN_SAMPLES
+        )
+        if delay is None or delay >= timeout:
+            return None
+        return delay
+
+    def _hedged(self, func, timeout):
+        delay = self._hedge_delay(timeout)
+        if delay is None:
+            return func(timeout)
+
+        pending = {self._hedge_pool.submit(func, timeout)}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            # the losing attempt cannot be interrupted, it finishes in the background
+            pending.add(self._hedge_pool.submit(func, timeout - delay))
+
+        error = None
+        while done or pending:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        raise error
+
+    async def _ahedged(self, func, timeout):
+        delay = self._hedge_delay(timeout)
+        if delay is None:
+            return await func(timeout)
+
+        pending = {asyncio.ensure_future(func(timeout))}
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            pending.add(asyncio.ensure_future(func(timeout - delay)))
+
+        error = None
+        try:
+            while done or pending:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+_recorded_lock = threading.Lock()
+
+
+def record_failure(error):
+    """
+    Count a failed call and return its reason. SingleFlight re-raises the
+    leader's exception in every caller that waited on it, the failure is
+    only counted for the first of them.
+    """
+    reason = classify_error(error)
+    with _recorded_lock:
+        recorded = getattr(error, '_failure_recorded', False)
+        error._failure_recorded = True
+    if not recorded:
+        LLM_FAILURES.labels(reason).inc()
+    return reason
+
+
+_caller = None
+
+
+def get_resilient_caller():
+    """The process-wide ResilientCaller, so the breaker sees every request"""
+    global _caller
+    if _caller is None:
+        _caller = ResilientCaller()
+    return _caller
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.core.cache import caches
+import hashlib
+import json
+import logging
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_content(content):
+    lines = content.replace('\r\n', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+
+def prompt_hash(messages, model, params):
+    """sha256 of the normalized message list plus the model parameters"""
+    payload = json.dumps({
+        'model': model,
+        'params': params,
+        'messages': [
+            {'role': m['role'], 'content': normalize_content(m['content'])}
+            for m in messages
+        ],
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of AI responses keyed by the prompt that produced them.
+
+    Backed by Django's cache framework (the CHAT_RESPONSE_CACHE_ALIAS cache),
+    so size bound, TTL and eviction come from its CACHES entry and the
+    backend can be swapped for a shared one (Redis, database) in settings.
+    Hits and misses are counted in the chat_response_cache_lookups_total
+    Prometheus counter, not in the cache: the default LocMemCache is per
+    process, and its entries can be evicted like any cached response.
+    """
+    KEY_PREFIX = 'chat-response:v1'
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or settings.CHAT_RESPONSE_CACHE_ALIAS]
+
+    def make_key(self, messages, model, params):
+        return f"{self.KEY_PREFIX}:{prompt_hash(messages, model, params)}"
+
+    def get(self, key):
+        try:
+            cached = self.cache.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {str(e)}")
+            return None
+        self._count(cached)
+        return cached
+
+    def set(self, key, ai_result):
+        """Store a successful AI result, failures are never cached"""
+        if not ai_result.get('success'):
+            return
+        try:
+            self.cache.set(key, {
+                'response': ai_result['response'],
+                'tokens_used': ai_result.get('tokens_used'),
+            })
+        except Exception as e:
+            logger.warning(f"Response cache store failed: {str(e)}")
+
+    async def aget(self, key):
+        try:
+            cached = await self.cache.aget(key)
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {str(e)}")
+            return None
+        self._count(cached)
+        return cached
+
+    async def aset(self, key, ai_result):
+        if not ai_result.get('success'):
+            return
+        try:
+            await self.cache.aset(key, {
+                'response': ai_result['response'],
+                'tokens_used': ai_result.get('tokens_used'),
+            })
+        except Exception as e:
+            logger.warning(f"Response cache store failed: {str(e)}")
+
+    def stats(self):
+        """Hits and misses of all workers since they started, see metrics.sample_value()"""
+        return {
+            'hits': int(metrics.sample_value('chat_response_cache_lookups_total', result='hit')),
+            'misses': int(metrics.sample_value('chat_response_cache_lookups_total', result='miss')),
+        }
+
+    def _count(self, cached):
+        metrics.RESPONSE_CACHE_LOOKUPS.labels('hit' if cached else 'miss').inc()
+
+
+def get_response_cache():
+    """The configured response cache, or None when caching is disabled"""
+    if not settings.CHAT_RESPONSE_CACHE_ENABLED:
+        return None
+    return ResponseCache()
@@ -0,0 +1,210 @@
+"""
+Retention of chat history (manage.py prune_chats).
+
+Sessions idle for more than N days, or whose Django session has expired,
+are archived to gzip'd NDJSON (services/chat_archive.py) and deleted with
+purge_chat_sessions, a batch of sessions at a time.
+
+A run keeps its progress in a directory of its own under the archive
+directory: state.json plus one batch-NNNNN.ndjson.gz per batch. The state
+names the cutoffs, fixed when the run starts, and the last session id done,
+so an interrupted run picks up where it stopped. A batch that was archived
+but not deleted yet is deleted first, without archiving it again. Sessions
+kept at that point are dropped from the batch file.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ..models import ChatSession
+from .chat_archive import drop_sessions, write_archive
+from .chat_service import purge_chat_sessions
+
+logger = logging.getLogger(__name__)
+
+DB_SESSION_ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+)
+
+
+class RetentionError(Exception):
+    pass
+
+
+def prunable_sessions(idle_before=None, expired_at=None):
+    """
+    Chat sessions without messages since idle_before, or whose Django
+    session had expired at expired_at (or is gone)
+    """
+    # sessions marked deleted are purged without an archive (purge_deleted_sessions)
+    sessions = ChatSession.objects.filter(deleted_at__isnull=True)
+    criteria = Q()
+    if idle_before is not None:
+        sessions = sessions.annotate(last_activity=Coalesce('last_message_at', 'created_at'))
+        criteria |= Q(last_activity__lt=idle_before)
+    if expired_at is not None:
+        if settings.SESSION_ENGINE not in DB_SESSION_ENGINES:
+            raise RetentionError(f"Expired sessions can't be found with SESSION_ENGINE {settings.SESSION_ENGINE}")
+        sessions = sessions.annotate(live_session=Exists(Session.objects.filter(
+            session_key=OuterRef('session_key'), expire_date__gt=expired_at
+        )))
+        criteria |= Q(live_session=False)
+    if not criteria:
+        return ChatSession.objects.none()
+
+    return sessions.filter(criteria)
+
+
+class PruneRun:
+    """A prune_chats run and its state directory, see the module docstring"""
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+
+    @classmethod
+    def start(cls, archive_dir, older_than_days=None, expired_sessions=False):
+        now = timezone.now()
+        path = os.path.join(archive_dir, f"prune-{now:%Y%m%dT%H%M%SZ}")
+        os.makedirs(path)
+        run = cls(path, {
+            'idle_before': (now - timedelta(days=older_than_days)).isoformat() if older_than_days else None,
+            'expired_at': now.isoformat() if expired_sessions else None,
+            'last_id': None,
+            'batches': 0,
+            'sessions': 0,
+            'messages': 0,
+            'pending': None,
+            'finished': False,
+        })
+        run.save()
+        return run
+
+    @classmethod
+    def unfinished(cls, archive_dir):
+        """The latest run of archive_dir that did not finish, or None"""
+        if not os.path.isdir(archive_dir):
+            return None
+        for name in sorted(os.listdir(archive_dir), reverse=True):
+            state_file = os.path.join(archive_dir, name, 'state.json')
+            if name.startswith('prune-') and os.path.exists(state_file):
+                with open(state_file) as f:
+                    state = json.load(f)
+                if not state['finished']:
+                    return cls(os.path.join(archive_dir, name), state)
+        return None
+
+    def save(self):
+        state_file = os.path.join(self.path, 'state.json')
+        with open(f"{state_file}.tmp", 'w') as f:
+            json.dump(self.state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{state_file}.tmp", state_file)
+
+    def _cutoff(self, key):
+        value = self.state[key]
+        return datetime.fromisoformat(value) if value else None
+
+    def sessions(self):
+        return prunable_sessions(self._cutoff('idle_before'), self._cutoff('expired_at'))
+
+    def next_batch(self, size):
+        """Ids of the next size prunable sessions, in id order"""
+        sessions = self.sessions().order_by('pk')
+        if self.state['last_id']:
+            sessions = sessions.filter(pk__gt=self.state['last_id'])
+        return [str(pk) for pk in sessions.values_list('pk', flat=True)[:size]]
+
+    def archive(self, session_ids):
+        """Archive a batch and mark it pending, returns (sessions, messages)"""
+        number = self.state['batches'] + 1
+        name = f"batch-{number:05d}.ndjson.gz"
+        counts = write_archive(
+            os.path.join(self.path, name), ChatSession.objects.filter(pk__in=session_ids)
+        )
+        self.state['pending'] = {'file': name, 'ids': session_ids}
+        self.state['batches'] = number
+        self.save()
+        return counts
+
+    def delete_pending(self, batch_size, pause):
+        """Delete the pending batch, returns (sessions, messages) deleted"""
+        pending = self.state['pending']
+        session_ids = pending['ids']
+        # sessions written to since they were archived are kept, their
+        # messages would be lost otherwise. They come out of the batch file,
+        # so it only holds what was deleted and a later run archives them
+        # once. Sessions already gone (a retry after a crash) stay in it.
+        still_prunable = list(self.sessions().filter(pk__in=session_ids).values_list('pk', flat=True))
+        kept = ChatSession.objects.filter(pk__in=session_ids).exclude(pk__in=still_prunable)
+        kept = [str(pk) for pk in kept.values_list('pk', flat=True)]
+        if kept:
+            drop_sessions(os.path.join(self.path, pending['file']), kept)
+        deleted = purge_chat_sessions(still_prunable, batch_size=batch_size, pause=pause)
+
+        self.state['last_id'] = max(session_ids)
+        self.state['sessions'] += deleted[0]
+        self.state['messages'] += deleted[1]
+        self.state['pending'] = None
+        self.save()
+        return deleted
+
+    def finish(self):
+        self.state['finished'] = True
+        self.save()
+
+
+@contextmanager
+def run_lock(archive_dir):
+    """Exclusive lock on archive_dir, so two prune_chats never run at once"""
+    os.makedirs(archive_dir, exist_ok=True)
+    with open(os.path.join(archive_dir, '.prune.lock'), 'w') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RetentionError(f"Another prune_chats is running on {archive_dir}")
+        yield
+
+
+def prune(run, batch_size, message_batch_size, pause=0, deadline=None, progress=None):
+    """
+    Archive and delete the sessions of run a batch at a time until none is
+    left or time.monotonic() passes deadline. Returns True when the run
+    finished.
+    """
+    if run.state['pending']:
+        batch_file = run.state['pending']['file']
+        deleted = run.delete_pending(message_batch_size, pause)
+        if progress:
+            progress(batch_file, deleted)
+
+    while deadline is None or time.monotonic() < deadline:
+        session_ids = run.next_batch(batch_size)
+        if not session_ids:
+            run.finish()
+            return True
+        run.archive(session_ids)
+        batch_file = run.state['pending']['file']
+        deleted = run.delete_pending(message_batch_size, pause)
+        if progress:
+            progress(batch_file, deleted)
+        if pause:
+            time.sleep(pause)
+
+    return False
@@ -0,0 +1,251 @@
+"""
+Full-text search over chat messages (GET /api/search/ and the admin).
+
+On Postgres a GIN index on to_tsvector(content), on SQLite an FTS5 table
+over ChatMessage.content kept in sync by triggers. Neither is a model
+field: migration 0017 creates them (with its own copy of the DDL) and the
+DDL here puts back whatever is missing after every migrate, since SQLite
+table rebuilds drop the triggers. Other databases fall back to icontains
+scans.
+
+The FTS5 rows are keyed by an INTEGER PRIMARY KEY of their own table
+(FTS_KEYS_TABLE, message id -> FTS rowid), which VACUUM and table rebuilds
+leave alone; the implicit rowid of the messages table is neither, as its
+primary key is a UUID. The FTS5 table keeps its own copy of the content,
+for snippets. On Postgres the index is an expression index built
+CONCURRENTLY, so adding it takes no lock that blocks writes.
+"""
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+import logging
+import re
+
+from ..models import ChatMessage, ChatSession
+
+logger = logging.getLogger(__name__)
+
+# text search configuration of the index, queries must use the same expression
+POSTGRES_CONFIG = 'english'
+POSTGRES_INDEX = 'chatmsg_search_expr_idx'
+FTS_TABLE = 'backendApp_chatmessage_search'
+FTS_KEYS_TABLE = 'backendApp_chatmessage_search_keys'
+FTS_TRIGGERS = ('chatmsg_search_insert', 'chatmsg_search_delete', 'chatmsg_search_update')
+
+# highlight markers, swapped for <mark> once the snippet is escaped
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+SNIPPET_TOKENS = 24
+
+TERM_RE = re.compile(r'\w+')
+
+
+def _search_vector(column):
+    # spelled out like the index expression, or the planner cannot use it
+    return f"to_tsvector('{POSTGRES_CONFIG}', {column})"
+
+
+def _fts_key(message_id):
+    return f'(SELECT id FROM "{FTS_KEYS_TABLE}" WHERE message_id = {message_id})'
+
+
+def _sqlite_install_sql():
+    table = ChatMessage._meta.db_table
+    return [
+        f"""CREATE TABLE IF NOT EXISTS "{FTS_KEYS_TABLE}" (
+            id INTEGER PRIMARY KEY, message_id char(32) NOT NULL UNIQUE
+        )""",
+        # underscores are part of identifiers in code
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS "{FTS_TABLE}" USING fts5(
+            content, tokenize="porter unicode61 tokenchars '_'"
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[0]} AFTER INSERT ON "{table}" BEGIN
+            INSERT INTO "{FTS_KEYS_TABLE}"(message_id) VALUES (new.id);
+            INSERT INTO "{FTS_TABLE}"(rowid, content) VALUES ({_fts_key('new.id')}, new.content);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[1]} AFTER DELETE ON "{table}" BEGIN
+            DELETE FROM "{FTS_TABLE}" WHERE rowid = {_fts_key('old.id')};
+            DELETE FROM "{FTS_KEYS_TABLE}" WHERE message_id = old.id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[2]} AFTER UPDATE OF content ON "{table}" BEGIN
+            UPDATE "{FTS_TABLE}" SET content = new.content WHERE rowid = {_fts_key('new.id')};
+        END""",
+    ]
+
+
+def _sqlite_reindex_sql():
+    """Index every message again, for messages written while the triggers were missing"""
+    table = ChatMessage._meta.db_table
+    return [
+        f'DELETE FROM "{FTS_TABLE}"',
+        f'DELETE FROM "{FTS_KEYS_TABLE}" WHERE message_id NOT IN (SELECT id FROM "{table}")',
+        f'INSERT OR IGNORE INTO "{FTS_KEYS_TABLE}"(message_id) SELECT id FROM "{table}"',
+        f"""INSERT INTO "{FTS_TABLE}"(rowid, content)
+            SELECT k.id, m.content FROM "{FTS_KEYS_TABLE}" k JOIN "{table}" m ON m.id = k.message_id""",
+    ]
+
+
+def _postgres_index_valid(cursor):
+    """True if the index exists and is valid, None if it does not exist"""
+    cursor.execute(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+        [POSTGRES_INDEX]
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _postgres_install(schema_editor):
+    table = ChatMessage._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        valid = _postgres_index_valid(cursor)
+    if valid:
+        return
+    if valid is False:
+        # left behind by an interrupted concurrent build
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {POSTGRES_INDEX}')
+    schema_editor.execute(
+        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {POSTGRES_INDEX} '
+        f'ON "{table}" USING gin ({_search_vector("content")})'
+    )
+
+
+def _sqlite_index_complete(cursor):
+    names = [FTS_TABLE, FTS_KEYS_TABLE, *FTS_TRIGGERS]
+    cursor.execute(
+        "SELECT count(*) FROM sqlite_master WHERE name IN (%s)" % ', '.join(['%s'] * len(names)), names
+    )
+    return cursor.fetchone()[0] == len(names)
+
+
+def install_search_index(schema_editor):
+    """
+    Create the search index if it is missing, a no-op otherwise. On Postgres
+    the schema editor must not be atomic (CREATE INDEX CONCURRENTLY).
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _postgres_install(schema_editor)
+    elif vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            if _sqlite_index_complete(cursor):
+                return
+        for sql in _sqlite_install_sql() + _sqlite_reindex_sql():
+            schema_editor.execute(sql)
+        logger.info("Rebuilt the chat message search index")
+
+
+def search_terms(query):
+    """Words of a user query, the index is searched for messages with all of them"""
+    return TERM_RE.findall(query)
+
+
+def _fts_match(terms):
+    # each term quoted, so nothing in the query is read as FTS5 syntax
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def matching_message_ids(query):
+    """Subquery of the ids of all messages matching query, for pk__in filters"""
+    terms = search_terms(query)
+    table = ChatMessage._meta.db_table
+
+    if not terms:
+        return ChatMessage.objects.none().values('pk')
+    if connection.vendor == 'postgresql':
+        return RawSQL(
+            f'SELECT id FROM "{table}" WHERE {_search_vector("content")} @@ plainto_tsquery(%s, %s)',
+            [POSTGRES_CONFIG, ' '.join(terms)]
+        )
+    if connection.vendor == 'sqlite':
+        return RawSQL(
+            f'SELECT k.message_id FROM "{FTS_TABLE}" f JOIN "{FTS_KEYS_TABLE}" k ON k.id = f.rowid '
+            f'WHERE "{FTS_TABLE}" MATCH %s',
+            [_fts_match(terms)]
+        )
+
+    queryset = ChatMessage.objects.all()
+    for term in terms:
+        queryset = queryset.filter(content__icontains=term)
+    return queryset.values('pk')
+
+
+def _ranked_messages(session_key, terms, limit):
+    message_table = ChatMessage._meta.db_table
+    session_table = ChatSession._meta.db_table
+
+    if connection.vendor == 'postgresql':
+        # headlines only for the page of hits, they re-parse the content
+        sql = f"""
+            SELECT hit.*, ts_headline(%s, hit.content, hit.query, %s) AS search_snippet
+            FROM (
+                SELECT m.*, s.title AS session_title, q AS query,
+                       ts_rank({_search_vector("m.content")}, q) AS search_rank
+                FROM "{message_table}" m
+                JOIN "{session_table}" s ON s.id = m.session_id,
+                     plainto_tsquery(%s, %s) q
+                WHERE s.session_key = %s AND {_search_vector("m.content")} @@ q
+                ORDER BY search_rank DESC, m.created_at DESC
+                LIMIT %s
+            ) hit
+            ORDER BY hit.search_rank DESC, hit.created_at DESC
+        """
+        options = (
+            f'StartSel={MARK_START}, StopSel={MARK_END}, '
+            f'MaxWords={SNIPPET_TOKENS}, MinWords={SNIPPET_TOKENS // 2}'
+        )
+        params = [POSTGRES_CONFIG, options, POSTGRES_CONFIG, ' '.join(terms), session_key, limit]
+    elif connection.vendor == 'sqlite':
+        # bm25() is lower for better matches
+        sql = f"""
+            SELECT m.*, s.title AS session_title,
+                   -bm25("{FTS_TABLE}") AS search_rank,
+                   snippet("{FTS_TABLE}", 0, %s, %s, '…', %s) AS search_snippet
+            FROM "{FTS_TABLE}" f
+            JOIN "{FTS_KEYS_TABLE}" k ON k.id = f.rowid
+            JOIN "{message_table}" m ON m.id = k.message_id
+            JOIN "{session_table}" s ON s.id = m.session_id
+            WHERE "{FTS_TABLE}" MATCH %s AND s.session_key = %s
+            ORDER BY bm25("{FTS_TABLE}"), m.created_at DESC
+            LIMIT %s
+        """
+        params = [MARK_START, MARK_END, SNIPPET_TOKENS, _fts_match(terms), session_key, limit]
+    else:
+        messages = ChatMessage.objects.filter(
+            pk__in=matching_message_ids(' '.join(terms)), session__session_key=session_key
+        ).select_related('session').order_by('-created_at')[:limit]
+        for message in messages:
+            message.session_title = message.session.title
+            message.search_rank = None
+            message.search_snippet = message.preview
+        return messages
+
+    return ChatMessage.objects.raw(sql, params)
+
+
+def _highlight(snippet):
+    return escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_messages(session_key, query, limit=20):
+    """
+    Messages of the chat sessions of session_key containing every word of
+    query, best matches first. The snippets are HTML escaped, with the
+    matched words wrapped in <mark>.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    return [
+        {
+            'id': message.id,
+            'session_id': message.session_id,
+            'session_title': message.session_title,
+            'message_type': message.message_type,
+            'created_at': message.created_at,
+            'snippet': _highlight(message.search_snippet),
+            'rank': message.search_rank,
+        }
+        for message in _ranked_messages(session_key, terms, limit)
+    ]
@@ -0,0 +1,131 @@
+"""
+Write-behind tracking of session activity.
+
+Every request with a session calls touch(): the time goes to the
+CHAT_SESSION_ACTIVITY_CACHE_ALIAS cache, where last_activity() reads it, and
+into the worker's pending batch. Once CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL
+seconds have passed since the last flush, the next touch() writes the batch
+to django_session: one UPDATE per CHAT_SESSION_ACTIVITY_BATCH_SIZE sessions,
+moving each expire_date to its last activity plus SESSION_COOKIE_AGE. A
+session is written at most once per interval by a worker, however many
+requests it makes in between.
+
+This replaces SESSION_SAVE_EVERY_REQUEST, which saved the session row on
+every request to slide its expiry. When the cache entry is gone the last
+activity is read back from the row, as expire_date - SESSION_COOKIE_AGE.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+import logging
+import threading
+import time
+
+from .. import metrics
+from .retention import DB_SESSION_ENGINES
+
+logger = logging.getLogger(__name__)
+
+
+def _cache():
+    from django.core.cache import caches
+    return caches[settings.CHAT_SESSION_ACTIVITY_CACHE_ALIAS]
+
+
+def _cache_key(session_key):
+    return f'session-activity:{session_key}'
+
+
+class SessionActivity:
+    """Pending activity of one worker, flushed to the database in batches"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = clock()
+
+    def touch(self, session_key, when=None):
+        when = when or timezone.now()
+        _cache().set(_cache_key(session_key), when, settings.SESSION_COOKIE_AGE)
+        with self._lock:
+            self._pending[session_key] = when
+            due = self.clock() - self._last_flush >= settings.CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def pending(self, session_key):
+        with self._lock:
+            return self._pending.get(session_key)
+
+    def forget(self, session_key):
+        with self._lock:
+            self._pending.pop(session_key, None)
+        _cache().delete(_cache_key(session_key))
+
+    def flush(self):
+        """Write the pending activity, returns the number of sessions written"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._last_flush = self.clock()
+        if not batch or settings.SESSION_ENGINE not in DB_SESSION_ENGINES:
+            return 0
+
+        age = timedelta(seconds=settings.SESSION_COOKIE_AGE)
+        items = list(batch.items())
+        written = 0
+        try:
+            for start in range(0, len(items), settings.CHAT_SESSION_ACTIVITY_BATCH_SIZE):
+                chunk = items[start:start + settings.CHAT_SESSION_ACTIVITY_BATCH_SIZE]
+                written += Session.objects.filter(session_key__in=[key for key, _ in chunk]).update(
+                    expire_date=Case(
+                        *[When(session_key=key, then=Value(when + age)) for key, when in chunk],
+                        output_field=DateTimeField(),
+                    )
+                )
+        except Exception as e:
+            # the activity is only lost for sessions that make no other request
+            logger.warning(f"Could not write the activity of {len(batch)} sessions: {str(e)}")
+            return 0
+        metrics.SESSION_ACTIVITY_FLUSHED.inc(written)
+        return written
+
+
+_activity = None
+
+
+def get_session_activity():
+    global _activity
+    if _activity is None:
+        _activity = SessionActivity()
+    return _activity
+
+
+def touch(session_key):
+    get_session_activity().touch(session_key)
+
+
+def flush_session_activity():
+    """Write what this worker has pending, e.g. when it exits"""
+    if _activity is not None:
+        return _activity.flush()
+    return 0
+
+
+def forget_session(session_key):
+    get_session_activity().forget(session_key)
+
+
+def last_activity(session_key):
+    """When the session last made a request, None when unknown"""
+    when = _cache().get(_cache_key(session_key)) or get_session_activity().pending(session_key)
+    if when is not None:
+        return when
+    if settings.SESSION_ENGINE not in DB_SESSION_ENGINES:
+        return None
+    expire_date = Session.objects.filter(session_key=session_key).values_list('expire_date', flat=True).first()
+    if expire_date is None:
+        return None
+    return expire_date - timedelta(seconds=settings.SESSION_COOKIE_AGE)
@@ -0,0 +1,249 @@
+from django.conf import settings
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows), calls are only coalesced within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05
+# published results are only read by callers already waiting, older ones are litter
+RESULT_MAX_AGE = 600
+PRUNE_INTERVAL = 60
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls made with the same key into a single call.
+
+    Within a process the first caller (the leader) runs the function and
+    the others wait for its result. Across processes, e.g. gunicorn workers
+    on one host, the leader also holds an flock on <lock_dir>/<key>.lock
+    while it runs and publishes its result to <key>.json. A worker that
+    finds the lock taken waits for it to be released and reads the result
+    instead of calling. Waiters that are still waiting after timeout seconds
+    give up and make their own call, as does a waiter whose leader failed.
+
+    Results shared across processes go through JSON, exceptions are only
+    shared within a process.
+    """
+
+    def __init__(self, lock_dir=None, timeout=None):
+        self.lock_dir = lock_dir or settings.CHAT_SINGLE_FLIGHT_LOCK_DIR
+        self.timeout = timeout if timeout is not None else settings.CHAT_SINGLE_FLIGHT_TIMEOUT
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self._last_prune = 0
+
+    def do(self, key, func):
+        """Return (result, shared), shared is True when another caller made the call"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            logger.warning(f"Gave up waiting for in-flight call {key}, calling independently")
+            return func(), False
+
+        try:
+            call.result, shared = self._do_across_processes(key, func)
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    async def ado(self, key, afunc):
+        """Async variant of do(), afunc is a coroutine function"""
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        call = self._async_calls.get(loop_key)
+
+        if call is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(call), self.timeout), True
+            except asyncio.TimeoutError:
+                logger.warning(f"Gave up waiting for in-flight call {key}, calling independently")
+            except asyncio.CancelledError:
+                if not call.cancelled():
+                    raise
+            return await afunc(), False
+
+        call = self._async_calls[loop_key] = loop.create_future()
+        try:
+            result, shared = await self._ado_across_processes(key, afunc)
+            call.set_result(result)
+            return result, shared
+        except asyncio.CancelledError:
+            # the waiters make their own calls
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # retrieved here so a leader without waiters does not log it again
+            call.exception()
+            raise
+        finally:
+            self._async_calls.pop(loop_key, None)
+
+    def _do_across_processes(self, key, func):
+        lock_file = self._open_lock(key)
+        if lock_file is None:
+            return func(), False
+
+        with lock_file:
+            if self._try_lock(lock_file):
+                return self._lead(key, lock_file, func), False
+
+            waiting_since = time.time()
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                if self._try_lock(lock_file):
+                    result = self._read_result(key, waiting_since)
+                    if result is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                        return result, True
+                    # the leader failed without publishing, take over
+                    return self._lead(key, lock_file, func), False
+
+        logger.warning(f"Gave up waiting for call {key} in another worker, calling independently")
+        return func(), False
+
+    async def _ado_across_processes(self, key, afunc):
+        lock_file = self._open_lock(key)
+        if lock_file is None:
+            return await afunc(), False
+
+        with lock_file:
+            if self._try_lock(lock_file):
+                return await self._alead(key, lock_file, afunc), False
+
+            waiting_since = time.time()
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                await asyncio.sleep(POLL_INTERVAL)
+                if self._try_lock(lock_file):
+                    result = self._read_result(key, waiting_since)
+                    if result is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                        return result, True
+                    return await self._alead(key, lock_file, afunc), False
+
+        logger.warning(f"Gave up waiting for call {key} in another worker, calling independently")
+        return await afunc(), False
+
+    def _lead(self, key, lock_file, func):
+        try:
+            result = func()
+            self._write_result(key, result)
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def _alead(self, key, lock_file, afunc):
+        try:
+            result = await afunc()
+            self._write_result(key, result)
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.lock_dir, f"{key}{suffix}")
+
+    def _open_lock(self, key):
+        """The key's lock file, or None when calls can only be coalesced in-process"""
+        if fcntl is None:
+            return None
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            return open(self._path(key, '.lock'), 'a+')
+        except OSError as e:
+            logger.warning(f"Single-flight lock unavailable: {str(e)}")
+            return None
+
+    def _try_lock(self, lock_file):
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _write_result(self, key, result):
+        path = self._path(key, '.json')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'finished_at': time.time(), 'result': result}, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not publish result of call {key}: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        self._prune()
+
+    def _read_result(self, key, not_before):
+        """The result published for key after not_before, if any"""
+        try:
+            with open(self._path(key, '.json')) as f:
+                published = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if published.get('finished_at', 0) < not_before:
+            return None
+        return published.get('result')
+
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        try:
+            with os.scandir(self.lock_dir) as entries:
+                for entry in entries:
+                    if now - entry.stat().st_mtime > RESULT_MAX_AGE:
+                        # removing a lock file in use only costs one duplicate call
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+
+_single_flight = None
+
+
+def get_single_flight():
+    """The process-wide SingleFlight, or None when coalescing is disabled"""
+    global _single_flight
+    if not settings.CHAT_SINGLE_FLIGHT_ENABLED:
+        return None
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,157 @@
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+import logging
+
+from ..models import ActivityCounter, DailyActivity, ChatSession, ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+def _bump(model, lookup, deltas):
+    """Add deltas to the row matching lookup, creating it if needed"""
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        # created concurrently, the update will find it now
+        model.objects.filter(**lookup).update(**updates)
+
+
+def _apply_activity(session_key, sessions, messages, count_as_created):
+    try:
+        with transaction.atomic():
+            for scope in (ActivityCounter.GLOBAL_SCOPE, session_key):
+                _bump(ActivityCounter, {'scope': scope}, {
+                    'session_count': sessions,
+                    'message_count': messages,
+                })
+                if count_as_created:
+                    _bump(DailyActivity, {'scope': scope, 'date': timezone.now().date()}, {
+                        'sessions_created': sessions,
+                        'messages_created': messages,
+                    })
+    except Exception as e:
+        # never fail a chat request over stats, reconcile_stats fixes the drift
+        logger.error(f"Failed to update activity counters: {str(e)}")
+
+
+def record_activity(session_key, sessions=0, messages=0):
+    """
+    Count created (positive) or deleted (negative) sessions and messages.
+
+    Applied after the surrounding transaction commits, in a short transaction
+    of its own, so the hot global row is not locked for the length of the
+    caller's transaction and rolled back writes are never counted.
+    """
+    count_as_created = sessions >= 0 and messages >= 0
+    transaction.on_commit(
+        lambda: _apply_activity(session_key, sessions, messages, count_as_created)
+    )
+
+
+def get_counts(scope=ActivityCounter.GLOBAL_SCOPE):
+    try:
+        counter = ActivityCounter.objects.only('session_count', 'message_count').get(scope=scope)
+    except ActivityCounter.DoesNotExist:
+        return {'sessions': 0, 'messages': 0}
+    return {'sessions': counter.session_count, 'messages': counter.message_count}
+
+
+def get_recent_activity(scope=ActivityCounter.GLOBAL_SCOPE, days=30):
+    """Sessions and messages created in the last days, from the daily rollups"""
+    since = timezone.now().date() - timedelta(days=days - 1)
+    totals = DailyActivity.objects.filter(scope=scope, date__gte=since).aggregate(
+        sessions=Sum('sessions_created'),
+        messages=Sum('messages_created'),
+    )
+    return {
+        'sessions': totals['sessions'] or 0,
+        'messages': totals['messages'] or 0,
+    }
+
+
+def reconcile_counters():
+    """
+    Recompute every ActivityCounter row from the chat tables. Meant for a
+    periodic job, it scans both tables. Returns the number of scopes written.
+    """
+    totals = {}
+
+    # sessions marked deleted are no longer counted, see delete_chat_sessions
+    sessions = ChatSession.objects.filter(deleted_at__isnull=True)
+    for row in sessions.values('session_key').annotate(n=Count('id')).order_by():
+        totals.setdefault(row['session_key'], [0, 0])[0] = row['n']
+
+    messages = ChatMessage.objects.filter(session__deleted_at__isnull=True)
+    for row in messages.values('session__session_key').annotate(n=Count('id')).order_by():
+        totals.setdefault(row['session__session_key'], [0, 0])[1] = row['n']
+
+    totals[ActivityCounter.GLOBAL_SCOPE] = [
+        sum(sessions for sessions, _ in totals.values()),
+        sum(messages for _, messages in totals.values()),
+    ]
+
+    stale = [
+        scope for scope in ActivityCounter.objects.values_list('scope', flat=True).iterator()
+        if scope not in totals
+    ]
+
+    with transaction.atomic():
+        for i in range(0, len(stale), 500):
+            ActivityCounter.objects.filter(scope__in=stale[i:i + 500]).delete()
+        ActivityCounter.objects.bulk_create(
+            [
+                ActivityCounter(scope=scope, session_count=sessions, message_count=messages)
+                for scope, (sessions, messages) in totals.items()
+            ],
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['scope'],
+            update_fields=['session_count', 'message_count', 'updated_at'],
+        )
+
+    return len(totals)
+
+
+def rebuild_daily_activity(days=30):
+    """Recompute the daily rollups of the last days from created_at"""
+    since = timezone.now().date() - timedelta(days=days - 1)
+    rows = {}
+
+    def add(scope, date, field, n):
+        row = rows.setdefault((scope, date), {'sessions_created': 0, 'messages_created': 0})
+        row[field] += n
+
+    sessions = ChatSession.objects.filter(created_at__date__gte=since, deleted_at__isnull=True).annotate(
+        date=TruncDate('created_at')
+    ).values('session_key', 'date').annotate(n=Count('id')).order_by()
+    for row in sessions:
+        add(row['session_key'], row['date'], 'sessions_created', row['n'])
+        add(ActivityCounter.GLOBAL_SCOPE, row['date'], 'sessions_created', row['n'])
+
+    messages = ChatMessage.objects.filter(created_at__date__gte=since, session__deleted_at__isnull=True).annotate(
+        date=TruncDate('created_at')
+    ).values('session__session_key', 'date').annotate(n=Count('id')).order_by()
+    for row in messages:
+        add(row['session__session_key'], row['date'], 'messages_created', row['n'])
+        add(ActivityCounter.GLOBAL_SCOPE, row['date'], 'messages_created', row['n'])
+
+    with transaction.atomic():
+        DailyActivity.objects.filter(date__gte=since).delete()
+        DailyActivity.objects.bulk_create(
+            [DailyActivity(scope=scope, date=date, **counts) for (scope, date), counts in rows.items()],
+            batch_size=500,
+        )
+
+    return len(rows)
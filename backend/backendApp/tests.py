@@ -1,3 +1,1769 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.urls import include, path
+
+from django.db import connection
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import httpx
+import openai
+from openai.resources.chat.completions import AsyncCompletions, Completions
+from openai.resources.models import AsyncModels
+from prometheus_client import REGISTRY
+
+from asgiref.sync import sync_to_async
+
+from .async_views import AsyncQuickChatView, AsyncSendMessageView
+from .models import ChatSession, ChatMessage, ChatJob, CodeReview, ReviewedFile
+from .services.ai_service import CodingChatAI
+from .services.chat_archive import import_records, read_records
+from .services import code_analysis
+from .services.code_analysis import aanalyze_message, analyze_message, close_pool, hints_message
+from .services.context_builder import message_tokens, pack_history
+from .services.chat_service import (
+    begin_exchange, complete_exchange, create_chat_session, delete_chat_sessions, fail_exchange, load_context_window,
+    purge_deleted_sessions, reconcile_pending
+)
+from .services.job_queue import claim_job, run_job, run_next_job
+from .services import admission, chat_service, openai_client, resilience, session_activity
+from .services.admission import AdmissionRejected, UpstreamSlots
+from .services.resilience import CircuitOpenError, ResilientCaller
+from .services.retention import PruneRun
+from .services.session_activity import SessionActivity
+from .services.single_flight import SingleFlight
+from .views import streaming_content
+from .services.stats_service import get_counts
+
+
+def fake_completion(content="Use a tuple for fixed records."):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(total_tokens=12)
+    )
+
+
+def fake_stream(*parts, total_tokens=9):
+    # a generator, closable like openai's Stream
+    for part in parts:
+        yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=part))])
+    yield SimpleNamespace(usage=SimpleNamespace(total_tokens=total_tokens), choices=[])
+
+
+def sse_events(body):
+    """[(event, data), ...] of a Server-Sent Events body"""
+    events = []
+    for frame in body.split('\n\n'):
+        if frame:
+            event, data = frame.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False)
+class StreamingTests(TestCase):
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_reply_is_streamed_as_server_sent_events(self):
+        first_tokens = self.sample('chat_llm_time_to_first_token_seconds_count', operation='chat_stream')
+        with mock.patch.object(Completions, 'create', return_value=fake_stream('Use ', 'a tuple.')):
+            response = self.client.post('/api/chat/?stream=1', {'message': 'Tuple or list?'}, content_type='application/json')
+            body = b''.join(response.streaming_content).decode()
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+        events = sse_events(body)
+        self.assertEqual([name for name, _ in events], ['start', 'delta', 'delta', 'done'])
+        self.assertEqual(events[0][1]['user_message']['content'], 'Tuple or list?')
+        self.assertEqual([data['content'] for name, data in events if name == 'delta'], ['Use ', 'a tuple.'])
+
+        assistant = ChatMessage.objects.get(pk=events[0][1]['assistant_message_id'])
+        self.assertEqual(events[-1][1]['assistant_message']['id'], str(assistant.pk))
+        self.assertEqual(assistant.content, 'Use a tuple.')
+        self.assertEqual(assistant.status, ChatMessage.STATUS_COMPLETE)
+        self.assertEqual(assistant.tokens_used, 9)
+        self.assertIsNotNone(assistant.time_to_first_token)
+        self.assertLessEqual(assistant.time_to_first_token, assistant.response_time)
+        self.assertEqual(
+            self.sample('chat_llm_time_to_first_token_seconds_count', operation='chat_stream'), first_tokens + 1
+        )
+
+    def test_partial_reply_is_kept_when_the_client_disconnects(self):
+        with mock.patch.object(Completions, 'create', return_value=fake_stream('Use ', 'a ', 'tuple.')):
+            response = self.client.post('/api/chat/?stream=1', {'message': 'Tuple or list, again?'}, content_type='application/json')
+            content = response.streaming_content
+            start = sse_events(next(content).decode())
+            next(content)
+            # the client goes away after the first delta, the server closes the response
+            response.close()
+
+        assistant = ChatMessage.objects.get(pk=start[0][1]['assistant_message_id'])
+        self.assertEqual(assistant.status, ChatMessage.STATUS_FAILED)
+        self.assertEqual(assistant.content, 'Use ')
+        self.assertIn('Client disconnected', assistant.error)
+        self.assertIsNotNone(assistant.time_to_first_token)
+
+
+class FakeAsyncStream:
+    """Async iterable of completion chunks, closable like openai's AsyncStream"""
+
+    def __init__(self, *parts, total_tokens=9):
+        self.chunks = fake_stream(*parts, total_tokens=total_tokens)
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+# the routes backend/asgi.py serves (ASYNC_CHAT_VIEWS), for AsyncViewTests
+urlpatterns = [
+    path('api/sessions/<uuid:pk>/send_message/', AsyncSendMessageView.as_view(), name='chatsession-send-message-async'),
+    path('api/chat/', AsyncQuickChatView.as_view(), name='quick-chat-async'),
+    path('api/', include('backendApp.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__, OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False)
+class AsyncViewTests(TestCase):
+
+    async def new_session(self):
+        await self.async_client.get('/api/session/')
+        session_key = self.async_client.cookies[settings.SESSION_COOKIE_NAME].value
+        return await sync_to_async(create_chat_session)(session_key, 'New Chat')
+
+    async def adapted_middleware(self, method, path, **extra):
+        """The response, and the middleware Django had to put behind a thread or loop"""
+        # a new client loads the middleware again, with the settings in force now
+        client = self.async_client_class()
+        client.cookies = self.async_client.cookies
+        with mock.patch('django.core.handlers.base.logger.debug') as debug, override_settings(DEBUG=True):
+            response = await getattr(client, method)(path, **extra)
+        adapted = [call.args[1] for call in debug.call_args_list if 'adapted for' in call.args[0]]
+        return response, [name.split()[-1] for name in adapted if name.startswith('middleware ')]
+
+    async def test_query_count_headers_stay_async(self):
+        session = await self.new_session()
+        middleware = ['backendApp.middleware.QueryCountHeaderMiddleware', 'django.contrib.sessions.middleware.SessionMiddleware']
+        with override_settings(MIDDLEWARE=middleware), \
+                mock.patch.object(AsyncCompletions, 'create', new_callable=mock.AsyncMock, return_value=fake_completion()):
+            response, adapted = await self.adapted_middleware(
+                'post', f'/api/sessions/{session.id}/send_message/',
+                data={'message': 'How many queries?'}, content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(adapted, [])
+        self.assertGreater(int(response['X-DB-Query-Count']), 0)
+
+    async def test_metrics_stay_async_and_time_the_whole_stream(self):
+        session = await self.new_session()
+        labels = {'endpoint': 'chatsession-send-message-async', 'method': 'POST', 'status': '200'}
+        observed = REGISTRY.get_sample_value('chat_http_request_duration_seconds_count', labels) or 0
+        middleware = ['backendApp.middleware.MetricsMiddleware', 'django.contrib.sessions.middleware.SessionMiddleware']
+        with override_settings(MIDDLEWARE=middleware), \
+                mock.patch.object(AsyncCompletions, 'create', new_callable=mock.AsyncMock, return_value=FakeAsyncStream('Yes.')):
+            response, adapted = await self.adapted_middleware(
+                'post', f'/api/sessions/{session.id}/send_message/?stream=1',
+                data={'message': 'Is this timed?'}, content_type='application/json'
+            )
+            self.assertEqual(adapted, [])
+            self.assertTrue(response.is_async)
+            # observed once the last chunk is out, not when the view returns
+            self.assertEqual(REGISTRY.get_sample_value('chat_http_request_duration_seconds_count', labels) or 0, observed)
+            body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertEqual(sse_events(body)[-1][0], 'done')
+        self.assertEqual(REGISTRY.get_sample_value('chat_http_request_duration_seconds_count', labels), observed + 1)
+        db_queries = {'endpoint': 'chatsession-send-message-async', 'method': 'POST'}
+        self.assertGreater(REGISTRY.get_sample_value('chat_http_request_db_queries_sum', db_queries), 0)
+
+    async def test_default_middleware_stays_async(self):
+        await self.new_session()
+        response, adapted = await self.adapted_middleware('post', '/api/chat/', data={}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(adapted, [])
+        # the session's activity is recorded from the async branch too
+        session_key = self.async_client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertIsNotNone(await sync_to_async(session_activity.last_activity)(session_key))
+        self.assertEqual(response.cookies[settings.SESSION_COOKIE_NAME].value, session_key)
+
+    async def test_send_message(self):
+        session = await self.new_session()
+        with mock.patch.object(AsyncCompletions, 'create', new_callable=mock.AsyncMock, return_value=fake_completion()) as create:
+            response = await self.async_client.post(
+                f'/api/sessions/{session.id}/send_message/', {'message': 'Tuple or list?'},
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        create.assert_awaited_once()
+        data = response.json()
+        self.assertEqual(data['assistant_message']['content'], 'Use a tuple for fixed records.')
+        self.assertEqual(data['session']['title'], 'Tuple or list?')
+        assistant = await ChatMessage.objects.aget(pk=data['assistant_message']['id'])
+        self.assertEqual(assistant.status, ChatMessage.STATUS_COMPLETE)
+        self.assertEqual(assistant.tokens_used, 12)
+
+    async def test_stream(self):
+        session = await self.new_session()
+        stream = FakeAsyncStream('Use ', 'a tuple.')
+        with mock.patch.object(AsyncCompletions, 'create', new_callable=mock.AsyncMock, return_value=stream):
+            response = await self.async_client.post(
+                f'/api/sessions/{session.id}/send_message/?stream=1', {'message': 'Tuple or list, streamed?'},
+                content_type='application/json'
+            )
+            body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertTrue(response.is_async)
+        events = sse_events(body)
+        self.assertEqual([name for name, _ in events], ['start', 'delta', 'delta', 'done'])
+        self.assertTrue(stream.closed)
+        assistant = await ChatMessage.objects.aget(pk=events[0][1]['assistant_message_id'])
+        self.assertEqual(assistant.content, 'Use a tuple.')
+        self.assertEqual(assistant.status, ChatMessage.STATUS_COMPLETE)
+        self.assertIsNotNone(assistant.time_to_first_token)
+
+
+class ExchangeLifecycleTests(TestCase):
+    """Assistant messages are stored pending, then completed or failed"""
+
+    def setUp(self):
+        self.session = ChatSession.objects.create(session_key='lifecycle-test', title='New Chat')
+
+    def test_pending_message_is_completed(self):
+        user_msg, assistant_msg, history = begin_exchange(self.session, 'How do I sort a dict?')
+
+        self.assertEqual(assistant_msg.status, ChatMessage.STATUS_PENDING)
+        self.assertEqual(history, [])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 2)
+        self.assertEqual(self.session.title, CodingChatAI.generate_session_title('How do I sort a dict?'))
+        # pending replies are not part of the next prompt
+        self.assertEqual(load_context_window(self.session), [user_msg])
+
+        complete_exchange(assistant_msg, {'response': 'Use sorted().', 'tokens_used': 12, 'success': True})
+
+        assistant_msg.refresh_from_db()
+        self.assertEqual(assistant_msg.status, ChatMessage.STATUS_COMPLETE)
+        self.assertEqual(assistant_msg.content, 'Use sorted().')
+        self.assertEqual(assistant_msg.tokens_used, 12)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.last_message_type, 'assistant')
+        self.assertEqual(load_context_window(self.session), [user_msg, assistant_msg])
+
+    def test_unsuccessful_and_unexpected_errors_are_failed(self):
+        _, assistant_msg, _ = begin_exchange(self.session, 'first')
+        complete_exchange(assistant_msg, {
+            'response': 'The AI service is unavailable.', 'error': 'rate limited',
+            'error_type': 'rate_limit', 'success': False
+        })
+        assistant_msg.refresh_from_db()
+        self.assertEqual(assistant_msg.status, ChatMessage.STATUS_FAILED)
+        self.assertEqual(assistant_msg.error, 'rate_limit: rate limited')
+
+        _, assistant_msg, _ = begin_exchange(self.session, 'second')
+        fail_exchange(assistant_msg, RuntimeError('boom'))
+        assistant_msg.refresh_from_db()
+        self.assertEqual(assistant_msg.status, ChatMessage.STATUS_FAILED)
+        self.assertEqual(assistant_msg.error, 'boom')
+
+        # when the failure cannot be stored, the row stays pending for reconcile
+        _, assistant_msg, _ = begin_exchange(self.session, 'third')
+        with mock.patch.object(chat_service, 'complete_exchange', side_effect=RuntimeError('db down')):
+            fail_exchange(assistant_msg, RuntimeError('boom'))
+        assistant_msg.refresh_from_db()
+        self.assertEqual(assistant_msg.status, ChatMessage.STATUS_PENDING)
+        self.assertEqual(load_context_window(self.session)[-1].content, 'third')
+
+    def test_reconcile_command_fails_stale_pending_messages(self):
+        _, stale, _ = begin_exchange(self.session, 'abandoned')
+        _, fresh, _ = begin_exchange(self.session, 'still running')
+        queued_user_msg, queued, _ = begin_exchange(self.session, 'queued')
+        ChatJob.objects.create(user_message=queued_user_msg, assistant_message=queued, available_at=timezone.now())
+        ChatMessage.objects.filter(pk__in=[stale.pk, queued.pk]).update(
+            created_at=timezone.now() - timedelta(minutes=30)
+        )
+
+        out = StringIO()
+        call_command('reconcile_pending_messages', '--dry-run', stdout=out)
+        self.assertIn('1 pending messages older than 10 minutes would be marked as failed', out.getvalue())
+        self.assertEqual(ChatMessage.objects.get(pk=stale.pk).status, ChatMessage.STATUS_PENDING)
+
+        out = StringIO()
+        call_command('reconcile_pending_messages', stdout=out)
+        self.assertIn('Marked 1 abandoned pending messages as failed', out.getvalue())
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ChatMessage.STATUS_FAILED)
+        self.assertEqual(stale.content, chat_service.ABANDONED_RESPONSE)
+        self.assertTrue(stale.error.startswith('Abandoned'))
+        self.assertEqual(ChatMessage.objects.get(pk=fresh.pk).status, ChatMessage.STATUS_PENDING)
+        # the job queue fails its own messages
+        self.assertEqual(ChatMessage.objects.get(pk=queued.pk).status, ChatMessage.STATUS_PENDING)
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False)
+class ContextWindowTests(TestCase):
+    """The history read per turn must not grow with the length of the session"""
+
+    def make_session(self, message_count):
+        session = ChatSession.objects.create(session_key='window-test', title='Long chat')
+        ChatMessage.objects.bulk_create([
+            ChatMessage(
+                session=session,
+                message_type='user' if i % 2 == 0 else 'assistant',
+                content=f"message {i:05d} " + "x" * 2000
+            )
+            for i in range(message_count)
+        ])
+        # everything is already folded into the summary, so no summary call is made
+        session.summary = 'Earlier discussion about Python collections.'
+        session.summary_until = timezone.now()
+        session.save()
+        return session
+
+    def test_window_is_one_bounded_query(self):
+        short_session = self.make_session(60)
+        long_session = self.make_session(600)
+
+        with self.assertNumQueries(1):
+            short_window = load_context_window(short_session)
+        with self.assertNumQueries(1):
+            long_window = load_context_window(long_session)
+
+        self.assertEqual(len(short_window), len(long_window))
+        self.assertEqual(
+            sum(len(msg.content) for msg in short_window),
+            sum(len(msg.content) for msg in long_window)
+        )
+        # oldest first, ending with the newest message
+        self.assertTrue(long_window[-1].content.startswith('message 00599'))
+
+    def test_send_message_query_count_is_constant(self):
+        client = self.client
+        client.get('/api/session/')
+        session_key = client.session.session_key
+
+        counts = []
+        for size in (60, 600):
+            session = self.make_session(size)
+            ChatSession.objects.filter(pk=session.pk).update(session_key=session_key)
+
+            with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+                with CaptureQueriesContext(connection) as queries:
+                    response = client.post(
+                        f'/api/sessions/{session.id}/send_message/',
+                        {'message': 'What about named tuples?'},
+                        content_type='application/json'
+                    )
+
+            self.assertEqual(response.status_code, 200)
+            history_reads = [
+                q['sql'] for q in queries.captured_queries
+                if 'ORDER BY "backendApp_chatmessage"."created_at" DESC' in q['sql']
+            ]
+            self.assertTrue(history_reads)
+            for sql in history_reads:
+                self.assertIn('LIMIT', sql)
+            counts.append(len(queries.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+
+
+@override_settings(
+    OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False,
+    CHAT_LLM_MAX_ATTEMPTS=1, CHAT_LLM_HEDGE_ENABLED=False
+)
+class ContextPackingTests(TestCase):
+    """Recent turns are packed into the token budget, older ones go into the rolling summary"""
+
+    def setUp(self):
+        resilience._caller = None
+        self.session = ChatSession.objects.create(session_key='packing-test', title='Packed chat')
+
+    def tearDown(self):
+        resilience._caller = None
+
+    def add_messages(self, count):
+        start = self.session.messages.count()
+        base = timezone.now() - timedelta(hours=1)
+        for i in range(start, start + count):
+            msg = ChatMessage.objects.create(
+                session=self.session,
+                message_type='user' if i % 2 == 0 else 'assistant',
+                content=f"message {i:03d} " + "word " * 100
+            )
+            ChatMessage.objects.filter(pk=msg.pk).update(created_at=base + timedelta(seconds=i))
+        return load_context_window(self.session)
+
+    def test_history_is_packed_into_the_budget(self):
+        history = self.add_messages(10)
+        cost = message_tokens(history[0])
+        budget = 3 * cost + cost // 2
+
+        included, dropped = pack_history(history, budget=budget)
+
+        self.assertEqual(included, history[-3:])
+        self.assertEqual(dropped, history[:-3])
+        self.assertLessEqual(sum(message_tokens(msg) for msg in included), budget)
+        self.assertEqual(pack_history(history, budget=budget), (included, dropped))
+        self.assertEqual(pack_history(history, budget=0), ([], history))
+
+        with override_settings(CHAT_HISTORY_TOKEN_BUDGET=budget):
+            prompt = CodingChatAI()._prepare_messages('Next question', history, summary='Earlier turns.')
+        self.assertEqual(
+            [m['content'] for m in prompt[2:-1]], [msg.content for msg in history[-3:]]
+        )
+        self.assertEqual(prompt[1]['content'], "Summary of the earlier part of this conversation:\nEarlier turns.")
+        self.assertEqual(prompt[-1], {'role': 'user', 'content': 'Next question'})
+
+    def test_rolling_summary_advances_over_dropped_turns(self):
+        history = self.add_messages(10)
+        budget = 4 * message_tokens(history[0])
+
+        with override_settings(CHAT_HISTORY_TOKEN_BUDGET=budget):
+            with mock.patch.object(Completions, 'create', return_value=fake_completion("Summary one.")) as create:
+                self.assertEqual(chat_service.update_rolling_summary(self.session, history), "Summary one.")
+                self.assertEqual(create.call_count, 1)
+                self.session.refresh_from_db()
+                self.assertEqual(self.session.summary_until, history[5].created_at)
+
+                # nothing new fell out of the window, no call
+                chat_service.update_rolling_summary(self.session, history)
+                self.assertEqual(create.call_count, 1)
+
+            history = self.add_messages(2)
+            with mock.patch.object(Completions, 'create', return_value=fake_completion("Summary two.")) as create:
+                self.assertEqual(chat_service.update_rolling_summary(self.session, history), "Summary two.")
+            # only the two turns that were pushed out are summarized
+            self.assertEqual(create.call_count, 1)
+            self.assertIn('Summary one.', create.call_args.kwargs['messages'][-1]['content'])
+            self.assertIn('message 006', create.call_args.kwargs['messages'][-1]['content'])
+            self.assertNotIn('message 005', create.call_args.kwargs['messages'][-1]['content'])
+            self.session.refresh_from_db()
+            self.assertEqual(self.session.summary, "Summary two.")
+            self.assertEqual(self.session.summary_until, history[7].created_at)
+
+    def test_failed_summary_keeps_the_old_one_and_the_reply_goes_through(self):
+        self.add_messages(10)
+        self.client.get('/api/session/')
+        ChatSession.objects.filter(pk=self.session.pk).update(
+            session_key=self.client.session.session_key, summary='Old summary.'
+        )
+        history = load_context_window(self.session)
+        budget = 4 * message_tokens(history[0])
+
+        with override_settings(CHAT_HISTORY_TOKEN_BUDGET=budget):
+            with mock.patch.object(
+                Completions, 'create', side_effect=[upstream_error(500), fake_completion("Here you go.")]
+            ) as create:
+                response = self.client.post(
+                    f'/api/sessions/{self.session.id}/send_message/',
+                    {'message': 'And then?'},
+                    content_type='application/json'
+                )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['assistant_message']['content'], "Here you go.")
+        self.assertEqual(create.call_count, 2)
+        # the reply was sent with the summary we had
+        self.assertIn('Old summary.', create.call_args.kwargs['messages'][1]['content'])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, 'Old summary.')
+        self.assertIsNone(self.session.summary_until)
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False)
+class SessionListTests(TestCase):
+
+    def test_list_query_count_does_not_depend_on_sessions_or_messages(self):
+        self.client.get('/api/session/')
+        session_key = self.client.session.session_key
+
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+            for i in range(3):
+                response = self.client.post('/api/chat/', {'message': f'question {i}'}, content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+
+        with CaptureQueriesContext(connection) as small:
+            response = self.client.get('/api/sessions/')
+        self.assertEqual(response.status_code, 200)
+
+        first = response.json()['results'][0]
+        self.assertEqual(first['message_count'], 2)
+        self.assertEqual(first['last_message']['message_type'], 'assistant')
+        self.assertEqual(first['last_message']['content'], 'Use a tuple for fixed records.')
+
+        for i in range(10):
+            session = ChatSession.objects.create(session_key=session_key, title=f'Chat {i}')
+            ChatMessage.objects.bulk_create([
+                ChatMessage(session=session, message_type='user', content='hello')
+                for _ in range(20)
+            ])
+
+        with CaptureQueriesContext(connection) as large:
+            self.client.get('/api/sessions/')
+
+        self.assertEqual(len(small), len(large))
+        for query in large.captured_queries:
+            self.assertNotIn('backendApp_chatmessage', query['sql'])
+
+    def test_backfill_command_recomputes_counters(self):
+        session = ChatSession.objects.create(session_key='backfill', title='Old chat')
+        ChatMessage.objects.create(session=session, message_type='user', content='first')
+        ChatMessage.objects.create(session=session, message_type='assistant', content='y' * 150)
+
+        call_command('backfill_session_counters', stdout=StringIO())
+
+        session.refresh_from_db()
+        self.assertEqual(session.message_count, 2)
+        self.assertEqual(session.last_message_type, 'assistant')
+        self.assertEqual(session.last_message_preview, 'y' * 100 + '...')
+
+
+class MessagePaginationTests(TestCase):
+
+    def setUp(self):
+        self.client.get('/api/session/')
+        self.session = ChatSession.objects.create(
+            session_key=self.client.session.session_key, title='Paged chat'
+        )
+        ChatMessage.objects.bulk_create([
+            ChatMessage(session=self.session, message_type='user', content=f'message {i:03d}')
+            for i in range(25)
+        ])
+
+    def test_walks_back_and_forward_without_gaps(self):
+        url = f'/api/sessions/{self.session.id}/messages/?limit=10'
+
+        seen = []
+        page = self.client.get(url).json()
+        newest = page
+        while True:
+            seen = [m['content'] for m in page['results']] + seen
+            if not page['previous']:
+                break
+            page = self.client.get(page['previous']).json()
+
+        self.assertEqual(seen, [f'message {i:03d}' for i in range(25)])
+        self.assertEqual(newest['results'][-1]['content'], 'message 024')
+
+        ChatMessage.objects.create(session=self.session, message_type='user', content='message 025')
+        newer = self.client.get(newest['next']).json()
+        self.assertEqual([m['content'] for m in newer['results']], ['message 025'])
+
+    def test_session_detail_omits_messages_unless_asked(self):
+        detail = self.client.get(f'/api/sessions/{self.session.id}/').json()
+        self.assertNotIn('messages', detail)
+
+        legacy = self.client.get(f'/api/sessions/{self.session.id}/?include_messages=1').json()
+        self.assertEqual(len(legacy['messages']), 25)
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False)
+class ActivityCounterTests(TestCase):
+
+    def test_counters_follow_creates_and_deletes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+                first = self.client.post('/api/chat/', {'message': 'one'}, content_type='application/json').json()
+                self.client.post('/api/chat/', {'message': 'two'}, content_type='application/json')
+
+        with CaptureQueriesContext(connection) as queries:
+            stats = self.client.get('/api/stats/').json()
+        # two counter rows plus one 30-row rollup sum, whatever the table sizes
+        stats_queries = [q for q in queries.captured_queries if 'backendApp_' in q['sql']]
+        self.assertEqual(len(stats_queries), 3)
+        self.assertEqual(stats['total_reviews'], 2)
+        self.assertEqual(stats['total_messages'], 4)
+        self.assertEqual(stats['recent_activity']['reviews_last_30_days'], 2)
+        self.assertEqual(stats['user_session_stats']['total_messages'], 4)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/sessions/{first['session_id']}/")
+
+        stats = self.client.get('/api/stats/').json()
+        self.assertEqual(stats['total_reviews'], 1)
+        self.assertEqual(stats['user_session_stats']['total_messages'], 2)
+        # rollups count activity, deletes do not undo it
+        self.assertEqual(stats['recent_activity']['reviews_last_30_days'], 2)
+
+    def test_reconcile_fixes_drift(self):
+        session = ChatSession.objects.create(session_key='drift', title='Untracked')
+        ChatMessage.objects.create(session=session, message_type='user', content='hello')
+
+        call_command('reconcile_stats', '--daily-days', '7', stdout=StringIO())
+
+        self.assertEqual(get_counts(), {'sessions': 1, 'messages': 1})
+        self.assertEqual(get_counts('drift'), {'sessions': 1, 'messages': 1})
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False)
+class MetricsTests(TestCase):
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_chat_request_is_measured(self):
+        endpoint = {'endpoint': 'backendApp:quick-chat', 'method': 'POST'}
+        requests = self.sample('chat_http_request_duration_seconds_count', status='200', **endpoint)
+        queries = self.sample('chat_http_request_db_queries_sum', **endpoint)
+        llm_calls = self.sample('chat_llm_request_duration_seconds_count', operation='chat', outcome='ok')
+        tokens = self.sample('chat_llm_tokens_sum', operation='chat')
+        serialized = self.sample('chat_serializer_duration_seconds_count', serializer='ChatMessageSerializer')
+
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+            response = self.client.post('/api/chat/', {'message': 'How do I sort a dict?'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.sample('chat_http_request_duration_seconds_count', status='200', **endpoint), requests + 1)
+        self.assertGreater(self.sample('chat_http_request_db_queries_sum', **endpoint), queries)
+        self.assertEqual(self.sample('chat_llm_request_duration_seconds_count', operation='chat', outcome='ok'), llm_calls + 1)
+        self.assertEqual(self.sample('chat_llm_tokens_sum', operation='chat'), tokens + 12)
+        self.assertGreater(self.sample('chat_serializer_duration_seconds_count', serializer='ChatMessageSerializer'), serialized)
+
+        scrape = self.client.get('/metrics')
+        self.assertEqual(scrape.status_code, 200)
+        self.assertIn(b'chat_http_request_duration_seconds_bucket{endpoint="backendApp:quick-chat"', scrape.content)
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        caches[settings.CHAT_RESPONSE_CACHE_ALIAS].clear()
+
+    def tearDown(self):
+        caches[settings.CHAT_RESPONSE_CACHE_ALIAS].clear()
+
+    def quick_chat(self, message):
+        response = self.client.post('/api/chat/', {'message': message}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return ChatMessage.objects.get(pk=response.data['assistant_message']['id'])
+
+    def stats(self):
+        return self.client.get('/api/stats/').data['response_cache']
+
+    def test_repeated_prompt_is_served_from_the_cache(self):
+        before = self.stats()
+        with mock.patch.object(Completions, 'create', return_value=fake_completion("Use sorted().")) as create:
+            first = self.quick_chat('How do I sort a dict?')
+            # a new session, so the same prompt
+            second = self.quick_chat('How do I sort a dict?')
+
+        self.assertEqual(create.call_count, 1)
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual(second.content, "Use sorted().")
+        self.assertEqual(second.status, ChatMessage.STATUS_COMPLETE)
+        self.assertEqual(self.stats(), {'hits': before['hits'] + 1, 'misses': before['misses'] + 1})
+
+    def test_sessions_can_opt_out(self):
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+            self.quick_chat('What is a generator?')
+        session = create_chat_session(self.client.session.session_key, 'No cache')
+        ChatSession.objects.filter(pk=session.pk).update(response_cache_enabled=False)
+        before = self.stats()
+
+        with mock.patch.object(Completions, 'create', return_value=fake_completion("Fresh.")) as create:
+            response = self.client.post(
+                f'/api/sessions/{session.id}/send_message/',
+                {'message': 'What is a generator?'},
+                content_type='application/json'
+            )
+
+        self.assertEqual(create.call_count, 1)
+        assistant = ChatMessage.objects.get(pk=response.data['assistant_message']['id'])
+        self.assertFalse(assistant.cached)
+        self.assertEqual(assistant.content, "Fresh.")
+        # not even looked up
+        self.assertEqual(self.stats(), before)
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.calls = 0
+        self.started = threading.Event()
+
+    def slow_call(self, seconds=0.3):
+        def call():
+            self.calls += 1
+            self.started.set()
+            time.sleep(seconds)
+            return {'response': 'shared answer', 'success': True}
+        return call
+
+    def run_together(self, flights, func):
+        def follow(flight):
+            self.started.wait(1)
+            return flight.do('prompt', func)
+
+        with ThreadPoolExecutor(max_workers=len(flights)) as pool:
+            leader = pool.submit(flights[0].do, 'prompt', func)
+            followers = [pool.submit(follow, flight) for flight in flights[1:]]
+            return [leader.result()] + [f.result() for f in followers]
+
+    def test_concurrent_calls_in_a_process_share_one_call(self):
+        flight = SingleFlight(lock_dir=self.lock_dir, timeout=5)
+        results = self.run_together([flight] * 4, self.slow_call())
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([shared for _, shared in results], [False, True, True, True])
+        self.assertTrue(all(result['response'] == 'shared answer' for result, _ in results))
+
+    def test_workers_share_a_call_through_the_lock_file(self):
+        # separate instances stand in for separate worker processes
+        workers = [SingleFlight(lock_dir=self.lock_dir, timeout=5) for _ in range(3)]
+        results = self.run_together(workers, self.slow_call())
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([shared for _, shared in results], [False, True, True])
+
+    def test_waiters_call_independently_after_the_timeout(self):
+        workers = [SingleFlight(lock_dir=self.lock_dir, timeout=0.1) for _ in range(2)]
+        results = self.run_together(workers, self.slow_call(seconds=0.5))
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual([shared for _, shared in results], [False, False])
+
+    def test_calls_after_the_leader_finished_are_not_shared(self):
+        flight = SingleFlight(lock_dir=self.lock_dir, timeout=5)
+        flight.do('prompt', self.slow_call(seconds=0))
+        _, shared = flight.do('prompt', self.slow_call(seconds=0))
+
+        self.assertEqual(self.calls, 2)
+        self.assertFalse(shared)
+
+    @override_settings(
+        OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False,
+        CHAT_LLM_MAX_ATTEMPTS=1, CHAT_LLM_HEDGE_ENABLED=False
+    )
+    def test_shared_failure_is_counted_once(self):
+        flight = SingleFlight(lock_dir=self.lock_dir, timeout=5)
+
+        def failing_call(*args, **kwargs):
+            self.calls += 1
+            self.started.set()
+            time.sleep(0.3)
+            raise upstream_error(400)
+
+        def ask():
+            self.started.wait(1)
+            return CodingChatAI().get_response('Why does this fail?')
+
+        failures = REGISTRY.get_sample_value('chat_llm_failures_total', {'reason': 'upstream_error'}) or 0
+        resilience._caller = None
+        try:
+            with mock.patch('backendApp.services.ai_service.get_single_flight', return_value=flight), \
+                    mock.patch.object(Completions, 'create', side_effect=failing_call):
+                with ThreadPoolExecutor(max_workers=4) as pool:
+                    leader = pool.submit(CodingChatAI().get_response, 'Why does this fail?')
+                    followers = [pool.submit(ask) for _ in range(3)]
+                    results = [leader.result()] + [f.result() for f in followers]
+        finally:
+            resilience._caller = None
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([result['error_type'] for result in results], ['upstream_error'] * 4)
+        self.assertEqual(
+            REGISTRY.get_sample_value('chat_llm_failures_total', {'reason': 'upstream_error'}), failures + 1
+        )
+
+
+def upstream_error(status, headers=None):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(status, headers=headers, request=request)
+    return openai.APIStatusError(f'Error code: {status}', response=response, body=None)
+
+
+@override_settings(
+    CHAT_LLM_RETRY_BASE_DELAY=0, CHAT_LLM_MAX_ATTEMPTS=3, CHAT_LLM_BREAKER_FAILURES=3,
+    CHAT_LLM_BREAKER_RESET_TIMEOUT=0.2, CHAT_LLM_HEDGE_ENABLED=False
+)
+class ResilienceTests(SimpleTestCase):
+
+    def flaky(self, *errors, result='ok', seconds=0):
+        calls = []
+
+        def call(timeout):
+            calls.append(timeout)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            time.sleep(seconds)
+            return result
+        return call, calls
+
+    def test_retries_retryable_errors(self):
+        call, calls = self.flaky(upstream_error(503), upstream_error(429))
+        self.assertEqual(ResilientCaller().call(call), 'ok')
+        self.assertEqual(len(calls), 3)
+
+    def test_does_not_retry_bad_requests(self):
+        call, calls = self.flaky(upstream_error(400))
+        with self.assertRaises(openai.APIStatusError):
+            ResilientCaller().call(call)
+        self.assertEqual(len(calls), 1)
+
+    def test_gives_up_when_the_deadline_is_near(self):
+        caller = ResilientCaller()
+        call, calls = self.flaky(upstream_error(429, {'retry-after': '30'}))
+        with self.assertRaises(resilience.DeadlineExceeded):
+            caller.call(call, deadline=resilience.Deadline(5))
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_opens_and_recovers(self):
+        caller = ResilientCaller()
+        call, calls = self.flaky(*[upstream_error(500)] * 3)
+        with self.assertRaises(openai.APIStatusError):
+            caller.call(call)
+
+        with self.assertRaises(CircuitOpenError):
+            caller.call(call)
+        self.assertEqual(len(calls), 3)
+
+        time.sleep(0.25)
+        # half open: a trial call goes through and closes the circuit
+        self.assertEqual(caller.call(call), 'ok')
+        self.assertEqual(caller.breaker.state, caller.breaker.CLOSED)
+
+    @override_settings(CHAT_LLM_HEDGE_ENABLED=True, CHAT_LLM_HEDGE_MIN_SAMPLES=5)
+    def test_slow_attempt_is_hedged(self):
+        caller = ResilientCaller()
+        for _ in range(10):
+            caller.latencies.observe(0.05)
+
+        attempts = []
+
+        def call(timeout):
+            attempts.append(timeout)
+            if len(attempts) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'hedged'
+
+        start = time.monotonic()
+        self.assertEqual(caller.call(call, hedge=True), 'hedged')
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(attempts), 2)
+
+
+@override_settings(
+    OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False,
+    CHAT_LLM_RETRY_BASE_DELAY=0, CHAT_LLM_MAX_ATTEMPTS=2
+)
+class UpstreamFailureTests(TestCase):
+
+    def setUp(self):
+        resilience._caller = None
+
+    def tearDown(self):
+        resilience._caller = None
+
+    def test_failed_reply_is_stored_as_failed_with_its_reason(self):
+        with mock.patch.object(Completions, 'create', side_effect=upstream_error(502)) as create:
+            response = self.client.post('/api/chat/', {'message': 'Why is my loop slow?'}, content_type='application/json')
+
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(response.status_code, 200)
+        assistant = ChatMessage.objects.get(message_type='assistant')
+        self.assertEqual(assistant.status, ChatMessage.STATUS_FAILED)
+        self.assertTrue(assistant.error.startswith('upstream_error: '))
+
+
+@override_settings(OPENAI_API_KEY='test-key')
+class OpenAIClientTests(SimpleTestCase):
+
+    def tearDown(self):
+        openai_client.close_clients()
+
+    def test_client_is_shared_and_replaced_after_fork(self):
+        client = openai_client.get_client()
+        self.assertIs(openai_client.get_client(), client)
+        self.assertEqual(client.max_retries, 0)
+
+        with mock.patch('os.getpid', return_value=-1):
+            forked = openai_client.get_client()
+        self.assertIsNot(forked, client)
+        client.close()
+
+    @override_settings(OPENAI_WARMUP_REQUEST=True)
+    async def test_async_client_is_warmed_and_closed_in_the_asgi_lifespan(self):
+        from backend.asgi import application
+
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+            if message['type'] == 'lifespan.startup.complete':
+                self.assertIsNotNone(openai_client._async_client)
+
+        with mock.patch.object(AsyncModels, 'list', new_callable=mock.AsyncMock) as models:
+            await application({'type': 'lifespan'}, receive, send)
+
+        models.assert_awaited_once()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertIsNone(openai_client._async_client)
+
+
+@override_settings(
+    OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False, CHAT_LLM_MAX_ATTEMPTS=1,
+    CHAT_JOB_MAX_ATTEMPTS=2, CHAT_JOB_RETRY_DELAY=0
+)
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        resilience._caller = None
+
+    def tearDown(self):
+        resilience._caller = None
+
+    def queue_message(self):
+        response = self.client.post('/api/chat/?async=1', {'message': 'Review my code'}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Location'], response.data['poll_url'])
+        return response.data['assistant_message']['id']
+
+    def test_queued_reply_is_generated_by_a_worker(self):
+        message_id = self.queue_message()
+        self.assertEqual(ChatMessage.objects.get(pk=message_id).status, ChatMessage.STATUS_PENDING)
+        # the queue owns the message, it is not abandoned
+        self.assertEqual(reconcile_pending(timezone.now() + timedelta(days=1), dry_run=True), 0)
+
+        with mock.patch.object(Completions, 'create', return_value=fake_completion("Looks good.")):
+            self.assertTrue(run_next_job('worker-1'))
+        self.assertFalse(run_next_job('worker-1'))
+
+        response = self.client.get(f'/api/messages/{message_id}/?wait=5')
+        self.assertEqual(response.data['status'], ChatMessage.STATUS_COMPLETE)
+        self.assertEqual(response.data['content'], "Looks good.")
+        self.assertEqual(ChatJob.objects.get().status, ChatJob.STATUS_DONE)
+
+    def test_transient_failures_are_retried_then_fail(self):
+        message_id = self.queue_message()
+
+        with mock.patch.object(Completions, 'create', side_effect=upstream_error(503)) as create:
+            run_next_job('worker-1')
+            self.assertEqual(ChatJob.objects.get().status, ChatJob.STATUS_QUEUED)
+            self.assertEqual(ChatMessage.objects.get(pk=message_id).status, ChatMessage.STATUS_PENDING)
+            run_next_job('worker-1')
+
+        self.assertEqual(create.call_count, 2)
+        job = ChatJob.objects.get()
+        self.assertEqual(job.status, ChatJob.STATUS_FAILED)
+        self.assertEqual(job.assistant_message.status, ChatMessage.STATUS_FAILED)
+
+    def test_expired_lease_is_taken_over(self):
+        self.queue_message()
+        stale = claim_job('worker-1')
+        self.assertIsNone(claim_job('worker-2'))
+
+        ChatJob.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        job = claim_job('worker-2')
+        self.assertEqual(job.attempts, 2)
+
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+            run_job(stale, 'worker-1')
+            # the first worker lost its lease, its result is dropped
+            self.assertEqual(ChatJob.objects.get().status, ChatJob.STATUS_RUNNING)
+            run_job(job, 'worker-2')
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.STATUS_DONE)
+
+
+@override_settings(OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False, CHAT_LLM_MAX_ATTEMPTS=1)
+class StreamingContentTests(SimpleTestCase):
+
+    def lines(self, produced, closed):
+        try:
+            for n in range(3):
+                produced.append(n)
+                yield f'{n}\n'
+        finally:
+            closed.append(True)
+
+    async def test_asgi_lines_go_out_as_they_are_ready(self):
+        produced, closed = [], []
+        content = streaming_content(AsyncRequestFactory().get('/'), self.lines(produced, closed))
+        self.assertTrue(hasattr(content, '__aiter__'))
+
+        self.assertEqual(await content.__anext__(), '0\n')
+        # nothing read ahead of the client
+        self.assertEqual(produced, [0])
+        await content.aclose()
+        self.assertEqual(closed, [True])
+
+    def test_wsgi_lines_are_left_alone(self):
+        lines = self.lines([], [])
+        self.assertIs(streaming_content(RequestFactory().get('/'), lines), lines)
+
+
+class BatchChatTests(TestCase):
+
+    def setUp(self):
+        resilience._caller = None
+        self.client.get('/api/session/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.session = create_chat_session(self.client.session.session_key, 'New Chat')
+
+    def tearDown(self):
+        resilience._caller = None
+
+    def answer(self, create, model, messages, **kwargs):
+        question = messages[-1]['content']
+        if 'fail' in question:
+            raise upstream_error(400)
+        return fake_completion(f"Answer to {question}")
+
+    def post_batch(self, items, path='/api/chat/batch/'):
+        with mock.patch.object(Completions, 'create', autospec=True, side_effect=self.answer):
+            response = self.client.post(path, {'items': items, 'concurrency': 3}, content_type='application/json')
+            if response.streaming:
+                response.lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+            return response
+
+    def test_results_come_back_in_order(self):
+        items = [{'message': f'question {i}', 'session_id': str(self.session.id)} for i in range(2)]
+        items += [{'message': 'question 2'}, {'message': 'question 3'}]
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.post_batch(items)
+        # one bulk insert for all the messages
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "backendApp_chatmessage"')]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([r['index'] for r in results], [0, 1, 2, 3])
+        self.assertEqual([r['assistant_message']['content'] for r in results],
+                         [f"Answer to question {i}" for i in range(4)])
+        self.assertEqual(response.data['succeeded'], 4)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 4)
+        self.assertEqual(self.session.title, CodingChatAI.generate_session_title('question 0'))
+        self.assertEqual(ChatSession.objects.count(), 3)
+        self.assertEqual(get_counts(self.session.session_key), {'sessions': 3, 'messages': 8})
+
+    def test_streamed_results_report_failures(self):
+        response = self.post_batch([{'message': 'please fail'}, {'message': 'fine'}], '/api/chat/batch/?stream=1')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = response.lines
+
+        by_index = {line['index']: line for line in lines[:-1]}
+        self.assertFalse(by_index[0]['success'])
+        self.assertTrue(by_index[0]['error'].startswith('upstream_error: '))
+        self.assertTrue(by_index[1]['success'])
+        self.assertEqual(lines[-1], {'done': True, 'succeeded': 1, 'failed': 1})
+        self.assertFalse(ChatMessage.objects.filter(status=ChatMessage.STATUS_PENDING).exists())
+
+    def test_unexpected_error_fails_the_pending_items(self):
+        in_flight = REGISTRY.get_sample_value('chat_upstream_in_flight')
+        with mock.patch('backendApp.services.batch_chat.update_rolling_summary', side_effect=RuntimeError('db down')):
+            response = self.post_batch([{'message': 'one'}, {'message': 'two'}])
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.data, {'error': 'Failed to process messages'})
+        assistants = ChatMessage.objects.filter(message_type='assistant')
+        self.assertEqual(assistants.count(), 2)
+        self.assertEqual({msg.status for msg in assistants}, {ChatMessage.STATUS_FAILED})
+        self.assertEqual({msg.error for msg in assistants}, {'db down'})
+        # the admission permit was released
+        self.assertEqual(REGISTRY.get_sample_value('chat_upstream_in_flight'), in_flight)
+
+    def test_every_item_is_validated(self):
+        response = self.post_batch([{'message': 'ok'}, {'message': '   '}])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('message', response.data['items'][1])
+        self.assertFalse(ChatMessage.objects.exists())
+
+
+class AdmissionTests(TestCase):
+
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            OPENAI_API_KEY='test-key', CHAT_RESPONSE_CACHE_ENABLED=False, CHAT_ADMISSION_STATE_DIR=state_dir,
+            CHAT_RATE_LIMIT_BURST=2, CHAT_RATE_LIMIT_REQUESTS=1, CHAT_RATE_LIMIT_TOKENS=600
+        )
+        self.settings_override.enable()
+        admission._buckets = admission._slots = None
+
+    def tearDown(self):
+        self.settings_override.disable()
+        admission._buckets = admission._slots = None
+
+    def chat(self):
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+            return self.client.post('/api/chat/', {'message': 'Why is my loop slow?'}, content_type='application/json')
+
+    def test_session_request_budget(self):
+        self.assertEqual(self.chat().status_code, 200)
+        self.assertEqual(self.chat().status_code, 200)
+
+        response = self.chat()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.data['reason'], 'rate_limited')
+        # one request per minute refills in about a minute
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(ChatMessage.objects.count(), 4)
+
+    def test_batches_cost_a_request_per_item(self):
+        def batch(count):
+            with mock.patch.object(Completions, 'create', return_value=fake_completion()):
+                return self.client.post(
+                    '/api/chat/batch/', {'items': [{'message': f'Question {n}'} for n in range(count)]},
+                    content_type='application/json'
+                )
+
+        response = batch(3)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.data['reason'], 'over_burst')
+        self.assertFalse(ChatMessage.objects.exists())
+
+        self.assertEqual(batch(2).status_code, 200)
+        self.assertEqual(self.chat().data['reason'], 'rate_limited')
+
+    def test_session_token_budget(self):
+        self.assertEqual(self.chat().status_code, 200)
+        admission.get_session_buckets().charge(self.client.session.session_key, 1000)
+
+        response = self.chat()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.data['reason'], 'token_budget')
+
+    def test_upstream_slots_are_shared_and_queued(self):
+        state_dir = tempfile.mkdtemp()
+        # two instances on one directory, like two workers
+        first, second = UpstreamSlots(1, state_dir), UpstreamSlots(1, state_dir)
+        slot = first.acquire('a')
+
+        with override_settings(CHAT_ADMISSION_QUEUE_PER_SESSION=1):
+            with self.assertRaises(AdmissionRejected) as rejected:
+                second.acquire('b', timeout=0.1)
+            self.assertEqual(rejected.exception.reason, 'queue_timeout')
+
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                waiting = pool.submit(second.acquire, 'b', 5)
+                while not second._queue:
+                    time.sleep(0.01)
+                with self.assertRaises(AdmissionRejected) as rejected:
+                    second.acquire('b', timeout=1)
+                self.assertEqual(rejected.exception.reason, 'session_queue_full')
+
+                slot.release()
+                waiting.result().release()
+
+    @override_settings(CHAT_UPSTREAM_CONCURRENCY=1, CHAT_ADMISSION_QUEUE_TIMEOUT=0.05)
+    def test_requests_refused_by_the_queue_are_refunded(self):
+        slot = admission.get_upstream_slots().try_acquire()
+        for _ in range(3):
+            with self.assertRaises(AdmissionRejected) as rejected:
+                admission.admit('refund-test')
+            self.assertEqual(rejected.exception.reason, 'queue_timeout')
+        slot.release()
+
+        # the burst of 2 is still there
+        admission.admit('refund-test').release()
+        admission.admit('refund-test').release()
+        with self.assertRaises(AdmissionRejected) as rejected:
+            admission.admit('refund-test')
+        self.assertEqual(rejected.exception.reason, 'rate_limited')
+
+    @override_settings(CHAT_UPSTREAM_CONCURRENCY=1, CHAT_ADMISSION_QUEUE_TIMEOUT=0.05)
+    async def test_async_admission_keeps_the_bucket_files_off_the_loop(self):
+        buckets = admission.get_session_buckets()
+        update = buckets._update
+        threads = []
+
+        def tracked_update(session_key, func):
+            threads.append(threading.get_ident())
+            return update(session_key, func)
+
+        slot = admission.get_upstream_slots().try_acquire()
+        with mock.patch.object(buckets, '_update', side_effect=tracked_update):
+            with self.assertRaises(AdmissionRejected):
+                await admission.aadmit('async-test')
+            slot.release()
+
+            permit = await admission.aadmit('async-test')
+            await permit.acharge(10)
+            permit.release()
+
+        # taken and refunded, taken, charged
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.client.get('/api/session/')
+        self.session = ChatSession.objects.create(
+            session_key=self.client.session.session_key, title='Sorting'
+        )
+        other = ChatSession.objects.create(session_key='someone-else', title='Sorting')
+        ChatMessage.objects.create(session=self.session, message_type='user', content='How do I sort a dict by value?')
+        ChatMessage.objects.create(session=other, message_type='user', content='Sort a dict by key')
+
+    def search(self, query):
+        return self.client.get('/api/search/', {'q': query})
+
+    def test_ranked_hits_of_own_sessions(self):
+        reply = ChatMessage.objects.create(
+            session=self.session, message_type='assistant', content='', status=ChatMessage.STATUS_PENDING
+        )
+        # replies are indexed once they are filled in
+        reply.content = 'Use sorted(d.items(), key=lambda kv: kv[1]) to sort by <value>'
+        reply.save()
+
+        response = self.search('lambda value')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        hit = response.data['results'][0]
+        self.assertEqual(hit['id'], reply.id)
+        self.assertEqual(hit['session_title'], 'Sorting')
+        self.assertIn('<mark>lambda</mark>', hit['snippet'])
+        self.assertIn('&lt;<mark>value</mark>&gt;', hit['snippet'])
+
+        # the other session's message matches too, but is not the caller's
+        self.assertEqual(self.search('dict').data['count'], 1)
+        reply.delete()
+        self.assertEqual(self.search('lambda').data['count'], 0)
+        self.assertEqual(self.search('"" OR *').data['count'], 0)
+        self.assertEqual(self.search('').status_code, 400)
+
+    def test_hits_survive_renumbered_rowids(self):
+        message = ChatMessage.objects.get(session=self.session)
+        # what VACUUM or a table rebuild may do to the implicit rowid of a UUID-keyed table
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE "{ChatMessage._meta.db_table}" SET rowid = rowid + 1000')
+
+        hits = self.search('dict').data['results']
+        self.assertEqual([hit['id'] for hit in hits], [message.id])
+        message.delete()
+        self.assertEqual(self.search('dict').data['count'], 0)
+
+    def test_admin_search_uses_the_index(self):
+        from .admin import ChatMessageAdmin
+        from django.contrib.admin.sites import site
+
+        model_admin = ChatMessageAdmin(ChatMessage, site)
+        results, _ = model_admin.get_search_results(None, ChatMessage.objects.all(), 'dict')
+        self.assertEqual(results.count(), 2)
+        results, _ = model_admin.get_search_results(None, ChatMessage.objects.all(), 'Sorting')
+        self.assertEqual(results.count(), 2)
+        results, _ = model_admin.get_search_results(None, ChatMessage.objects.all(), 'value')
+        self.assertEqual(results.count(), 1)
+
+
+class PruneChatsTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.old = create_chat_session('pruned', 'Old chat')
+            self.recent = create_chat_session('pruned', 'Recent chat')
+            for session in (self.old, self.recent):
+                begin_exchange(session, 'How do I read a file?')
+                ChatJob.objects.create(
+                    user_message=session.messages.first(),
+                    assistant_message=session.messages.last(),
+                    available_at=timezone.now()
+                )
+        ChatSession.objects.filter(pk=self.old.pk).update(
+            last_message_at=timezone.now() - timedelta(days=100)
+        )
+        self.archive_dir = tempfile.mkdtemp()
+
+    def prune_chats(self, *args):
+        out = StringIO()
+        call_command('prune_chats', '--archive-dir', self.archive_dir, *args, stdout=out)
+        return out.getvalue()
+
+    def test_archives_then_deletes_in_batches(self):
+        self.assertIn('1 sessions with 2 messages', self.prune_chats('--older-than', '90', '--dry-run'))
+        self.assertTrue(ChatSession.objects.filter(pk=self.old.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            out = self.prune_chats('--older-than', '90', '--message-batch-size', '1')
+        self.assertIn('Pruned 1 sessions and 2 messages', out)
+        self.assertEqual(list(ChatSession.objects.values_list('pk', flat=True)), [self.recent.pk])
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        self.assertEqual(ChatJob.objects.count(), 1)
+        self.assertEqual(get_counts('pruned'), {'sessions': 1, 'messages': 2})
+
+        [run_dir] = [name for name in os.listdir(self.archive_dir) if name.startswith('prune-')]
+        with gzip.open(os.path.join(self.archive_dir, run_dir, 'batch-00001.ndjson.gz'), 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['type'] for r in records], ['archive', 'session', 'message', 'message'])
+        self.assertEqual(records[1]['id'], str(self.old.pk))
+
+    def test_resumes_an_interrupted_run(self):
+        run = PruneRun.start(self.archive_dir, older_than_days=90)
+        run.archive(run.next_batch(10))
+        # the process died before deleting the batch, another one starts
+        out = self.prune_chats('--expired-sessions')
+
+        self.assertIn('Resuming', out)
+        self.assertIn('Pruned 1 sessions', out)
+        self.assertFalse(ChatSession.objects.filter(pk=self.old.pk).exists())
+        self.assertTrue(ChatSession.objects.filter(pk=self.recent.pk).exists())
+        self.assertEqual(len(os.listdir(run.path)), 2)
+
+    def test_sessions_kept_after_archiving_leave_the_batch_file(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            revived = create_chat_session('pruned', 'Revived chat')
+            begin_exchange(revived, 'Still there?')
+        ChatSession.objects.filter(pk=revived.pk).update(
+            last_message_at=timezone.now() - timedelta(days=100)
+        )
+        run = PruneRun.start(self.archive_dir, older_than_days=90)
+        run.archive(run.next_batch(10))
+        batch_file = os.path.join(run.path, run.state['pending']['file'])
+        # a new message between archiving and deleting
+        ChatSession.objects.filter(pk=revived.pk).update(last_message_at=timezone.now())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            run.delete_pending(1000, 0)
+        self.assertTrue(ChatSession.objects.filter(pk=revived.pk).exists())
+        self.assertFalse(ChatSession.objects.filter(pk=self.old.pk).exists())
+        with gzip.open(batch_file, 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['type'] for r in records], ['archive', 'session', 'message', 'message'])
+        self.assertEqual(records[1]['id'], str(self.old.pk))
+
+        # retried after a crash: the deleted sessions stay in the file
+        run.state['pending'] = {'file': os.path.basename(batch_file), 'ids': [str(self.old.pk), str(revived.pk)]}
+        run.delete_pending(1000, 0)
+        with gzip.open(batch_file, 'rt') as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+
+class SessionDeletionTests(TestCase):
+
+    def setUp(self):
+        self.client.get('/api/session/')
+        self.session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        with self.captureOnCommitCallbacks(execute=True):
+            self.session = create_chat_session(self.session_key, 'Long chat')
+            for n in range(3):
+                user_msg, assistant_msg, _ = begin_exchange(self.session, f'Question {n}')
+            ChatJob.objects.create(user_message=user_msg, assistant_message=assistant_msg, available_at=timezone.now())
+
+    @override_settings(CHAT_DELETE_BATCH_SIZE=2)
+    def test_messages_go_in_bounded_raw_batches(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f'/api/sessions/{self.session.id}/')
+        self.assertEqual(response.status_code, 204)
+
+        deletes = [q['sql'] for q in queries if q['sql'].startswith('DELETE FROM "backendApp_chatmessage"')]
+        self.assertEqual(len(deletes), 3)
+        self.assertFalse(ChatSession.objects.exists())
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertFalse(ChatJob.objects.exists())
+        self.assertEqual(get_counts(self.session_key), {'sessions': 0, 'messages': 0})
+
+    def test_background_delete_marks_then_purges(self):
+        with mock.patch.object(chat_service, '_purge_in_background') as purge, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f'/api/sessions/{self.session.id}/?async=1')
+        self.assertEqual(response.status_code, 202)
+        purge.assert_called_once_with([self.session.id], [])
+
+        # gone for its owner and the counters, the rows are still there
+        self.assertEqual(self.client.get(f'/api/sessions/{self.session.id}/').status_code, 404)
+        self.assertEqual(get_counts(self.session_key), {'sessions': 0, 'messages': 0})
+        self.assertEqual(ChatMessage.objects.count(), 6)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(purge_deleted_sessions([self.session.id]), (1, 6))
+        self.assertFalse(ChatSession.objects.exists())
+        self.assertEqual(get_counts(), {'sessions': 0, 'messages': 0})
+
+    def add_review(self, files=3):
+        review = CodeReview.objects.create(session_key=self.session_key, name='project.zip', file_count=files)
+        ReviewedFile.objects.bulk_create([
+            ReviewedFile(review=review, path=f'app/mod_{n}.py', fingerprint=f'{n:064d}') for n in range(files)
+        ])
+        return review
+
+    @override_settings(CHAT_DELETE_BATCH_SIZE=2)
+    def test_clearing_the_session_deletes_reviews_in_bounded_raw_batches(self):
+        self.add_review()
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/session/')
+        self.assertEqual(response.status_code, 200)
+
+        deletes = [q['sql'] for q in queries if q['sql'].startswith('DELETE FROM "backendApp_reviewedfile"')]
+        # two batches, then the files written since
+        self.assertEqual(len(deletes), 3)
+        self.assertFalse(CodeReview.objects.exists())
+        self.assertFalse(ReviewedFile.objects.exists())
+        self.assertFalse(ChatSession.objects.exists())
+
+    def test_marked_reviews_are_hidden_from_their_owner(self):
+        review = self.add_review()
+        self.assertEqual(len(self.client.get('/api/reviews/').json()), 1)
+        CodeReview.objects.filter(pk=review.pk).update(deleted_at=timezone.now())
+        self.assertEqual(self.client.get('/api/reviews/').json(), [])
+        self.assertEqual(self.client.get(f'/api/reviews/{review.id}/').status_code, 404)
+
+    def test_worker_exit_purges_only_its_unfinished_deletes(self):
+        review = self.add_review()
+        unowned = CodeReview.objects.create(session_key='', name='no owner')
+        # marked by another worker, left to prune_chats
+        elsewhere = CodeReview.objects.create(session_key='other', name='other.zip', deleted_at=timezone.now())
+        with mock.patch.object(chat_service, 'threading') as threads, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/session/?async=1')
+        self.assertEqual(response.status_code, 202)
+        threads.Thread.return_value.start.assert_called_once()
+        self.assertIsNotNone(CodeReview.objects.get(pk=review.pk).deleted_at)
+        self.assertEqual(ReviewedFile.objects.count(), 3)
+
+        # the worker exits before its purge thread got to it
+        spec = importlib.util.spec_from_file_location('gunicorn_conf', settings.BASE_DIR / 'gunicorn.conf.py')
+        gunicorn_conf = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ):
+            # it sets PROMETHEUS_MULTIPROC_DIR
+            spec.loader.exec_module(gunicorn_conf)
+        self.addCleanup(chat_service._unfinished_purges.clear)
+        with mock.patch('backendApp.services.code_analysis.close_pool'), \
+                mock.patch('backendApp.services.openai_client.close_clients'), \
+                self.captureOnCommitCallbacks(execute=True):
+            gunicorn_conf.worker_exit(None, None)
+        self.assertFalse(ReviewedFile.objects.exists())
+        self.assertFalse(ChatSession.objects.exists())
+        self.assertEqual(set(CodeReview.objects.values_list('pk', flat=True)), {unowned.pk, elsewhere.pk})
+
+        self.assertEqual(chat_service.purge_deleted_reviews(), 1)
+        self.assertEqual(list(CodeReview.objects.values_list('pk', flat=True)), [unowned.pk])
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.client.get('/api/session/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.session = create_chat_session(self.client.session.session_key, 'Exported')
+            begin_exchange(self.session, 'What does yield do?')
+            create_chat_session('someone-else', 'Not exported')
+
+    def test_streams_own_sessions_and_imports_them_back(self):
+        response = self.client.get('/api/export/?gzip=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('.ndjson.gz', response['Content-Disposition'])
+
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([r['type'] for r in records], ['archive', 'session', 'message', 'message'])
+        self.assertEqual(records[1]['id'], str(self.session.id))
+
+        before = list(ChatMessage.objects.values_list('id', 'content', 'created_at'))
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_chat_sessions(ChatSession.objects.filter(pk=self.session.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(import_records(read_records(lines), batch_size=1), (1, 2))
+        self.assertEqual(import_records(read_records(lines)), (0, 0))
+
+        self.assertEqual(list(ChatMessage.objects.values_list('id', 'content', 'created_at')), before)
+        self.assertEqual(get_counts(self.session.session_key), {'sessions': 1, 'messages': 2})
+
+    def test_global_export_is_staff_only(self):
+        self.assertEqual(self.client.get('/api/export/all/').status_code, 403)
+
+        User.objects.create_user('admin', password='pw', is_staff=True)
+        self.client.login(username='admin', password='pw')
+        response = self.client.get('/api/export/all/')
+        self.assertEqual(response.status_code, 200)
+        sessions = [line for line in b''.join(response.streaming_content).splitlines() if b'"session"' in line]
+        self.assertEqual(len(sessions), 2)
+
+
+BROKEN_SNIPPET = """Why does this fail?
+```python
+import os
+
+def add(item, items=[]):
+    if item == None:
+        return items
+    items.append(item
+    return items
+```
+"""
+
+
+@override_settings(CHAT_RESPONSE_CACHE_ENABLED=False, CHAT_CODE_ANALYSIS_WORKERS=0)
+class SessionActivityTests(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch.object(session_activity, '_activity', SessionActivity(clock=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches['sessions'].clear()
+
+    def session_writes(self, path, times=1):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(times):
+                response = self.client.get(path)
+        writes = [q['sql'] for q in queries if 'django_session' in q['sql'] and not q['sql'].startswith('SELECT')]
+        return writes, response
+
+    def test_activity_is_written_behind_in_batches(self):
+        self.client.get('/api/session/')
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+        writes, response = self.session_writes('/api/stats/', 5)
+        self.assertEqual(writes, [])
+        # the cookie slides without saving the session
+        self.assertEqual(response.cookies[settings.SESSION_COOKIE_NAME].value, session_key)
+        seen = session_activity.last_activity(session_key)
+        self.assertEqual(self.client.get('/api/session/').data['last_activity'], seen.isoformat())
+
+        self.now += settings.CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL
+        writes, _ = self.session_writes('/api/stats/')
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('UPDATE'))
+
+        caches['sessions'].clear()
+        expire_date = Session.objects.get(session_key=session_key).expire_date
+        self.assertGreater(session_activity.last_activity(session_key), seen)
+        self.assertEqual(
+            session_activity.last_activity(session_key),
+            expire_date - timedelta(seconds=settings.SESSION_COOKIE_AGE)
+        )
+
+
+class CodeAnalysisTests(TestCase):
+
+    def test_hints_reach_the_prompt_and_the_reply(self):
+        self.client.get('/api/session/')
+        session = create_chat_session(self.client.session.session_key, 'Code review')
+
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()) as create:
+            response = self.client.post(
+                f'/api/sessions/{session.id}/send_message/', {'message': BROKEN_SNIPPET},
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+
+        messages = create.call_args.kwargs['messages']
+        self.assertEqual(messages[-1], {'role': 'user', 'content': BROKEN_SNIPPET.strip()})
+        self.assertEqual(messages[-2]['role'], 'system')
+        self.assertIn("syntax error at line 6", messages[-2]['content'])
+
+        analysis = response.json()['assistant_message']['code_analysis']
+        self.assertEqual(analysis[0]['block'], 1)
+        self.assertEqual(analysis[0]['language'], 'python')
+        self.assertEqual(ChatMessage.objects.get(message_type='assistant').code_analysis, analysis)
+
+    def test_lint_findings_are_cached_by_content(self):
+        fixed = BROKEN_SNIPPET.replace('items.append(item', 'items.append(item)')
+        analysis = analyze_message(fixed)
+        self.assertIsNone(analysis[0]['syntax_error'])
+        self.assertEqual(
+            [finding['code'] for finding in analysis[0]['findings']],
+            ['unused-import', 'mutable-default', 'none-comparison']
+        )
+        self.assertIn("line 4 none-comparison", hints_message(analysis))
+
+        with mock.patch('backendApp.services.code_analysis.analyze_snippet') as analyze:
+            self.assertEqual(analyze_message(fixed), analysis)
+        analyze.assert_not_called()
+        self.assertEqual(analyze_message("No code here."), [])
+
+    @override_settings(CHAT_CODE_ANALYSIS_WORKERS=1)
+    def test_pool_results_match_inline_ones(self):
+        self.addCleanup(close_pool)
+        snippet = BROKEN_SNIPPET.replace('import os', 'import sys')
+        pooled = analyze_message(snippet)
+        self.assertTrue(pooled[0]['syntax_error'])
+        # another cache, so the second run is not a hit
+        with override_settings(CHAT_CODE_ANALYSIS_WORKERS=0, CHAT_CODE_ANALYSIS_CACHE_ALIAS='chat_responses'):
+            self.assertEqual(analyze_message(snippet), pooled)
+
+    @override_settings(CHAT_CODE_ANALYSIS_WORKERS=0)
+    async def test_async_analysis_keeps_the_cache_and_analysers_off_the_loop(self):
+        threads = {}
+
+        def tracked(name, func):
+            def call(*args):
+                threads[name] = threading.get_ident()
+                return func(*args)
+            return mock.patch.object(code_analysis, name, side_effect=call)
+
+        snippet = BROKEN_SNIPPET.replace('import os', 'import json')
+        with tracked('_cached', code_analysis._cached), tracked('_store', code_analysis._store), \
+                tracked('_analyze_blocks', code_analysis._analyze_blocks):
+            analysis = await aanalyze_message(snippet)
+
+        self.assertTrue(analysis[0]['syntax_error'])
+        self.assertEqual(sorted(threads), ['_analyze_blocks', '_cached', '_store'])
+        self.assertNotIn(threading.get_ident(), threads.values())
+
+
+@override_settings(CHAT_RESPONSE_CACHE_ENABLED=False, CHAT_CODE_ANALYSIS_WORKERS=0)
+class RevisionDiffTests(TestCase):
+
+    def test_revised_code_is_sent_as_a_diff(self):
+        self.client.get('/api/session/')
+        session = create_chat_session(self.client.session.session_key, 'Review loop')
+        functions = [f"def step_{i}(data):\n    result = transform(data, {i})\n    return result\n" for i in range(20)]
+        first = "Please review\n```python\n" + ''.join(functions) + "```"
+        functions[7] = functions[7].replace('return result', 'return result or data')
+        revised = "Fixed, better?\n```python\n" + ''.join(functions) + "```"
+
+        responses = []
+        with mock.patch.object(Completions, 'create', return_value=fake_completion()) as create:
+            for message in (first, revised):
+                responses.append(self.client.post(
+                    f'/api/sessions/{session.id}/send_message/', {'message': message},
+                    content_type='application/json'
+                ).json())
+
+        earlier, latest = [m['content'] for m in create.call_args.kwargs['messages'] if m['role'] == 'user']
+        self.assertEqual(earlier, first)
+        self.assertTrue(latest.startswith(
+            'Fixed, better?\n(revised version of code block 1 of my message starting "Please review"'
+        ))
+        self.assertIn("-    return result\n+    return result or data", latest)
+        self.assertNotIn('def step_19', latest)
+
+        self.assertIsNone(responses[0]['assistant_message']['prompt_tokens_saved'])
+        self.assertGreater(responses[1]['assistant_message']['prompt_tokens_saved'], 100)
+        self.assertEqual(ChatMessage.objects.filter(message_type='user').order_by('created_at').last().content, revised)
+
+
+def zip_upload(files, name='project.zip'):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for path, content in files.items():
+            archive.writestr(path, content)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='application/zip')
+
+
+@override_settings(CHAT_RESPONSE_CACHE_ENABLED=False, CHAT_CODE_ANALYSIS_WORKERS=0, CHAT_REVIEW_CHUNK_TOKENS=200)
+class CodeReviewTests(TestCase):
+
+    def setUp(self):
+        resilience._caller = None
+        self.review_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(CHAT_REVIEW_DIR=self.review_dir))
+        self.client.get('/api/session/')
+        self.project = {
+            'app/models.py': ''.join(
+                f"def handler_{n}(request):\n    value = request.get('key_{n}')\n"
+                f"    if value:\n        return value * {n}\n    return None\n\n\n"
+                for n in range(30)
+            ),
+            'app/util.py': "import os\n\ndef clean(path):\n    return path.strip()\n",
+            'app/logo.py': b"\x89PNG\x00\x00",
+            'node_modules/lib/index.js': "module.exports = 1;\n",
+            'README.md': "# project\n",
+        }
+
+    def tearDown(self):
+        resilience._caller = None
+
+    def answer(self, create, model, messages, **kwargs):
+        # one finding on the first line of every chunk
+        first_line = int(messages[-1]['content'].split('lines ')[1].split('-')[0])
+        return fake_completion(json.dumps({'findings': [
+            {'line': first_line, 'severity': 'warning', 'category': 'bug', 'message': f"Check line {first_line}"}
+        ]}))
+
+    def upload(self, data, path='/api/reviews/'):
+        with mock.patch.object(Completions, 'create', autospec=True, side_effect=self.answer) as create:
+            response = self.client.post(path, data)
+            if response.streaming:
+                response.lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        response.model_calls = create.call_count
+        return response
+
+    def test_archive_is_reviewed_in_chunks_and_merged(self):
+        response = self.upload({'archive': zip_upload(self.project)})
+        self.assertEqual(response.status_code, 201)
+        report = response.json()
+
+        files = {file['path']: file for file in report['files']}
+        self.assertEqual(sorted(files), ['app/logo.py', 'app/models.py', 'app/util.py'])
+        self.assertEqual(files['app/logo.py']['status'], 'skipped')
+        self.assertEqual(files['app/logo.py']['detail'], 'binary file')
+        self.assertGreater(files['app/models.py']['chunk_count'], 1)
+        self.assertEqual(response.model_calls, report['chunk_count'])
+        self.assertEqual(report['chunk_count'], files['app/models.py']['chunk_count'] + 1)
+
+        util = files['app/util.py']['findings']
+        self.assertEqual([(f['line'], f['source']) for f in util], [(1, 'static'), (1, 'model')])
+        self.assertEqual(util[0]['category'], 'unused-import')
+        models = files['app/models.py']['findings']
+        self.assertEqual(len(models), files['app/models.py']['chunk_count'])
+        self.assertEqual(models, sorted(models, key=lambda f: f['line']))
+
+        self.assertEqual(report['status'], 'complete')
+        self.assertEqual((report['reviewed_count'], report['skipped_count']), (2, 1))
+        self.assertEqual(report['findings_by_severity']['warning'], len(models) + 2)
+        self.assertEqual(os.listdir(self.review_dir), [])
+        self.assertEqual(self.client.get(f"/api/reviews/{report['id']}/").json(), report)
+
+    def test_reupload_reviews_only_changed_files(self):
+        first = self.upload({'archive': zip_upload(self.project)}).json()
+
+        self.project['app/util.py'] = "def clean(path):\n    return path.strip().lower()\n"
+        response = self.upload({
+            'files': [
+                SimpleUploadedFile('models.py', self.project['app/models.py'].encode()),
+                SimpleUploadedFile('util.py', self.project['app/util.py'].encode()),
+            ],
+            'paths': ['app/models.py', 'app/util.py'],
+        }, '/api/reviews/?stream=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.model_calls, 1)
+
+        files = {line['path']: line for line in response.lines[:-1]}
+        self.assertTrue(files['app/models.py']['reused'])
+        self.assertFalse(files['app/util.py']['reused'])
+        self.assertEqual([f['source'] for f in files['app/util.py']['findings']], ['model'])
+        review = response.lines[-1]['review']
+        self.assertEqual((review['reviewed_count'], review['reused_count'], review['chunk_count']), (1, 1, 1))
+
+        previous = ReviewedFile.objects.get(review_id=first['id'], path='app/models.py')
+        self.assertEqual(files['app/models.py']['findings'], previous.findings)
+        self.assertEqual(len(self.client.get('/api/reviews/').json()), 2)
@@ -1,9 +1,17 @@
 
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
     ChatSessionViewSet,
     QuickChatView,
+    BatchChatView,
+    MessageView,
+    ExportView,
+    AdminExportView,
+    SearchView,
+    CodeReviewView,
+    CodeReviewDetailView,
     SessionManagementView,
     StatsView,
     HealthCheckView
@@ -14,12 +22,42 @@ app_name = 'backendApp'
 router = DefaultRouter()
 router.register(r'sessions', ChatSessionViewSet, basename='chatsession')
 
-urlpatterns = [
+urlpatterns = []
+
+if settings.ASYNC_CHAT_VIEWS:
+    from .async_views import AsyncQuickChatView, AsyncSendMessageView, AsyncMessageView
+
+    # must come before the router so it shadows the sync send_message action
+    urlpatterns += [
+        path('sessions/<uuid:pk>/send_message/', AsyncSendMessageView.as_view(), name='chatsession-send-message-async'),
+    ]
+    quick_chat_view = AsyncQuickChatView.as_view()
+    message_view = AsyncMessageView.as_view()
+else:
+    quick_chat_view = QuickChatView.as_view()
+    message_view = MessageView.as_view()
+
+urlpatterns += [
 
     path('', include(router.urls)),
     
     
-    path('chat/', QuickChatView.as_view(), name='quick-chat'),
+    path('chat/', quick_chat_view, name='quick-chat'),
+    path('chat/batch/', BatchChatView.as_view(), name='quick-chat-batch'),
+    
+    
+    path('messages/<uuid:pk>/', message_view, name='message-detail'),
+    
+
+    path('search/', SearchView.as_view(), name='search'),
+    
+    
+    path('reviews/', CodeReviewView.as_view(), name='code-reviews'),
+    path('reviews/<uuid:pk>/', CodeReviewDetailView.as_view(), name='code-review-detail'),
+    
+    
+    path('export/', ExportView.as_view(), name='export'),
+    path('export/all/', AdminExportView.as_view(), name='export-all'),
     
 
     path('session/', SessionManagementView.as_view(), name='session-management'),
@@ -33,10 +71,22 @@ urlpatterns = [
 
 # Available endpoints:
 # POST   /api/chat/                       - Send message and get AI response
+# POST   /api/chat/?stream=1              - Same, streamed as Server-Sent Events
+# POST   /api/chat/?async=1               - Same, 202 with the pending reply, generated by run_chat_worker
+# POST   /api/chat/batch/                 - Many messages answered concurrently (?stream=1 for NDJSON)
 # GET    /api/sessions/                   - List user's chat sessions  
 # POST   /api/sessions/                   - Create new chat session
-# GET    /api/sessions/{id}/              - Get specific session with messages
+# GET    /api/sessions/{id}/              - Get specific session (?include_messages=1 embeds all messages)
+# GET    /api/sessions/{id}/messages/     - Session messages, keyset paginated (?before=, ?after=, ?limit=)
 # POST   /api/sessions/{id}/send_message/ - Send message to specific session
+#        (?stream=1 streams the reply as Server-Sent Events, ?async=1 queues it)
+# GET    /api/messages/{id}/              - Single message (?wait=N long-polls a pending reply)
+# GET    /api/search/?q=                  - Ranked full-text search over the user's messages (?limit=)
+# POST   /api/reviews/                    - Review an uploaded archive or files chunk by chunk (?stream=1 for NDJSON)
+# GET    /api/reviews/                    - List user's code reviews
+# GET    /api/reviews/{id}/               - Review report with every file's findings
+# GET    /api/export/                     - User's sessions and messages streamed as NDJSON (?gzip=1)
+# GET    /api/export/all/                 - Same for every user, staff only (?session_key=, ?gzip=1)
 # DELETE /api/sessions/{id}/              - Delete session
 # GET    /api/session/                    - Get session info
 # DELETE /api/session/                    - Clear session
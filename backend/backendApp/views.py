@@ -1,27 +1,262 @@
 
-from rest_framework import status, viewsets, views
+from rest_framework import permissions, status, viewsets, views
 from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
-from django.db import transaction
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.urls import reverse
 from django.utils import timezone
 from django.db.models import Count
+import json
 import logging
+import time
 
-from .models import ChatSession, ChatMessage
+from .models import ChatSession, ChatMessage, CodeReview
 from .serializers import (
-    ChatSessionSerializer, ChatSessionListSerializer, 
-    ChatMessageSerializer, SendMessageSerializer
+    ChatSessionSerializer, ChatSessionDetailSerializer, ChatSessionListSerializer, 
+    ChatMessageSerializer, SendMessageSerializer, BatchChatSerializer, SearchQuerySerializer,
+    ReviewUploadSerializer, ReviewedFileSerializer, CodeReviewSerializer, CodeReviewDetailSerializer
 )
+from .pagination import MessageKeysetPagination
 from .services.ai_service import CodingChatAI
+from .services.response_cache import get_response_cache
+from .services.admission import AdmissionRejected, admit
+from .services.batch_chat import fail_unfinished, run_batch
+from .services.chat_archive import iter_ndjson, iter_records
+from .services.chat_service import (
+    begin_exchange, begin_batch_exchanges, complete_exchange, fail_exchange, update_rolling_summary,
+    create_chat_session, delete_chat_sessions
+)
+from .services.code_review import (
+    ReviewPlan, ReviewUploadError, discard_upload, new_upload_directory, run_review, store_upload
+)
+from .services.job_queue import enqueue_reply, wait_for_message
+from .services.search_service import search_messages
+from .services.session_activity import forget_session, last_activity
+from .services.stats_service import get_counts, get_recent_activity
 
 logger = logging.getLogger(__name__)
 
+
+def wants_stream(request):
+    """True when the client asked for a Server-Sent Events response (?stream=1)"""
+    return request.GET.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def wants_queued_reply(request):
+    """
+    True when the client asked for the reply to be generated in the
+    background (?async=1 or Prefer: respond-async)
+    """
+    return (
+        request.GET.get('async', '').lower() in ('1', 'true', 'yes')
+        or 'respond-async' in request.headers.get('Prefer', '')
+    )
+
+
+def wants_background_delete(request):
+    """
+    True when a deletion should only mark the sessions deleted before
+    answering (asked for like a queued reply, or CHAT_DELETE_IN_BACKGROUND)
+    """
+    return settings.CHAT_DELETE_IN_BACKGROUND or wants_queued_reply(request)
+
+
+def long_poll_timeout(request):
+    """Seconds to wait from ?wait=, 0 when missing or invalid"""
+    try:
+        return max(0.0, float(request.GET.get('wait', 0)))
+    except ValueError:
+        return 0.0
+
+
+def wants_full_session(request):
+    """True when the client asked for the legacy payload with all messages"""
+    return request.GET.get('include_messages', '').lower() in ('1', 'true', 'yes')
+
+
+def session_payload(session, request):
+    if wants_full_session(request):
+        return ChatSessionDetailSerializer(session).data
+    return ChatSessionSerializer(session).data
+
+
+def queued_reply_payload(session, user_msg, assistant_msg, job):
+    """
+    Body of the 202 answer to a queued reply, the client long-polls
+    poll_url until the assistant message is no longer pending
+    """
+    return {
+        'user_message': ChatMessageSerializer(user_msg).data,
+        'assistant_message': ChatMessageSerializer(assistant_msg).data,
+        'session_id': str(session.id),
+        'job_id': str(job.id),
+        'poll_url': reverse('backendApp:message-detail', args=[assistant_msg.id]),
+    }
+
+
+def queued_reply_response(session, user_msg, assistant_msg, job):
+    payload = queued_reply_payload(session, user_msg, assistant_msg, job)
+    return Response(payload, status=status.HTTP_202_ACCEPTED, headers={'Location': payload['poll_url']})
+
+
+def too_many_requests(error):
+    """429 for a request refused by admission control"""
+    return Response(
+        {'error': 'Too many requests, please retry later', 'reason': error.reason, 'retry_after': error.retry_after},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={'Retry-After': str(error.retry_after)}
+    )
+
+
+def streaming_content(request, lines):
+    """
+    lines as the content of a StreamingHttpResponse. Under ASGI, Django 4.2
+    reads a sync iterator to its end before sending anything, so there the
+    lines go out through an async iterator instead, each one produced in
+    the request's thread, and reach the client as they are ready.
+    """
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        return _aiter_lines(iter(lines))
+    return lines
+
+
+_END = object()
+
+
+async def _aiter_lines(lines):
+    next_line = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            line = await next_line(lines, _END)
+            if line is _END:
+                return
+            yield line
+    finally:
+        # the client may be gone, the generator's cleanup still runs
+        close = getattr(lines, 'close', None)
+        if close:
+            await sync_to_async(close, thread_sensitive=True)()
+
+
+def export_response(sessions, request, name):
+    """
+    The sessions and their messages as a streamed NDJSON download (see
+    services/chat_archive.py), gzip'd with ?gzip=1. Rows are fetched in
+    chunks while the response is sent, memory stays flat.
+    """
+    compress = request.GET.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = f"{name}-{timezone.now():%Y%m%d}.ndjson"
+    if compress:
+        filename += '.gz'
+    
+    response = StreamingHttpResponse(
+        streaming_content(request, iter_ndjson(iter_records(sessions), compress=compress)),
+        content_type='application/gzip' if compress else 'application/x-ndjson'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+def stream_ai_reply(session, user_msg, assistant_msg, conversation_history, permit=None):
+    """
+    Stream the pending assistant_msg reply to user_msg as Server-Sent Events.
+
+    Events: ``start`` (user message, pending assistant message id),
+    ``delta`` (content chunks), ``done`` (stored assistant message) or
+    ``error``. The assistant message is completed once the stream closes.
+    If the client disconnects half way it is stored as failed with the
+    partial content. The admission permit, if any, is held until then.
+    """
+    ai_service = CodingChatAI()
+
+    def events():
+        start_time = time.time()
+        time_to_first_token = None
+        parts = []
+        result = None
+        ai_events = None
+
+        try:
+            yield sse_event('start', {
+                'user_message': ChatMessageSerializer(user_msg).data,
+                'assistant_message_id': str(assistant_msg.id),
+                'session_id': str(session.id)
+            })
+
+            summary = update_rolling_summary(session, conversation_history)
+            ai_events = ai_service.stream_response(
+                user_msg.content, conversation_history,
+                use_cache=session.response_cache_enabled, summary=summary
+            )
+
+            for event in ai_events:
+                if event['type'] == 'delta':
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    parts.append(event['content'])
+                    yield sse_event('delta', {'content': event['content']})
+                else:
+                    result = event
+        finally:
+            if ai_events is not None:
+                ai_events.close()
+
+            if result is None:
+                # client went away before the upstream stream finished
+                result = {
+                    'response': ''.join(parts),
+                    'tokens_used': None,
+                    'response_time': time.time() - start_time,
+                    'time_to_first_token': time_to_first_token,
+                    'error': 'Client disconnected before the response finished',
+                    'success': False,
+                }
+                logger.info(f"Client disconnected from stream for session {session.id}")
+
+            complete_exchange(assistant_msg, result)
+            if permit is not None:
+                permit.charge(result.get('tokens_used'))
+                permit.release()
+
+        if result['success']:
+            yield sse_event('done', {
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'success': True
+            })
+        else:
+            yield sse_event('error', {
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'error': result.get('error', 'Failed to process message'),
+                'success': False
+            })
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # tell nginx not to buffer the event stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 class ChatSessionViewSet(viewsets.ModelViewSet):
     
     
     def get_serializer_class(self):
         if self.action == 'list':
             return ChatSessionListSerializer
+        if self.action == 'retrieve' and wants_full_session(self.request):
+            return ChatSessionDetailSerializer
         return ChatSessionSerializer
     
     def get_queryset(self):
@@ -30,23 +265,30 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
         if not session_key:
             return ChatSession.objects.none()
         
-        return ChatSession.objects.filter(
-            session_key=session_key
-        ).prefetch_related('messages')
+        return ChatSession.objects.filter(session_key=session_key)
+    
+    def destroy(self, request, *args, **kwargs):
+        background = wants_background_delete(request)
+        delete_chat_sessions(ChatSession.objects.filter(pk=self.get_object().pk), background=background)
+        return Response(status=status.HTTP_202_ACCEPTED if background else status.HTTP_204_NO_CONTENT)
     
     def create(self, request, *args, **kwargs):
 
         if not request.session.session_key:
             request.session.create()
         
-        session = ChatSession.objects.create(
-            session_key=request.session.session_key,
-            title="New Chat"
-        )
+        session = create_chat_session(request.session.session_key, "New Chat")
         
         serializer = ChatSessionSerializer(session)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     
+    @action(detail=True, methods=['get'], pagination_class=MessageKeysetPagination)
+    def messages(self, request, pk=None):
+        """Messages of the session, keyset paginated (see MessageKeysetPagination)"""
+        session = self.get_object()
+        page = self.paginate_queryset(session.messages.all())
+        return self.get_paginated_response(ChatMessageSerializer(page, many=True).data)
+    
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
     
@@ -57,54 +299,54 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         user_message = serializer.validated_data['message']
+        assistant_msg = None
+        
+        try:
+            permit = admit(session.session_key, slots=0 if wants_queued_reply(request) else 1)
+        except AdmissionRejected as e:
+            return too_many_requests(e)
         
         try:
-            with transaction.atomic():
-                
-                user_msg = ChatMessage.objects.create(
-                    session=session,
-                    message_type='user',
-                    content=user_message
-                )
-                
+            # the user message and a pending reply are committed before the
+            # model is called, so no transaction is held open during generation
+            user_msg, assistant_msg, conversation_history = begin_exchange(
+                session, user_message, only_if_title="New Chat"
+            )
+            
+            if wants_queued_reply(request):
+                job = enqueue_reply(user_msg, assistant_msg)
+                return queued_reply_response(session, user_msg, assistant_msg, job)
             
-                if session.messages.count() == 1 and session.title == "New Chat":
-                    ai_service = CodingChatAI()
-                    session.title = ai_service.generate_session_title(user_message)
-                    session.save()
-                
-                
-                conversation_history = session.messages.order_by('created_at')
-                
+            if wants_stream(request):
+                return stream_ai_reply(session, user_msg, assistant_msg, conversation_history, permit.handover())
+            
+            summary = update_rolling_summary(session, conversation_history)
+            ai_service = CodingChatAI()
+            ai_result = ai_service.get_response(
+                user_message, conversation_history,
+                use_cache=session.response_cache_enabled, summary=summary
+            )
+            permit.charge(ai_result.get('tokens_used'))
             
-                ai_service = CodingChatAI()
-                ai_result = ai_service.get_response(user_message, conversation_history)
-                
-                
-                assistant_msg = ChatMessage.objects.create(
-                    session=session,
-                    message_type='assistant',
-                    content=ai_result['response'],
-                    tokens_used=ai_result.get('tokens_used'),
-                    response_time=ai_result.get('response_time')
-                )
-                
-        
-                session.updated_at = timezone.now()
-                session.save()
-                
-                return Response({
-                    'user_message': ChatMessageSerializer(user_msg).data,
-                    'assistant_message': ChatMessageSerializer(assistant_msg).data,
-                    'session': ChatSessionSerializer(session).data
-                })
+            complete_exchange(assistant_msg, ai_result)
+            session.refresh_from_db()
+            
+            return Response({
+                'user_message': ChatMessageSerializer(user_msg).data,
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'session': session_payload(session, request)
+            })
         
         except Exception as e:
             logger.error(f"Error in send_message: {str(e)}")
+            if assistant_msg is not None:
+                fail_exchange(assistant_msg, e)
             return Response(
                 {'error': 'Failed to process message'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+        finally:
+            permit.release()
 
 class QuickChatView(views.APIView):
     
@@ -118,12 +360,17 @@ class QuickChatView(views.APIView):
         
         user_message = serializer.validated_data['message']
         session_id = serializer.validated_data.get('session_id')
+        assistant_msg = None
+        
+        if not request.session.session_key:
+            request.session.create()
         
         try:
+            permit = admit(request.session.session_key, slots=0 if wants_queued_reply(request) else 1)
+        except AdmissionRejected as e:
+            return too_many_requests(e)
         
-            if not request.session.session_key:
-                request.session.create()
-            
+        try:
             
             if session_id:
                 try:
@@ -132,59 +379,312 @@ class QuickChatView(views.APIView):
                         session_key=request.session.session_key
                     )
                 except ChatSession.DoesNotExist:
-                    session = ChatSession.objects.create(
-                        session_key=request.session.session_key,
-                        title="Quick Chat"
-                    )
+                    session = create_chat_session(request.session.session_key, "Quick Chat")
             else:
-                session = ChatSession.objects.create(
-                    session_key=request.session.session_key,
-                    title="Quick Chat"
-                )
+                session = create_chat_session(request.session.session_key, "Quick Chat")
             
-            with transaction.atomic():
+            user_msg, assistant_msg, conversation_history = begin_exchange(session, user_message)
             
-                user_msg = ChatMessage.objects.create(
-                    session=session,
-                    message_type='user',
-                    content=user_message
-                )
-                
-                
-                if session.messages.count() == 1:
-                    ai_service = CodingChatAI()
-                    session.title = ai_service.generate_session_title(user_message)
-                    session.save()
-                
+            if wants_queued_reply(request):
+                job = enqueue_reply(user_msg, assistant_msg)
+                return queued_reply_response(session, user_msg, assistant_msg, job)
             
-                conversation_history = session.messages.order_by('created_at')
-                
+            if wants_stream(request):
+                return stream_ai_reply(session, user_msg, assistant_msg, conversation_history, permit.handover())
             
-                ai_service = CodingChatAI()
-                ai_result = ai_service.get_response(user_message, conversation_history)
-                
-                
-                assistant_msg = ChatMessage.objects.create(
-                    session=session,
-                    message_type='assistant',
-                    content=ai_result['response'],
-                    tokens_used=ai_result.get('tokens_used'),
-                    response_time=ai_result.get('response_time')
-                )
-                
-                return Response({
-                    'user_message': ChatMessageSerializer(user_msg).data,
-                    'assistant_message': ChatMessageSerializer(assistant_msg).data,
-                    'session_id': str(session.id),
-                    'success': ai_result['success']
-                })
+            summary = update_rolling_summary(session, conversation_history)
+            ai_service = CodingChatAI()
+            ai_result = ai_service.get_response(
+                user_message, conversation_history,
+                use_cache=session.response_cache_enabled, summary=summary
+            )
+            permit.charge(ai_result.get('tokens_used'))
+            
+            complete_exchange(assistant_msg, ai_result)
+            
+            return Response({
+                'user_message': ChatMessageSerializer(user_msg).data,
+                'assistant_message': ChatMessageSerializer(assistant_msg).data,
+                'session_id': str(session.id),
+                'success': ai_result['success']
+            })
         
         except Exception as e:
             logger.error(f"Error in quick_chat: {str(e)}")
+            if assistant_msg is not None:
+                fail_exchange(assistant_msg, e)
             return Response(
                 {'error': 'Failed to process message'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+        finally:
+            permit.release()
+
+class BatchChatView(views.APIView):
+    """
+    POST /api/chat/batch/ with {"items": [{"message", "session_id"}, ...]}.
+
+    Answers all items, CHAT_BATCH_CONCURRENCY at a time (or "concurrency"
+    if lower), and returns the results in item order. With ?stream=1 the
+    response is NDJSON, one line per result as soon as it is ready (with
+    its "index"), then a summary line.
+    """
+    
+    def post(self, request):
+        serializer = BatchChatSerializer(data=request.data)
+        
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        items = serializer.validated_data['items']
+        concurrency = min(
+            serializer.validated_data.get('concurrency', settings.CHAT_BATCH_CONCURRENCY), len(items)
+        )
+        
+        if not request.session.session_key:
+            request.session.create()
+        
+        try:
+            # an item costs a request, a batch larger than a full burst is
+            # refused; free upstream slots beyond the first set how far it fans out
+            permit = admit(request.session.session_key, requests=len(items), extra_slots=concurrency - 1)
+        except AdmissionRejected as e:
+            return too_many_requests(e)
+        
+        try:
+            exchanges = begin_batch_exchanges(request.session.session_key, items)
+        except Exception as e:
+            logger.error(f"Error in chat batch: {str(e)}")
+            permit.release()
+            return Response(
+                {'error': 'Failed to process messages'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        batch = run_batch(exchanges, permit.lanes(concurrency), permit)
+        
+        if wants_stream(request):
+            response = StreamingHttpResponse(
+                streaming_content(request, self.ndjson_lines(exchanges, batch, permit)),
+                content_type='application/x-ndjson'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        
+        try:
+            ordered = sorted(
+                (self.item_result(index, exchanges[index], assistant_msg, ai_result)
+                 for index, assistant_msg, ai_result in batch),
+                key=lambda result: result['index']
+            )
+        except Exception as e:
+            logger.error(f"Error in chat batch: {str(e)}")
+            batch.close()
+            permit.release()
+            fail_unfinished(exchanges, e)
+            return Response(
+                {'error': 'Failed to process messages'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        return Response({
+            'results': ordered,
+            'succeeded': sum(result['success'] for result in ordered),
+            'failed': sum(not result['success'] for result in ordered),
+        })
+    
+    def item_result(self, index, exchange, assistant_msg, ai_result):
+        session, user_msg, _, _ = exchange
+        result = {
+            'index': index,
+            'session_id': str(session.id),
+            'user_message': ChatMessageSerializer(user_msg).data,
+            'assistant_message': ChatMessageSerializer(assistant_msg).data,
+            'success': ai_result['success'],
+        }
+        if not ai_result['success']:
+            result['error'] = assistant_msg.error
+        return result
+    
+    def ndjson_lines(self, exchanges, batch, permit):
+        succeeded = failed = 0
+        try:
+            for index, assistant_msg, ai_result in batch:
+                result = self.item_result(index, exchanges[index], assistant_msg, ai_result)
+                if result['success']:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(result, cls=DjangoJSONEncoder) + '\n'
+        except Exception as e:
+            logger.error(f"Error in streamed chat batch: {str(e)}")
+            batch.close()
+            permit.release()
+            failed += fail_unfinished(exchanges, e)
+            yield json.dumps({'done': True, 'succeeded': succeeded, 'failed': failed, 'error': 'Failed to process messages'}) + '\n'
+            return
+        finally:
+            # client gone: the rest of the batch is still stored, see run_batch
+            batch.close()
+        yield json.dumps({'done': True, 'succeeded': succeeded, 'failed': failed}) + '\n'
+
+class MessageView(views.APIView):
+    """
+    A message of the caller's sessions. ?wait=<seconds> long-polls a pending
+    assistant reply: the answer comes as soon as it is complete or failed,
+    or after at most CHAT_LONG_POLL_MAX_WAIT seconds with it still pending.
+    """
+    
+    def get(self, request, pk):
+        session_key = request.session.session_key
+        if not session_key:
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        
+        queryset = ChatMessage.objects.filter(pk=pk, session__session_key=session_key)
+        message = wait_for_message(queryset, long_poll_timeout(request))
+        if message is None:
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response(ChatMessageSerializer(message).data)
+
+class ExportView(views.APIView):
+    """All chat sessions of the caller with their messages, streamed as NDJSON"""
+    
+    def get(self, request):
+        session_key = request.session.session_key
+        sessions = ChatSession.objects.filter(session_key=session_key) if session_key else ChatSession.objects.none()
+        return export_response(sessions, request, 'chats')
+
+class AdminExportView(views.APIView):
+    """Every chat session (?session_key= for one user's), staff only"""
+    permission_classes = [permissions.IsAdminUser]
+    
+    def get(self, request):
+        sessions = ChatSession.objects.filter(deleted_at__isnull=True)
+        if request.GET.get('session_key'):
+            sessions = sessions.filter(session_key=request.GET['session_key'])
+        return export_response(sessions, request, 'all-chats')
+
+class SearchView(views.APIView):
+    """
+    Full-text search over the messages of the caller's sessions, ranked hits
+    with highlighted snippets, see services/search_service.py
+    """
+    
+    def get(self, request):
+        serializer = SearchQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        query = serializer.validated_data['q']
+        session_key = request.session.session_key
+        results = []
+        if session_key:
+            results = search_messages(session_key, query, serializer.validated_data['limit'])
+        
+        return Response({'query': query, 'count': len(results), 'results': results})
+
+class CodeReviewView(views.APIView):
+    """
+    POST /api/reviews/ with a multipart "archive" (zip or tarball) or
+    "files" (and their "paths"): reviews the source files chunk by chunk,
+    CHAT_REVIEW_CONCURRENCY chunks (or "concurrency" if lower) at a time,
+    and returns the merged report. Files unchanged since an earlier review
+    of the caller keep its findings. With ?stream=1 the response is NDJSON,
+    one line per file as soon as it is done, then the review's totals.
+    
+    GET lists the caller's reviews, see services/code_review.py.
+    """
+    parser_classes = [MultiPartParser]
+    
+    def get(self, request):
+        session_key = request.session.session_key
+        reviews = CodeReview.objects.none()
+        if session_key:
+            reviews = CodeReview.objects.filter(session_key=session_key, deleted_at__isnull=True)
+        return Response(CodeReviewSerializer(reviews, many=True).data)
+    
+    def post(self, request):
+        # uploads are written to temporary files as they arrive, never held in memory
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        serializer = ReviewUploadSerializer(data=request.data)
+        
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        data = serializer.validated_data
+        if not request.session.session_key:
+            request.session.create()
+        session_key = request.session.session_key
+        archive = data.get('archive')
+        name = archive.name if archive else f"{len(data['files'])} files"
+        
+        directory = new_upload_directory()
+        try:
+            files = store_upload(directory, archive, data.get('files', ()), data.get('paths', ()))
+            plan = ReviewPlan.prepare(session_key, name, directory, files)
+        except ReviewUploadError as e:
+            discard_upload(directory)
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            logger.error(f"Error in code review upload: {str(e)}")
+            discard_upload(directory)
+            return Response({'error': 'Failed to read the upload'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        chunks = len(plan.chunks)
+        concurrency = min(data.get('concurrency', settings.CHAT_REVIEW_CONCURRENCY), max(1, chunks))
+        try:
+            # a chunk costs a request like a batch item, reused files cost nothing
+            permit = admit(
+                session_key, requests=max(1, chunks),
+                slots=1 if chunks else 0, extra_slots=concurrency - 1 if chunks else 0
+            )
+        except AdmissionRejected as e:
+            plan.discard()
+            return too_many_requests(e)
+        
+        try:
+            review = plan.start()
+        except Exception as e:
+            logger.error(f"Error in code review: {str(e)}")
+            plan.discard()
+            permit.release()
+            return Response({'error': 'Failed to start the review'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        results = run_review(plan, review, permit.lanes(concurrency), permit)
+        
+        if wants_stream(request):
+            response = StreamingHttpResponse(
+                streaming_content(request, self.ndjson_lines(review, results)), content_type='application/x-ndjson'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        
+        for _ in results:
+            pass
+        return Response(CodeReviewDetailSerializer(review).data, status=status.HTTP_201_CREATED)
+    
+    def ndjson_lines(self, review, results):
+        try:
+            for reviewed_file in results:
+                yield json.dumps(ReviewedFileSerializer(reviewed_file).data, cls=DjangoJSONEncoder) + '\n'
+        finally:
+            # client gone: the running chunks are still stored, see run_review
+            results.close()
+        yield json.dumps({'done': True, 'review': CodeReviewSerializer(review).data}, cls=DjangoJSONEncoder) + '\n'
+
+class CodeReviewDetailView(views.APIView):
+    """A review of the caller with every file's findings"""
+    
+    def get(self, request, pk):
+        session_key = request.session.session_key
+        review = CodeReview.objects.filter(
+            pk=pk, session_key=session_key, deleted_at__isnull=True
+        ).prefetch_related('files').first()
+        if not session_key or review is None:
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(CodeReviewDetailSerializer(review).data)
 
 class SessionManagementView(views.APIView):
     """Manage user sessions"""
@@ -194,21 +694,16 @@ class SessionManagementView(views.APIView):
         if not request.session.session_key:
             request.session.create()
         
-        # Get session stats
-        chat_sessions = ChatSession.objects.filter(
-            session_key=request.session.session_key
-        )
-        
-        total_messages = ChatMessage.objects.filter(
-            session__session_key=request.session.session_key
-        ).count()
+        # Get session stats, one counter row
+        counts = get_counts(request.session.session_key)
+        total_messages = counts['messages']
         
         session_data = {
             'session_key': request.session.session_key,
-            'chat_sessions_count': chat_sessions.count(),
+            'chat_sessions_count': counts['sessions'],
             'total_messages': total_messages,
             'created_reviews_count': total_messages,  # For frontend compatibility
-            'last_activity': request.session.get('last_activity', timezone.now().isoformat()),
+            'last_activity': (last_activity(request.session.session_key) or timezone.now()).isoformat(),
         }
         
         return Response(session_data)
@@ -216,12 +711,19 @@ class SessionManagementView(views.APIView):
     def delete(self, request):
         """Clear session and all associated chats"""
         session_key = request.session.session_key
+        background = wants_background_delete(request)
         
         if session_key:
             # Delete all chat sessions for this user session
-            ChatSession.objects.filter(session_key=session_key).delete()
+            delete_chat_sessions(
+                ChatSession.objects.filter(session_key=session_key), background=background,
+                reviews=CodeReview.objects.filter(session_key=session_key)
+            )
+            forget_session(session_key)
         
         request.session.flush()
+        if background:
+            return Response({'message': 'Session cleared, chats are being deleted'}, status=status.HTTP_202_ACCEPTED)
         return Response({'message': 'Session cleared successfully'})
 
 class StatsView(views.APIView):
@@ -230,30 +732,31 @@ class StatsView(views.APIView):
     def get(self, request):
         """Get overall stats"""
         
+        # counter rows and daily rollups only, see services/stats_service.py
         session_key = request.session.session_key
-        user_sessions = 0
-        user_messages = 0
+        user_counts = {'sessions': 0, 'messages': 0}
         
         if session_key:
-            user_sessions = ChatSession.objects.filter(session_key=session_key).count()
-            user_messages = ChatMessage.objects.filter(
-                session__session_key=session_key
-            ).count()
+            user_counts = get_counts(session_key)
     
-        total_sessions = ChatSession.objects.count()
-        total_messages = ChatMessage.objects.count()
+        totals = get_counts()
+        recent = get_recent_activity(days=30)
+        response_cache = get_response_cache()
         
         stats = {
-            'total_reviews': total_sessions, 
-            'completed_reviews': total_sessions,
+            'total_reviews': totals['sessions'], 
+            'completed_reviews': totals['sessions'],
             'analyzing_reviews': 0,
+            'total_messages': totals['messages'],
             'recent_activity': {
-                'reviews_last_30_days': user_sessions,
+                'reviews_last_30_days': recent['sessions'],
+                'messages_last_30_days': recent['messages'],
             },
             'user_session_stats': {
-                'chat_sessions': user_sessions,
-                'total_messages': user_messages,
-            }
+                'chat_sessions': user_counts['sessions'],
+                'total_messages': user_counts['messages'],
+            },
+            'response_cache': response_cache.stats() if response_cache else None,
         }
         
         return Response(stats)
@@ -264,17 +767,15 @@ class HealthCheckView(views.APIView):
 
         try:
     
-            ChatSession.objects.count()
-            
-            
-            ai_service = CodingChatAI()
+            ChatSession.objects.exists()
             
             return Response({
                 'status': 'healthy',
                 'timestamp': timezone.now(),
                 'services': {
                     'database': True,
-                    'openai': hasattr(ai_service, 'get_response'),
+                    # configuration only, probing OpenAI on every health check costs a request
+                    'openai': bool(settings.OPENAI_API_KEY),
                 }
             })
         except Exception as e:
@@ -0,0 +1,142 @@
+"""
+Connection setup cost: a new OpenAI client per request vs the pooled
+per-process client from backendApp.services.openai_client.
+
+Starts the stub server over HTTPS with a throwaway self-signed certificate
+(needs the openssl command) and sends the same completions both ways, so
+the difference is the TCP + TLS setup a warm keep-alive connection saves.
+
+    python -m benchmarks.client_pool --requests 300 --output client-pool.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import django
+import httpx
+import openai
+
+from .fake_openai import FakeOpenAIServer, build_parser as stub_parser
+from .loadtest import git_revision, summarize
+
+MESSAGES = [{'role': 'user', 'content': 'How do I reverse a list in Python?'}]
+
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-keyout', keyfile, '-out', certfile, '-subj', '/CN=127.0.0.1',
+        '-addext', 'subjectAltName=IP:127.0.0.1',
+    ], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def start_stub(options, certfile, keyfile):
+    stub_options = stub_parser().parse_args([
+        '--port', '0',
+        '--latency', str(options.latency),
+        '--tokens-per-second', '100000',
+        '--completion-tokens', '20',
+    ] + (['--certfile', certfile, '--keyfile', keyfile] if certfile else []))
+    server = FakeOpenAIServer(('127.0.0.1', 0), stub_options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed_requests(count, send):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        send()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def run(options):
+    with tempfile.TemporaryDirectory() as directory:
+        certfile = keyfile = None
+        if not options.plain_http:
+            certfile, keyfile = make_certificate(directory)
+            # trusted by every httpx client made below, pooled or not
+            os.environ['SSL_CERT_FILE'] = certfile
+
+        server = start_stub(options, certfile, keyfile)
+        scheme = 'http' if options.plain_http else 'https'
+        base_url = f"{scheme}://127.0.0.1:{server.server_port}/v1"
+
+        os.environ['OPENAI_API_KEY'] = 'benchmark'
+        os.environ['OPENAI_BASE_URL'] = base_url
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+        django.setup()
+        from backendApp.services.openai_client import close_clients, get_client, warm_clients
+
+        def per_request_client():
+            # what constructing a client for every request costs
+            with openai.OpenAI(api_key='benchmark', base_url=base_url, max_retries=0,
+                               http_client=httpx.Client()) as client:
+                client.chat.completions.create(model='gpt-4o-mini', messages=MESSAGES)
+
+        def pooled_client():
+            get_client().chat.completions.create(model='gpt-4o-mini', messages=MESSAGES)
+
+        results = {}
+        for name, send, warm in (('per_request_client', per_request_client, None),
+                                 ('pooled_client', pooled_client, warm_clients)):
+            if warm:
+                warm(connect=True)
+            timed_requests(options.warmup, send)
+            connections_before = server.stats.as_dict()['connections']
+            timings = timed_requests(options.requests, send)
+            results[name] = {
+                'latency_ms': summarize(timings),
+                'connections_opened': server.stats.as_dict()['connections'] - connections_before,
+            }
+
+        close_clients()
+        server.shutdown()
+        server.server_close()
+
+    saved = results['per_request_client']['latency_ms']['mean'] - results['pooled_client']['latency_ms']['mean']
+    return {
+        'meta': {'git_revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')},
+        'config': {
+            'requests': options.requests,
+            'tls': not options.plain_http,
+            'stub_latency_s': options.latency,
+        },
+        'results': results,
+        'saved_per_request_ms': saved,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pooled vs per-request OpenAI clients')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='Stub latency in seconds (default: 0)')
+    parser.add_argument('--plain-http', action='store_true', help='Skip TLS, measure TCP setup only')
+    parser.add_argument('--output', default='client-pool-results.json')
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in report['results'].items():
+        latency = result['latency_ms']
+        print(
+            f"{name:<20} mean {latency['mean']:7.2f} ms  p50 {latency['p50']:7.2f} ms  "
+            f"p95 {latency['p95']:7.2f} ms  connections {result['connections_opened']}"
+        )
+    print(f"connection setup saved per request: {report['saved_per_request_ms']:.2f} ms")
+    print(f"results written to {options.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Per-snippet overhead of the code analysis stage in front of the model
+(backendApp.services.code_analysis).
+
+For Python snippets of a few sizes it times the analysers alone (inline),
+a full analyze_message() through the process pool with a cold cache (every
+snippet is new) and with a warm one, and counts the prompt tokens the
+hints add next to the tokens of the snippet itself.
+
+    python -m benchmarks.code_analysis --requests 200 --output code-analysis.json
+"""
+import argparse
+import json
+import os
+import time
+
+import django
+
+from .loadtest import git_revision, summarize
+
+FUNCTION = '''
+def handler_{n}(request, cache={{}}):
+    """Look the item up, caching misses"""
+    key = request.get("key")
+    if key is None or key == "":
+        return None
+    for attempt in range(3):
+        try:
+            value = cache[key]
+        except:
+            value = fetch(key, attempt)
+        if value and attempt > 0 or value == None:
+            continue
+    return [item for item in value if item]
+'''
+
+SIZES = {'small': 1, 'medium': 8, 'large': 60}
+
+
+def snippet(functions, salt):
+    # the salt keeps every snippet distinct, so cold runs never hit the cache
+    body = ''.join(FUNCTION.format(n=n) for n in range(functions))
+    return f"# revision {salt}\nimport os\nfrom json import loads\n{body}"
+
+
+def message(code):
+    return f"Can you review this?\n```python\n{code}```\n"
+
+
+def timed(count, func):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def run(options):
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    os.environ['CHAT_CODE_ANALYSIS_WORKERS'] = str(options.workers)
+    django.setup()
+    from backendApp.services.code_analysis import (
+        analyze_message, analyze_snippet, close_pool, hints_message, warm_pool
+    )
+    from backendApp.services.context_builder import count_tokens
+
+    warm_pool()
+    results = {}
+    for size, functions in SIZES.items():
+        fixed = message(snippet(functions, 'fixed'))
+        analyze_message(fixed)
+        hints = hints_message(analyze_message(fixed))
+
+        results[size] = {
+            'lines': snippet(functions, 0).count('\n'),
+            'snippet_tokens': count_tokens(snippet(functions, 0)),
+            'hint_tokens': count_tokens(hints),
+            'inline_ms': summarize(timed(options.requests, lambda i: analyze_snippet(snippet(functions, i), 'python'))),
+            'cold_cache_ms': summarize(timed(options.requests, lambda i: analyze_message(message(snippet(functions, f"cold-{i}"))))),
+            'warm_cache_ms': summarize(timed(options.requests, lambda i: analyze_message(fixed))),
+        }
+
+    close_pool()
+    return {
+        'meta': {'git_revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')},
+        'config': {'requests': options.requests, 'workers': options.workers},
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the per-snippet cost of the code analysis stage')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=2, help='Pool processes, 0 analyses inline (default: 2)')
+    parser.add_argument('--output', default='code-analysis-results.json')
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for size, result in report['results'].items():
+        print(
+            f"{size:<7} {result['lines']:5d} lines  inline p50 {result['inline_ms']['p50']:6.2f} ms  "
+            f"cold p50 {result['cold_cache_ms']['p50']:6.2f} ms  warm p50 {result['warm_cache_ms']['p50']:6.3f} ms  "
+            f"hints {result['hint_tokens']} tokens for a {result['snippet_tokens']} token snippet"
+        )
+    print(f"results written to {options.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""
+OpenAI-compatible stub server for load tests.
+
+Serves POST /v1/chat/completions, streamed or not, with a configurable
+latency, token rate and error rate, so the backend can be benchmarked
+without calling the real API. Standard library only.
+
+    python -m benchmarks.fake_openai --port 8100 --latency 0.3 --tokens-per-second 80
+
+Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1
+(any OPENAI_API_KEY will do). With --certfile/--keyfile it serves HTTPS,
+so connection setup costs include a TLS handshake like the real API.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import random
+import ssl
+import threading
+import time
+import uuid
+
+WORDS = (
+    "use a list comprehension here because it keeps the loop readable and "
+    "avoids the repeated append calls while the generator version is lazy"
+).split()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def start(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, error=False):
+        with self.lock:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+            }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeOpenAI/1.0'
+    # headers and body are separate writes, Nagle would delay the body ~40ms
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stats.connected()
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            return self.send_json(200, self.server.stats.as_dict())
+        if self.path.rstrip('/').endswith('/models'):
+            return self.send_json(200, {'object': 'list', 'data': [{'id': 'gpt-4o-mini', 'object': 'model'}]})
+        self.send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self.send_json(400, {'error': {'message': 'Invalid JSON', 'type': 'invalid_request_error'}})
+
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self.send_json(404, {'error': {'message': 'Not found'}})
+
+        options = self.server.options
+        stats = self.server.stats
+        stats.start()
+        error = False
+        try:
+            roll = random.random()
+            if roll < options.error_rate:
+                error = True
+                time.sleep(self.latency())
+                return self.send_error_response(options.error_status)
+            if roll < options.error_rate + options.hang_rate:
+                # a stuck upstream, for exercising client timeouts
+                error = True
+                time.sleep(options.hang_seconds)
+                return self.send_error_response(504)
+
+            completion_tokens = self.completion_tokens(body)
+            prompt_tokens = self.prompt_tokens(body)
+            time.sleep(self.latency())
+
+            if body.get('stream'):
+                include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+                self.stream_completion(body, completion_tokens, prompt_tokens, include_usage)
+            else:
+                time.sleep(completion_tokens / options.tokens_per_second)
+                self.send_json(200, self.completion(body, completion_tokens, prompt_tokens))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away mid-response
+            error = True
+        finally:
+            stats.finish(error)
+
+    def latency(self):
+        options = self.server.options
+        return max(0.0, random.gauss(options.latency, options.jitter)) if options.jitter else options.latency
+
+    def completion_tokens(self, body):
+        tokens = self.server.options.completion_tokens
+        if body.get('max_tokens'):
+            tokens = min(tokens, int(body['max_tokens']))
+        return max(1, tokens)
+
+    def prompt_tokens(self, body):
+        # same ~4 characters per token estimate the backend falls back to
+        chars = sum(len(str(m.get('content') or '')) for m in body.get('messages') or [])
+        return (chars + 3) // 4
+
+    def text(self, tokens):
+        return ' '.join(WORDS[i % len(WORDS)] for i in range(tokens))
+
+    def completion(self, body, completion_tokens, prompt_tokens):
+        return {
+            'id': f"chatcmpl-{uuid.uuid4().hex}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.text(completion_tokens)},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+    def stream_completion(self, body, completion_tokens, prompt_tokens, include_usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {
+            'id': chunk_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+        }
+        delay = 1.0 / self.server.options.tokens_per_second
+
+        self.write_event(dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]))
+        for i in range(completion_tokens):
+            word = WORDS[i % len(WORDS)]
+            self.write_event(dict(base, choices=[{
+                'index': 0,
+                'delta': {'content': word if i == 0 else ' ' + word},
+                'finish_reason': None,
+            }]))
+            time.sleep(delay)
+        self.write_event(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if include_usage:
+            self.write_event(dict(base, choices=[], usage={
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            }))
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.write_chunk(b'')
+
+    def write_event(self, data):
+        self.write_chunk(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_error_response(self, status):
+        error_type = 'rate_limit_error' if status == 429 else 'server_error'
+        headers = {'Retry-After': '1'} if status == 429 else {}
+        self.send_json(status, {'error': {'message': f'Injected error ({status})', 'type': error_type}}, headers)
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, options):
+        super().__init__(address, FakeOpenAIHandler)
+        self.options = options
+        self.stats = Stats()
+        if options.certfile:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(options.certfile, options.keyfile)
+            # handshake in the handler thread, not in the accept loop
+            self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='OpenAI-compatible stub server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.25,
+                        help='Seconds before the first token (default: 0.25)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Standard deviation of the latency in seconds (default: 0)')
+    parser.add_argument('--tokens-per-second', type=float, default=100.0,
+                        help='Generation speed (default: 100)')
+    parser.add_argument('--completion-tokens', type=int, default=60,
+                        help='Tokens per completion, capped by max_tokens (default: 60)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with --error-status (default: 0)')
+    parser.add_argument('--error-status', type=int, default=500, choices=[429, 500, 502, 503],
+                        help='Status of injected errors (default: 500)')
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help='Fraction of requests that stall for --hang-seconds (default: 0)')
+    parser.add_argument('--hang-seconds', type=float, default=30.0)
+    parser.add_argument('--certfile', help='Serve HTTPS with this certificate (PEM)')
+    parser.add_argument('--keyfile', help='Private key of --certfile')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    server = FakeOpenAIServer((options.host, options.port), options)
+    scheme = 'https' if options.certfile else 'http'
+    print(f"Fake OpenAI listening on {scheme}://{options.host}:{server.server_port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats.as_dict()), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""
+Load driver for the chat API.
+
+Runs each scenario for a number of requests at a fixed concurrency against a
+running backend and reports latency percentiles, requests/s, DB queries per
+request (from the X-DB-Query-Count header, see BENCHMARK_QUERY_HEADERS) and
+the peak RSS of the server processes. Results are written as JSON so runs
+can be compared across commits with --compare.
+
+    python -m benchmarks.loadtest --base-url http://127.0.0.1:8000 \\
+        --concurrency 16 --requests 400 --server-pid $(pgrep -of gunicorn) \\
+        --output bench-results.json
+
+See "Benchmarks" in the top-level README for the full setup.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+import uuid
+
+import httpx
+
+SCENARIOS = ('chat', 'sessions', 'send_message')
+
+PROMPTS = [
+    "How do I reverse a list in Python?",
+    "What is the difference between a process and a thread?",
+    "Why does my React component render twice?",
+    "How should I index a table for range queries on a timestamp?",
+    "Explain Big O of a dict lookup.",
+]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(p / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+class RSSSampler(threading.Thread):
+    """Samples the resident memory of the given processes and their children (Linux /proc)"""
+
+    def __init__(self, pids, interval=0.2):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_kb = max(self.peak_kb, sum(self.rss_kb(pid) for pid in self.process_tree()))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def process_tree(self):
+        seen = set()
+        pending = list(self.pids)
+        while pending:
+            pid = pending.pop()
+            if pid in seen:
+                continue
+            seen.add(pid)
+            try:
+                for tid in os.listdir(f'/proc/{pid}/task'):
+                    with open(f'/proc/{pid}/task/{tid}/children') as f:
+                        pending.extend(int(child) for child in f.read().split())
+            except OSError:
+                continue
+        return seen
+
+    def rss_kb(self, pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+
+class Worker:
+    """One simulated user with its own connection and session cookie"""
+
+    def __init__(self, options):
+        self.options = options
+        self.client = httpx.Client(base_url=options.base_url, timeout=options.timeout)
+        self.client.get('/api/session/')
+        self.chat_session_id = None
+        self.sent = 0
+
+    def close(self):
+        self.client.close()
+
+    def prompt(self):
+        self.sent += 1
+        prompt = PROMPTS[self.sent % len(PROMPTS)]
+        if self.options.repeat_prompts:
+            return prompt
+        # a unique suffix so the response cache does not answer for the model
+        return f"{prompt} (run {uuid.uuid4().hex[:8]})"
+
+    def run(self, scenario):
+        if scenario == 'chat':
+            return self.post_message('/api/chat/')
+        if scenario == 'sessions':
+            return self.client.get('/api/sessions/'), None
+        if scenario == 'send_message':
+            if self.chat_session_id is None:
+                response = self.client.post('/api/sessions/', json={'title': 'Load test'})
+                response.raise_for_status()
+                self.chat_session_id = response.json()['id']
+            return self.post_message(f'/api/sessions/{self.chat_session_id}/send_message/')
+        raise ValueError(f"Unknown scenario {scenario}")
+
+    def post_message(self, url):
+        payload = {'message': self.prompt()}
+        if not self.options.stream:
+            return self.client.post(url, json=payload), None
+
+        start = time.perf_counter()
+        first_token = None
+        with self.client.stream('POST', url, params={'stream': 1}, json=payload) as response:
+            for line in response.iter_lines():
+                if first_token is None and line.startswith('event: delta'):
+                    first_token = time.perf_counter() - start
+        return response, first_token
+
+
+def run_scenario(scenario, workers, options):
+    latencies, first_tokens, queries, query_ms = [], [], [], []
+    errors = {}
+    lock = threading.Lock()
+    remaining = [options.requests]
+
+    def take():
+        with lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def loop(worker):
+        while take():
+            start = time.perf_counter()
+            try:
+                response, first_token = worker.run(scenario)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                response, first_token, status = None, None, type(e).__name__
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                if status != 200 and status != 201:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+                    continue
+                latencies.append(elapsed * 1000)
+                if first_token is not None:
+                    first_tokens.append(first_token * 1000)
+                if 'X-DB-Query-Count' in response.headers:
+                    queries.append(int(response.headers['X-DB-Query-Count']))
+                    query_ms.append(float(response.headers.get('X-DB-Query-Time-Ms', 0)))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+        list(pool.map(loop, workers))
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': options.requests,
+        'ok': len(latencies),
+        'errors': errors,
+        'wall_seconds': wall,
+        'requests_per_second': len(latencies) / wall if wall else None,
+        'latency_ms': summarize(latencies),
+        'time_to_first_token_ms': summarize(first_tokens),
+        'db_queries_per_request': summarize(queries),
+        'db_query_time_ms': summarize(query_ms),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results, baseline=None):
+    print(f"\n{'scenario':<14}{'ok':>6}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+    for name, result in results['scenarios'].items():
+        latency = result['latency_ms'] or {}
+        queries = result['db_queries_per_request'] or {}
+        rps = result['requests_per_second'] or 0
+        print(
+            f"{name:<14}{result['ok']:>6}{sum(result['errors'].values()):>6}{rps:>9.1f}"
+            f"{latency.get('p50', 0):>10.1f}{latency.get('p95', 0):>10.1f}{latency.get('p99', 0):>10.1f}"
+            f"{queries.get('mean', 0):>9.1f}"
+        )
+        if baseline and name in baseline.get('scenarios', {}):
+            print_delta(result, baseline['scenarios'][name])
+
+    rss = results['peak_rss_mb']
+    server = f"{rss['server']} MB" if rss['server'] is not None else 'not sampled (use --server-pid)'
+    print(f"\npeak RSS: server {server}, driver {rss['driver']:.1f} MB")
+
+
+def print_delta(result, old):
+    def change(new, before):
+        if not new or not before:
+            return '     n/a'
+        return f"{(new - before) / before * 100:>+7.1f}%"
+
+    latency, old_latency = result['latency_ms'] or {}, old.get('latency_ms') or {}
+    queries, old_queries = result['db_queries_per_request'] or {}, old.get('db_queries_per_request') or {}
+    print(
+        f"{'  vs baseline':<26}{change(result['requests_per_second'], old.get('requests_per_second')):>9}"
+        f"{change(latency.get('p50'), old_latency.get('p50')):>10}"
+        f"{change(latency.get('p95'), old_latency.get('p95')):>10}"
+        f"{change(latency.get('p99'), old_latency.get('p99')):>10}"
+        f"{change(queries.get('mean'), old_queries.get('mean')):>9}"
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Load test the chat API')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma separated, run in order (default: {','.join(SCENARIOS)})")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario (default: 200)')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per scenario (default: 10)')
+    parser.add_argument('--stream', action='store_true', help='Request SSE responses and measure time to first token')
+    parser.add_argument('--repeat-prompts', action='store_true',
+                        help='Reuse the same prompts so the response cache can answer')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--server-pid', type=int, action='append', default=[],
+                        help='Server process to sample RSS from, with its children (repeatable)')
+    parser.add_argument('--label', default='', help='Free text stored with the results')
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--compare', help='Earlier results file to print deltas against')
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    scenarios = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+
+    sampler = RSSSampler(options.server_pid)
+    sampler.start()
+
+    workers = [Worker(options) for _ in range(options.concurrency)]
+    results = {}
+    try:
+        for name in scenarios:
+            if options.warmup:
+                run_scenario(name, workers, argparse.Namespace(**dict(vars(options), requests=options.warmup)))
+            print(f"running {name}: {options.requests} requests at concurrency {options.concurrency}", flush=True)
+            results[name] = run_scenario(name, workers, options)
+    finally:
+        for worker in workers:
+            worker.close()
+        sampler.stop()
+
+    report = {
+        'meta': {
+            'label': options.label,
+            'git_revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'config': {
+            'base_url': options.base_url,
+            'concurrency': options.concurrency,
+            'requests': options.requests,
+            'warmup': options.warmup,
+            'stream': options.stream,
+            'repeat_prompts': options.repeat_prompts,
+        },
+        'scenarios': results,
+        'peak_rss_mb': {
+            'server': round(sampler.peak_kb / 1024, 1) if options.server_pid else None,
+            # ru_maxrss is in kilobytes on Linux
+            'driver': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+    }
+
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"\nresults written to {options.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Session writes per request, before and after write-behind session activity
+(backendApp.services.session_activity).
+
+Runs the same read-only traffic (session info, stats, health, session list)
+for a number of sessions through Django's test client, against a scratch
+SQLite database, in two setups:
+
+    save_every_request  db session engine, SESSION_SAVE_EVERY_REQUEST=True
+    write_behind        cached_db engine, SessionActivityMiddleware
+
+and counts the queries on django_session. The requests of a session are
+--gap seconds apart on a simulated clock, so flushes happen as they would
+over (requests * gap) seconds of real traffic.
+
+    python -m benchmarks.session_activity --sessions 50 --requests 40 --gap 5
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import django
+
+from .loadtest import git_revision, summarize
+
+PATHS = ('/api/session/', '/api/stats/', '/api/health/', '/api/sessions/')
+
+
+class SessionQueries:
+    """execute_wrapper() hook counting reads and writes of django_session"""
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if 'django_session' in sql:
+            if sql.lstrip().upper().startswith('SELECT'):
+                self.reads += 1
+            else:
+                self.writes += 1
+        return execute(sql, params, many, context)
+
+
+def run_mode(name, overrides, options):
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client, override_settings
+    from backendApp.services import session_activity
+
+    clock = [0.0]
+    session_activity._activity = session_activity.SessionActivity(clock=lambda: clock[0])
+    middleware = [m for m in settings.MIDDLEWARE if m != 'backendApp.middleware.SessionActivityMiddleware']
+    if name == 'write_behind':
+        middleware = settings.MIDDLEWARE
+
+    with override_settings(MIDDLEWARE=middleware, **overrides):
+        clients = [Client(HTTP_HOST='localhost') for _ in range(options.sessions)]
+        for client in clients:
+            client.get('/api/session/')
+
+        counter = SessionQueries()
+        timings = []
+        with connection.execute_wrapper(counter):
+            for i in range(options.requests):
+                for n, client in enumerate(clients):
+                    start = time.perf_counter()
+                    client.get(PATHS[(i + n) % len(PATHS)])
+                    timings.append((time.perf_counter() - start) * 1000)
+                    clock[0] += options.gap / options.sessions
+            # what a worker writes when it exits
+            session_activity.flush_session_activity()
+
+    total = options.sessions * options.requests
+    return {
+        'requests': total,
+        'session_reads': counter.reads,
+        'session_writes': counter.writes,
+        'writes_per_request': counter.writes / total,
+        'reads_per_request': counter.reads / total,
+        'latency_ms': summarize(timings),
+    }
+
+
+def run(options):
+    database = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+    os.environ['DB_NAME'] = database.name
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    os.environ['CHAT_SESSION_ACTIVITY_FLUSH_INTERVAL'] = str(options.flush_interval)
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+    modes = {
+        'save_every_request': {
+            'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+            'SESSION_SAVE_EVERY_REQUEST': True,
+        },
+        # one process, so the local 'sessions' cache is as good as a shared one
+        'write_behind': {'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db'},
+    }
+    try:
+        results = {name: run_mode(name, overrides, options) for name, overrides in modes.items()}
+    finally:
+        os.unlink(database.name)
+    return {
+        'meta': {'git_revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')},
+        'config': {
+            'sessions': options.sessions, 'requests': options.requests,
+            'gap': options.gap, 'flush_interval': options.flush_interval,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the django_session writes of read-only requests')
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=40, help='Requests per session')
+    parser.add_argument('--gap', type=float, default=5, help='Simulated seconds between requests of a session')
+    parser.add_argument('--flush-interval', type=float, default=60)
+    parser.add_argument('--output', default='session-activity-results.json')
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in report['results'].items():
+        print(
+            f"{name:<19} {result['requests']} requests  "
+            f"writes/request {result['writes_per_request']:.3f}  reads/request {result['reads_per_request']:.3f}  "
+            f"p50 {result['latency_ms']['p50']:.2f} ms"
+        )
+    print(f"results written to {options.output}")
+
+
+if __name__ == '__main__':
+    main()
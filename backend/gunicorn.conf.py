@@ -0,0 +1,52 @@
+"""
+gunicorn settings, picked up automatically when gunicorn runs from backend/.
+
+Every worker gets its own pooled OpenAI clients, created and connected
+when the worker boots and closed when it exits (services/openai_client.py),
+and its own code analysis process pool (services/code_analysis.py). On
+exit it also writes the session activity it has pending
+(services/session_activity.py) and purges the chat sessions and code
+reviews its background deletes have not finished (services/chat_service.py).
+
+Prometheus multiprocess mode: every worker writes its metric samples to
+PROMETHEUS_MULTIPROC_DIR and /metrics aggregates the files, so a scrape
+sees the whole server rather than the worker that happened to answer.
+The directory has to be set before the workers import prometheus_client
+and emptied on every start so old samples are not counted again.
+"""
+import os
+import shutil
+
+prometheus_multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus-multiproc'
+)
+
+
+def on_starting(server):
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # the app, and with it Django, is loaded by now
+    from backendApp.services.code_analysis import warm_pool
+    from backendApp.services.openai_client import warm_clients
+    warm_clients()
+    warm_pool()
+
+
+def worker_exit(server, worker):
+    from backendApp.services.chat_service import purge_unfinished_deletes
+    from backendApp.services.code_analysis import close_pool
+    from backendApp.services.openai_client import close_clients
+    from backendApp.services.session_activity import flush_session_activity
+    close_clients()
+    close_pool()
+    flush_session_activity()
+    # only what this worker's delete threads left, prune_chats does the rest
+    purge_unfinished_deletes()
@@ -55,7 +55,20 @@ class ApiService {
   }
 
   async getChatSession(id) {
-    return this.request(`/api/sessions/${id}/`);
+    const [session, page] = await Promise.all([
+      this.request(`/api/sessions/${id}/`),
+      this.getSessionMessages(id),
+    ]);
+    return { ...session, messages: page.results };
+  }
+
+  // newest page first; pass page.previous's cursor as `before` for older ones
+  async getSessionMessages(id, { before = null, limit = 50 } = {}) {
+    const params = new URLSearchParams({ limit });
+    if (before) {
+      params.set('before', before);
+    }
+    return this.request(`/api/sessions/${id}/messages/?${params.toString()}`);
   }
 
   async createChatSession() {